@@ -43,14 +43,24 @@ import uuid
 from sklearn.ensemble import RandomForestRegressor, IsolationForest
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_absolute_error, r2_score
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.linear_model import LinearRegression
-from scipy.stats import pearsonr
+from scipy.stats import t as distribucion_t, kendalltau, theilslopes
 import warnings
 import os
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists
 import base64
 
 warnings.filterwarnings('ignore')
@@ -156,7 +166,7 @@ app.config['SECRET_KEY'] = SECRET_KEY
 # Configurar CORS para permitir solicitudes desde cualquier origen
 CORS(app,
      origins="*",
-     allow_headers=['Content-Type', 'Authorization', 'X-API-Key', 'Accept', 'Origin'],
+     allow_headers=['Content-Type', 'Authorization', 'X-API-Key', 'Accept', 'Origin', 'Idempotency-Key'],
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH', 'HEAD'],
      supports_credentials=False,
      max_age=86400)
@@ -167,7 +177,7 @@ def after_request(response):
     """Agregar headers CORS a cada respuesta"""
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS, PATCH, HEAD'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-API-Key, Accept, Origin'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-API-Key, Accept, Origin, Idempotency-Key'
     response.headers['Access-Control-Max-Age'] = '86400'
     return response
 
@@ -198,8 +208,81 @@ try:
 except ImportError:
     print("⚠️  flask-swagger-ui no instalado - Swagger UI no disponible")
 
-# Diccionario para almacenar tokens activos
-active_tokens = {}
+# Verificación sin estado: un token es válido si la firma y 'exp' lo son, así
+# que cualquier worker (o el proceso tras un reinicio) acepta los tokens de
+# los demás. La revocación usa una lista de token_id revocados que solo
+# guarda cada id hasta que su token habría expirado. La lista vive en un
+# SQLite compartido por todos los workers de la máquina; JWT_REVOCADOS_DB debe
+# ser una ruta absoluta en un disco persistente, porque el disco del
+# contenedor se pierde en cada despliegue y con él las revocaciones.
+# JWT_REVOCADOS_DB=memoria la deja en memoria del proceso: solo vale con un
+# único worker, porque un token revocado en uno seguiría válido en los demás
+# (gunicorn.conf.py no arranca si se combina con varios workers).
+JWT_REVOCADOS_DB = os.getenv('JWT_REVOCADOS_DB', '')
+JWT_REVOCADOS_EN_MEMORIA = JWT_REVOCADOS_DB.lower() == 'memoria'
+
+if not JWT_REVOCADOS_EN_MEMORIA and not os.path.isabs(JWT_REVOCADOS_DB):
+    raise RuntimeError(
+        'JWT_REVOCADOS_DB requiere una ruta absoluta en un disco persistente '
+        '(p. ej. /var/data/jwt_revocados.db) o el valor memoria con un único worker; '
+        f'valor actual: {JWT_REVOCADOS_DB!r}'
+    )
+
+_tokens_revocados = {}  # token_id -> timestamp de expiración del token
+_revocados_lock = threading.Lock()
+_revocados_inicializado = False
+_revocados_local = threading.local()
+
+
+def _conexion_revocados():
+    """
+    Conexión al SQLite de revocados. token_revocado se consulta en cada petición
+    autenticada, así que cada hilo abre la suya una vez y la reutiliza (sqlite3
+    no comparte conexiones entre hilos).
+    """
+    global _revocados_inicializado
+    conexion = getattr(_revocados_local, 'conexion', None)
+    if conexion is not None:
+        return conexion
+    conexion = sqlite3.connect(JWT_REVOCADOS_DB, timeout=30)
+    _revocados_local.conexion = conexion
+    if not _revocados_inicializado:
+        with _revocados_lock:
+            if not _revocados_inicializado:
+                conexion.execute('PRAGMA journal_mode=WAL')
+                conexion.execute('CREATE TABLE IF NOT EXISTS revocados (token_id TEXT PRIMARY KEY, expira REAL NOT NULL)')
+                conexion.execute('CREATE INDEX IF NOT EXISTS revocados_expira ON revocados (expira)')
+                conexion.commit()
+                _revocados_inicializado = True
+    return conexion
+
+
+def revocar_token(token_id, expira):
+    """
+    Añade un token_id a la lista de revocados hasta 'expira' (timestamp).
+    Aprovecha para desalojar las entradas cuyo token ya expiró.
+    """
+    ahora = time.time()
+    if not JWT_REVOCADOS_EN_MEMORIA:
+        with _conexion_revocados() as conexion:
+            conexion.execute('DELETE FROM revocados WHERE expira <= ?', (ahora,))
+            conexion.execute('INSERT OR REPLACE INTO revocados (token_id, expira) VALUES (?, ?)', (token_id, expira))
+        return
+    with _revocados_lock:
+        for expirado in [t for t, exp in _tokens_revocados.items() if exp <= ahora]:
+            del _tokens_revocados[expirado]
+        _tokens_revocados[token_id] = expira
+
+
+def token_revocado(token_id):
+    """True si el token_id está en la lista de revocados."""
+    if not JWT_REVOCADOS_EN_MEMORIA:
+        fila = _conexion_revocados().execute(
+            'SELECT 1 FROM revocados WHERE token_id = ? AND expira > ?', (token_id, time.time())
+        ).fetchone()
+        return fila is not None
+    return token_id in _tokens_revocados
+
 
 def generate_token(user_id='default_user'):
     """Genera un JWT token único con expiración"""
@@ -211,17 +294,16 @@ def generate_token(user_id='default_user'):
             'exp': datetime.utcnow() + timedelta(hours=TOKEN_EXPIRATION_HOURS)
         }
         token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
-        active_tokens[token] = payload
         return token
     except Exception as e:
         return None
 
 def verify_token(token):
-    """Verifica la validez del JWT token. Devuelve payload si es válido, False si no."""
+    """Verifica la validez del JWT token (firma, expiración y revocación). Devuelve payload si es válido, False si no."""
     try:
-        if token not in active_tokens:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'], options={'require': ['exp', 'token_id']})
+        if token_revocado(payload['token_id']):
             return False
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
         return payload
     except jwt.ExpiredSignatureError:
         return False
@@ -250,9 +332,10 @@ def token_required(f):
         payload = verify_token(token)
         if not payload:
             return jsonify({'error': 'Token inválido o expirado'}), 401
-        # Exponer user_id en el contexto de la request
+        # Exponer user_id (y el payload, para revocarlo) en el contexto de la request
         try:
             g.user_id = payload.get('user_id')
+            g.token_payload = payload
         except Exception:
             pass
         
@@ -301,6 +384,13 @@ try:
 except ImportError:
     LSTM_AVAILABLE = False
 
+# Persistencia opcional de modelos entrenados
+try:
+    import joblib
+    JOBLIB_AVAILABLE = True
+except ImportError:
+    JOBLIB_AVAILABLE = False
+
 
 # ============================================================
 # 🛠️ UTILIDADES Y HELPERS
@@ -312,47 +402,100 @@ def validate_expense_data(data):
     return all(field in item for item in data for field in required_fields)
 
 
+def construir_frame_gastos(registros):
+    """
+    Construye el DataFrame tipado y compacto que consumen todos los análisis.
+
+    Acepta gastos del body (fecha, monto, categoria) o documentos de Firestore
+    (fecha|createdAt, cantidad|monto, categoria, descripcion, id). Las
+    columnas de calendario se calculan aquí una sola vez.
+
+    Args:
+        registros: Lista de dicts con gastos
+
+    Returns:
+        DataFrame ordenado por fecha (los empates se desempatan por id de
+        origen o, si algún registro no lo trae, por orden de entrada) con columnas:
+        id, fecha (datetime64), monto (float64), categoria (category),
+        descripcion, dia, año_mes (period M), mes, año, trimestre,
+        dia_mes, dia_semana, semana y año_iso (enteros pequeños).
+        df.attrs['fechas_invalidas'] indica cuántos registros se descartaron.
+    """
+    crudo = pd.DataFrame.from_records(registros) if registros else pd.DataFrame()
+
+    def _columna(nombre, alternativa=None):
+        if nombre in crudo.columns:
+            col = crudo[nombre].astype(object)
+        else:
+            col = pd.Series(None, index=crudo.index, dtype=object)
+        if alternativa and alternativa in crudo.columns:
+            col = col.where(col.notna() & (col != ''), crudo[alternativa])
+        return col
+
+    fechas, fechas_invalidas = normalizar_fechas(_columna('fecha', 'createdAt'))
+    monto = pd.to_numeric(_columna('cantidad', 'monto'), errors='coerce').fillna(0).astype('float64')
+    categoria = _columna('categoria')
+    categoria = categoria.where(categoria.notna() & (categoria != ''), 'Sin categoría').astype(str)
+    ids = _columna('id')
+    ids_de_origen = bool(len(ids)) and bool(ids.notna().all())
+    ids = ids.where(ids.notna(), 'fila-' + crudo.index.astype(str).to_series(index=crudo.index))
+
+    df = pd.DataFrame({
+        'id': ids.astype(str),
+        'fecha': fechas,
+        'monto': monto,
+        'categoria': categoria.astype('category'),
+        'descripcion': _columna('descripcion').fillna('')
+    })
+    # Orden estable sobre una clave determinista: el orden de los documentos de
+    # Firestore depende de cómo se sincronizó el snapshot, así que ahí se
+    # desempata por id; los gastos del body conservan su orden de entrada
+    orden = ['fecha', 'id'] if ids_de_origen else 'fecha'
+    df = df[df['fecha'].notna()].sort_values(orden, kind='mergesort').reset_index(drop=True)
+    df['categoria'] = df['categoria'].cat.remove_unused_categories()
+
+    fecha = df['fecha'].dt
+    iso = fecha.isocalendar()
+    df['dia'] = fecha.normalize()
+    df['año_mes'] = fecha.to_period('M')
+    df['mes'] = fecha.month.astype('int8')
+    df['año'] = fecha.year.astype('int16')
+    df['trimestre'] = fecha.quarter.astype('int8')
+    df['dia_mes'] = fecha.day.astype('int8')
+    df['dia_semana'] = fecha.dayofweek.astype('int8')
+    df['semana'] = iso['week'].astype('int8')
+    df['año_iso'] = iso['year'].astype('int16')
+
+    df.attrs['fechas_invalidas'] = fechas_invalidas
+    return df
+
+
 def prepare_dataframe(expenses):
-    """Prepara DataFrame con validación y conversión de tipos."""
-    df = pd.DataFrame(expenses)
-    df['fecha'] = pd.to_datetime(df['fecha'])
-    df['monto'] = pd.to_numeric(df['monto'])
-    # Estandarizar nombre de columna para compatibilidad
-    if 'categoria' in df.columns:
-        df['category'] = df['categoria']
-    return df.sort_values('fecha').reset_index(drop=True)
+    """Prepara DataFrame con validación y conversión de tipos (ver construir_frame_gastos)."""
+    return construir_frame_gastos(expenses)
 
 
 def _expenses_from_firebase_for_user(user_id):
-    """Obtiene gastos de Firestore y los adapta al esquema esperado por endpoints (fecha, monto, categoria)."""
+    """Obtiene el DataFrame tipado de gastos del usuario desde Firestore (fecha, monto, categoria...)."""
     if not FIREBASE_AVAILABLE or not db:
         return None, 'Firebase no disponible'
-    gastos, error = obtener_gastos_firebase(user_id)
+    df, error = obtener_frame_gastos(user_id)
     if error:
         return None, error
-    expenses = []
-    for g_item in gastos:
-        try:
-            dt = procesar_fecha(g_item.get('fecha') or g_item.get('createdAt'))
-            categoria = g_item.get('categoria') or 'Sin categoría'
-            monto_val = g_item.get('cantidad') if 'cantidad' in g_item else g_item.get('monto', 0)
-            monto = float(monto_val) if monto_val is not None else 0.0
-            expenses.append({
-                'fecha': dt.strftime('%Y-%m-%d'),
-                'monto': monto,
-                'categoria': categoria
-            })
-        except Exception:
-            continue
-    return expenses, None
+    if df.empty:
+        return None, 'Sin gastos con fecha válida'
+    return df, None
 
 
 def _get_expenses_or_firebase(data):
-    """Devuelve expenses del body si son válidos; si no, intenta cargarlos desde Firebase usando g.user_id."""
+    """Devuelve el DataFrame de expenses del body si son válidos; si no, lo carga desde Firebase usando g.user_id."""
     data = data or {}
     expenses = data.get('expenses') or []
     if expenses and validate_expense_data(expenses):
-        return expenses, None
+        df = construir_frame_gastos(expenses)
+        if df.empty:
+            return None, 'Ningún gasto del body tiene una fecha válida'
+        return df, None
     # Intentar con Firebase si hay user_id en token
     try:
         user_id = getattr(g, 'user_id', None)
@@ -363,8 +506,16 @@ def _get_expenses_or_firebase(data):
     return None, 'No se proporcionaron expenses y no se pudo determinar el usuario'
 
 
+def _leer_dias_prediccion(por_defecto=30):
+    """Lee ?days= de la petición. Devuelve (dias, error) con 1 <= dias <= PREDICCION_MAX_DIAS."""
+    dias = request.args.get('days', por_defecto, type=int)
+    if not 1 <= dias <= PREDICCION_MAX_DIAS:
+        return None, f'days debe estar entre 1 y {PREDICCION_MAX_DIAS}'
+    return dias, None
+
+
 def _get_user_expenses_from_token():
-    """Obtiene los gastos del usuario desde Firebase usando el user_id del token.
+    """Obtiene el DataFrame de gastos del usuario desde Firebase usando el user_id del token.
     Se usa en endpoints GET que no reciben datos en el body."""
     try:
         user_id = getattr(g, 'user_id', None)
@@ -374,65 +525,621 @@ def _get_user_expenses_from_token():
     if not user_id:
         return None, None, 'Usuario no identificado en el token'
     
-    expenses, err = _expenses_from_firebase_for_user(user_id)
-    if not expenses:
+    df, err = _expenses_from_firebase_for_user(user_id)
+    if df is None:
         return None, user_id, f'No hay gastos en Firebase: {err}'
     
-    return expenses, user_id, None
+    return df, user_id, None
+
+
+# ============================================================
+# 🗄️ CACHÉ EN MEMORIA (LRU + TTL)
+# ============================================================
+
+def _crear_cache_lru(max_entradas, ttl_segundos=None):
+    """
+    Crea una caché LRU en memoria del proceso con TTL opcional.
+
+    Args:
+        max_entradas: Número máximo de claves antes de desalojar la menos usada
+        ttl_segundos: Segundos de vida de cada entrada (None = sin expiración)
+
+    Returns:
+        Dict con el estado de la caché (usar con las funciones _cache_*)
+    """
+    return {
+        'entradas': OrderedDict(),
+        'max_entradas': max(1, int(max_entradas)),
+        'ttl': ttl_segundos,
+        'lock': threading.RLock(),
+        'hits': 0,
+        'misses': 0,
+        'expiradas': 0,
+        'desalojadas': 0
+    }
+
+
+def _cache_obtener(cache, clave, contar=True):
+    """Devuelve el valor guardado para la clave o None si no existe o expiró."""
+    with cache['lock']:
+        entrada = cache['entradas'].get(clave)
+        if entrada is None:
+            if contar:
+                cache['misses'] += 1
+            return None
+        guardado_en, valor = entrada
+        if cache['ttl'] is not None and time.monotonic() - guardado_en > cache['ttl']:
+            del cache['entradas'][clave]
+            cache['expiradas'] += 1
+            if contar:
+                cache['misses'] += 1
+            return None
+        cache['entradas'].move_to_end(clave)
+        if contar:
+            cache['hits'] += 1
+        return valor
+
+
+def _cache_guardar(cache, clave, valor):
+    """Guarda un valor y desaloja las entradas menos usadas si se supera el tamaño."""
+    with cache['lock']:
+        cache['entradas'][clave] = (time.monotonic(), valor)
+        cache['entradas'].move_to_end(clave)
+        while len(cache['entradas']) > cache['max_entradas']:
+            cache['entradas'].popitem(last=False)
+            cache['desalojadas'] += 1
+
+
+def _cache_invalidar(cache, clave=None):
+    """Elimina una clave de la caché (o toda la caché si clave es None)."""
+    with cache['lock']:
+        if clave is None:
+            cache['entradas'].clear()
+        else:
+            cache['entradas'].pop(clave, None)
+
+
+def _cache_estadisticas(cache):
+    """Resumen de uso de la caché para diagnóstico."""
+    with cache['lock']:
+        consultas = cache['hits'] + cache['misses']
+        return {
+            'entradas': len(cache['entradas']),
+            'max_entradas': cache['max_entradas'],
+            'ttl_segundos': cache['ttl'],
+            'hits': cache['hits'],
+            'misses': cache['misses'],
+            'ratio_aciertos': round(cache['hits'] / consultas, 4) if consultas else 0.0,
+            'expiradas': cache['expiradas'],
+            'desalojadas': cache['desalojadas']
+        }
+
+
+# Caché de snapshots de gastos por usuario (users/{uid}/gastos)
+GASTOS_CACHE_MAX_USUARIOS = int(os.getenv('GASTOS_CACHE_MAX_USUARIOS', 256))
+# Pasado este tiempo el snapshot se refresca consultando solo los gastos nuevos
+GASTOS_CACHE_TTL_SEGUNDOS = int(os.getenv('GASTOS_CACHE_TTL_SEGUNDOS', 300))
+# Relectura completa periódica para recoger ediciones, borrados y gastos sin createdAt
+GASTOS_RESYNC_COMPLETA_SEGUNDOS = int(os.getenv('GASTOS_RESYNC_COMPLETA_SEGUNDOS', 3600))
+
+# Las entradas no expiran por TTL: cuando envejecen se sincronizan por delta
+_gastos_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS)
+
+_gastos_sync_stats = {
+    'sync_completas': 0,
+    'sync_incrementales': 0,
+    'docs_delta': 0
+}
+
+# Locks por usuario (repartidos en franjas) para que varias peticiones
+# simultáneas del mismo usuario hagan una sola lectura de Firestore
+_GASTOS_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def _lock_gastos_usuario(usuario_id):
+    """Devuelve el lock asociado a un usuario."""
+    return _GASTOS_LOCKS[hash(usuario_id) % len(_GASTOS_LOCKS)]
+
+
+def _actualizar_marca_agua(marcas, gasto_id, gasto):
+    """
+    Actualiza la marca de agua (createdAt máximo + ids vistos en ese instante).
+
+    Se guarda una marca por tipo de valor (string ISO o Timestamp) porque
+    Firestore solo compara createdAt contra valores del mismo tipo.
+    """
+    creado = gasto.get('createdAt')
+    if creado is None:
+        return
+    tipo = type(creado).__name__
+    actual = marcas.get(tipo)
+    if actual is None or creado > actual[0]:
+        marcas[tipo] = (creado, {gasto_id})
+    elif creado == actual[0]:
+        actual[1].add(gasto_id)
+
+
+def _leer_gastos_completo(client, usuario_id):
+    """Lee toda la subcolección de gastos del usuario."""
+    gastos = {}
+    for doc in client.collection('users').document(usuario_id).collection('gastos').stream():
+        gasto = doc.to_dict()
+        gasto['id'] = doc.id
+        gastos[doc.id] = gasto
+    return gastos
+
+
+def _leer_gastos_delta(client, usuario_id, marcas):
+    """Lee solo los gastos con createdAt >= marca de agua que no se habían visto."""
+    nuevos = {}
+    gastos_ref = client.collection('users').document(usuario_id).collection('gastos')
+    for valor, ids_vistos in marcas.values():
+        for doc in gastos_ref.where('createdAt', '>=', valor).stream():
+            if doc.id in ids_vistos:
+                continue
+            gasto = doc.to_dict()
+            gasto['id'] = doc.id
+            nuevos[doc.id] = gasto
+    return nuevos
+
+
+def sincronizar_gastos_usuario(usuario_id, entrada=None, client=None, completa=False):
+    """
+    Sincroniza el snapshot de gastos de un usuario de forma incremental.
+
+    Args:
+        usuario_id: ID del usuario
+        entrada: Snapshot previo (None para carga completa)
+        client: Cliente Firestore (por defecto el global db; admite un doble en memoria)
+        completa: Forzar relectura de toda la colección
+
+    Returns:
+        Dict con gastos por id, marcas de agua, versión y momento de sincronización
+    """
+    client = client or db
+    ahora = time.monotonic()
+
+    requiere_completa = (
+        completa
+        or entrada is None
+        or not entrada['marcas']
+        or ahora - entrada['sync_completa_en'] > GASTOS_RESYNC_COMPLETA_SEGUNDOS
+    )
+
+    if requiere_completa:
+        gastos = _leer_gastos_completo(client, usuario_id)
+        marcas = {}
+        for gasto_id, gasto in gastos.items():
+            _actualizar_marca_agua(marcas, gasto_id, gasto)
+        _gastos_sync_stats['sync_completas'] += 1
+        return {
+            'gastos': gastos,
+            'marcas': marcas,
+            'version': entrada['version'] + 1 if entrada else 1,
+            'sincronizado_en': ahora,
+            'sync_completa_en': ahora,
+            'obsoleta': False
+        }
+
+    nuevos = _leer_gastos_delta(client, usuario_id, entrada['marcas'])
+    _gastos_sync_stats['sync_incrementales'] += 1
+    _gastos_sync_stats['docs_delta'] += len(nuevos)
+
+    if not nuevos:
+        return {**entrada, 'sincronizado_en': ahora, 'obsoleta': False}
+
+    # Copia para no alterar listas ya entregadas a otras peticiones
+    gastos = dict(entrada['gastos'])
+    gastos.update(nuevos)
+    marcas = {tipo: (valor, set(ids)) for tipo, (valor, ids) in entrada['marcas'].items()}
+    for gasto_id, gasto in nuevos.items():
+        _actualizar_marca_agua(marcas, gasto_id, gasto)
+
+    return {
+        **entrada,
+        'gastos': gastos,
+        'marcas': marcas,
+        'version': entrada['version'] + 1,
+        'sincronizado_en': ahora,
+        'obsoleta': False,
+        'frame': None
+    }
+
+
+def _snapshot_gastos_vigente(entrada):
+    """Indica si el snapshot puede servirse sin consultar Firestore."""
+    return (not entrada['obsoleta']
+            and time.monotonic() - entrada['sincronizado_en'] <= GASTOS_CACHE_TTL_SEGUNDOS)
+
+
+def invalidar_cache_gastos(usuario_id=None, completa=False):
+    """
+    Invalida el snapshot de gastos de un usuario (o de todos si usuario_id es None).
+
+    Por defecto solo lo marca como obsoleto para que la siguiente lectura
+    consulte únicamente el delta; completa=True lo descarta por completo.
+    """
+    if usuario_id is None or completa:
+        _cache_invalidar(_gastos_cache, usuario_id)
+        return
+    entrada = _cache_obtener(_gastos_cache, usuario_id, contar=False)
+    if entrada is not None:
+        entrada['obsoleta'] = True
+
+
+def estadisticas_cache_gastos():
+    """Estadísticas de aciertos/fallos y sincronizaciones de la caché de gastos."""
+    return {
+        **_cache_estadisticas(_gastos_cache),
+        'ttl_segundos': GASTOS_CACHE_TTL_SEGUNDOS,
+        **_gastos_sync_stats
+    }
+
+
+# ============================================================
+# 🧊 CUBO DE AGREGADOS
+# ============================================================
+# Los endpoints compuestos (*-complete, asesor) llaman a 5+ funciones que
+# repetían los mismos groupby. El cubo los calcula una sola vez por frame.
+
+# Cubos recientes indexados por la huella de contenido del frame. Solo se
+# cachean los frames compartidos (los de obtener_frame_gastos); los que se
+# construyen con el cuerpo de una petición son de un solo uso
+_cubos_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS)
+
+# Huellas de los frames compartidos, indexadas por id(frame) con una
+# referencia débil: al liberarse el frame su entrada desaparece, de modo que
+# un id reutilizado nunca hereda la huella de otro frame
+_huellas_frames = {}
+_huellas_frames_lock = threading.RLock()
+
+
+def calcular_huella_frame(df):
+    """Huella del contenido de un frame de gastos (id, fecha, monto y categoría)."""
+    filas = pd.util.hash_pandas_object(df[['id', 'fecha', 'monto', 'categoria']], index=False)
+    return _huella_datos(filas.values)
+
+
+def registrar_huella_frame(df, huella=None):
+    """Registra un frame compartido con su huella (la calcula si no se pasa)."""
+    if huella is None:
+        huella = calcular_huella_frame(df)
+    clave = id(df)
+
+    def _liberar(ref):
+        with _huellas_frames_lock:
+            actual = _huellas_frames.get(clave)
+            if actual is not None and actual[0] is ref:
+                del _huellas_frames[clave]
+
+    with _huellas_frames_lock:
+        _huellas_frames[clave] = (weakref.ref(df, _liberar), huella)
+    return huella
+
+
+def huella_registrada(df):
+    """Huella del frame si está registrado como compartido, None en otro caso."""
+    with _huellas_frames_lock:
+        entrada = _huellas_frames.get(id(df))
+    if entrada is None or entrada[0]() is not df:
+        return None
+    return entrada[1]
+
+
+def construir_cubo_agregados(df):
+    """
+    Calcula en una sola pasada los agregados que consumen los análisis.
+
+    Args:
+        df: DataFrame de construir_frame_gastos
+
+    Returns:
+        Dict con totales globales y rollups (DataFrames) por día, mes,
+        categoría, día de semana, semana ISO, mes×categoría y la matriz
+        día×categoría (NaN donde la categoría no tuvo gastos ese día).
+    """
+    monto = df['monto']
+    stats = ['sum', 'count', 'mean']
+    renombrar = {'sum': 'total', 'count': 'n', 'mean': 'promedio'}
+
+    dia_categoria = df.groupby(['dia', 'categoria'], observed=True)['monto'].sum()
+    matriz = dia_categoria.unstack('categoria')
+
+    por_categoria = df.groupby('categoria', observed=True)['monto'].agg(
+        ['sum', 'count', 'mean', 'max', 'min', 'std']
+    ).rename(columns={**renombrar, 'max': 'maximo', 'min': 'minimo', 'std': 'desviacion'})
+    por_categoria['dias'] = matriz.notna().sum().reindex(por_categoria.index).fillna(0).astype(int)
+
+    return {
+        'n': len(df),
+        'total': float(monto.sum()),
+        'media': float(monto.mean()) if len(df) else 0.0,
+        'desviacion': float(monto.std()) if len(df) > 1 else 0.0,
+        'mediana': float(monto.median()) if len(df) else 0.0,
+        'por_dia': df.groupby('dia')['monto'].agg(['sum', 'count']).rename(columns=renombrar),
+        'por_mes': df.groupby('año_mes')['monto'].agg(stats).rename(columns=renombrar),
+        'por_categoria': por_categoria,
+        'por_dia_semana': df.groupby('dia_semana')['monto'].agg(stats).rename(columns=renombrar),
+        'por_semana': df.groupby(['año_iso', 'semana'])['monto'].sum(),
+        'por_mes_categoria': df.groupby(['año_mes', 'categoria'], observed=True)['monto'].agg(['sum', 'count']).rename(columns=renombrar),
+        'matriz_dia_categoria': matriz
+    }
+
+
+def obtener_cubo_agregados(df):
+    """
+    Devuelve el cubo del frame. Los frames compartidos lo reutilizan por huella
+    de contenido; los de un solo uso lo calculan sin guardarlo en caché.
+    """
+    huella = huella_registrada(df)
+    if huella is None:
+        return construir_cubo_agregados(df)
+    cubo = _cache_obtener(_cubos_cache, huella)
+    if cubo is None:
+        cubo = construir_cubo_agregados(df)
+        _cache_guardar(_cubos_cache, huella, cubo)
+    return cubo
+
+
+# ============================================================
+# 🧠 REGISTRO DE MODELOS ENTRENADOS
+# ============================================================
+# Los modelos por categoría se indexan por (usuario, categoría, huella de los
+# datos de entrenamiento): si los gastos no cambian, no se vuelve a entrenar.
+
+MODELOS_CACHE_MAX = int(os.getenv('MODELOS_CACHE_MAX', 512))
+# Directorio para persistir los modelos con joblib (vacío = solo memoria)
+MODELOS_CACHE_DIR = os.getenv('MODELOS_CACHE_DIR', '')
+
+_modelos_cache = _crear_cache_lru(MODELOS_CACHE_MAX)
+
+# Entrenamiento en paralelo: número de workers (1 = secuencial) y tipo de pool.
+# 'thread' aprovecha que sklearn libera el GIL al construir los árboles;
+# 'process' aísla cada ajuste en otro proceso (los estimadores se serializan).
+PREDICCION_WORKERS = int(os.getenv('PREDICCION_WORKERS', min(4, os.cpu_count() or 1)))
+PREDICCION_MODO_POOL = os.getenv('PREDICCION_MODO_POOL', 'thread').lower()
+
+_pool_modelos = None
+_pool_modelos_lock = threading.Lock()
+
+_modelos_stats = {
+    'entrenamientos': 0,
+    'cargados_disco': 0,
+    'guardados_disco': 0,
+    'errores_disco': 0
+}
+
+
+def _huella_datos(*arrays):
+    """Huella estable del contenido de los arrays de entrenamiento."""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        if arr is None:
+            h.update(b'-')
+            continue
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def _ruta_modelo(clave):
+    """Ruta del fichero joblib para una clave del registro."""
+    nombre = hashlib.blake2b(repr(clave).encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(MODELOS_CACHE_DIR, f'{nombre}.joblib')
+
+
+def _cargar_modelo_disco(clave):
+    if not MODELOS_CACHE_DIR or not JOBLIB_AVAILABLE:
+        return None
+    ruta = _ruta_modelo(clave)
+    if not os.path.exists(ruta):
+        return None
+    try:
+        modelo = joblib.load(ruta)
+        _modelos_stats['cargados_disco'] += 1
+        return modelo
+    except Exception:
+        _modelos_stats['errores_disco'] += 1
+        return None
+
+
+def _guardar_modelo_disco(clave, modelo):
+    if not MODELOS_CACHE_DIR or not JOBLIB_AVAILABLE:
+        return
+    try:
+        os.makedirs(MODELOS_CACHE_DIR, exist_ok=True)
+        ruta = _ruta_modelo(clave)
+        temporal = f'{ruta}.{uuid.uuid4().hex}.tmp'
+        joblib.dump(modelo, temporal)
+        os.replace(temporal, ruta)
+        _modelos_stats['guardados_disco'] += 1
+    except Exception:
+        _modelos_stats['errores_disco'] += 1
+
+
+def _crear_rf_categoria():
+    """Estimador de predicción por categoría (función de módulo para poder enviarla a procesos)."""
+    return RandomForestRegressor(n_estimators=50, max_depth=5, random_state=42)
+
+
+def _ajustar_modelo(crear_modelo, X, y):
+    """Crea y entrena un estimador. Se ejecuta en el pool de entrenamiento."""
+    modelo = crear_modelo()
+    modelo.fit(X, y)
+    return modelo
+
+
+def _pool_entrenamiento():
+    """Pool acotado compartido por todas las peticiones (se crea bajo demanda)."""
+    global _pool_modelos
+    with _pool_modelos_lock:
+        if _pool_modelos is None:
+            if PREDICCION_MODO_POOL == 'process':
+                # spawn: un fork heredaría el canal gRPC del cliente de Firestore
+                _pool_modelos = ProcessPoolExecutor(
+                    max_workers=PREDICCION_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                _pool_modelos = ThreadPoolExecutor(
+                    max_workers=PREDICCION_WORKERS,
+                    thread_name_prefix='entrenamiento'
+                )
+        return _pool_modelos
+
+
+def ajustar_modelos(tareas):
+    """
+    Entrena varios modelos, en paralelo si hay más de un worker configurado.
+
+    Args:
+        tareas: Lista de tuplas (crear_modelo, X, y)
+
+    Returns:
+        Lista de estimadores entrenados en el mismo orden que las tareas
+    """
+    if PREDICCION_WORKERS <= 1 or len(tareas) <= 1:
+        return [_ajustar_modelo(*tarea) for tarea in tareas]
+
+    # pool.map conserva el orden de entrada: el resultado es determinista
+    return list(_pool_entrenamiento().map(_ajustar_modelo, *zip(*tareas)))
+
+
+def obtener_modelos_entrenados(peticiones):
+    """
+    Devuelve un modelo ajustado por petición, reutilizando los ya existentes.
+
+    Los modelos que no están en memoria ni en disco se entrenan juntos con
+    ajustar_modelos(), de modo que la latencia es la del más lento y no la suma.
+
+    Args:
+        peticiones: Lista de tuplas (usuario_id, categoria, tipo, X, y, crear_modelo)
+            - usuario_id: ID del usuario (None para datos enviados en el body)
+            - categoria: Categoría de gasto del modelo
+            - tipo: Identificador del estimador e hiperparámetros (parte de la clave)
+            - X, y: Datos de entrenamiento
+            - crear_modelo: Función sin argumentos que crea el estimador sin entrenar
+
+    Returns:
+        Lista de estimadores entrenados en el mismo orden que las peticiones
+    """
+    modelos = [None] * len(peticiones)
+    pendientes = []
+
+    for i, (usuario_id, categoria, tipo, X, y, crear_modelo) in enumerate(peticiones):
+        clave = (usuario_id or '-', str(categoria), tipo, _huella_datos(X, y))
+        modelo = _cache_obtener(_modelos_cache, clave)
+        if modelo is None:
+            modelo = _cargar_modelo_disco(clave)
+            if modelo is not None:
+                _cache_guardar(_modelos_cache, clave, modelo)
+        if modelo is None:
+            pendientes.append((i, clave, (crear_modelo, X, y)))
+        modelos[i] = modelo
+
+    if pendientes:
+        entrenados = ajustar_modelos([tarea for _, _, tarea in pendientes])
+        for (i, clave, _), modelo in zip(pendientes, entrenados):
+            _modelos_stats['entrenamientos'] += 1
+            _guardar_modelo_disco(clave, modelo)
+            _cache_guardar(_modelos_cache, clave, modelo)
+            modelos[i] = modelo
+
+    return modelos
+
+
+def obtener_modelo_entrenado(usuario_id, categoria, tipo, X, y, crear_modelo):
+    """
+    Devuelve un modelo ajustado a (X, y), reutilizándolo si ya existe.
+
+    Ver obtener_modelos_entrenados() para el detalle de los argumentos.
+
+    Returns:
+        Estimador entrenado
+    """
+    return obtener_modelos_entrenados([(usuario_id, categoria, tipo, X, y, crear_modelo)])[0]
+
+
+def estadisticas_modelos():
+    """Aciertos del registro de modelos y uso de la persistencia en disco."""
+    return {
+        **_cache_estadisticas(_modelos_cache),
+        'persistencia': bool(MODELOS_CACHE_DIR) and JOBLIB_AVAILABLE,
+        'workers': PREDICCION_WORKERS,
+        'modo_pool': PREDICCION_MODO_POOL,
+        **_modelos_stats
+    }
 
 
 # ============================================================
 # 1️⃣ PREDICCIÓN POR CATEGORÍA
 # ============================================================
 
-def predict_by_category(df, days=30):
+# Horizonte máximo aceptado en ?days= de /api/v2/predict-category
+PREDICCION_MAX_DIAS = int(os.getenv('PREDICCION_MAX_DIAS', 365))
+
+
+def _horizonte_prediccion(last_date, days):
+    """Fechas futuras y matriz de features [dia_semana, dia_mes] para todo el horizonte."""
+    fechas = pd.date_range(last_date + timedelta(days=1), periods=days, freq='D')
+    return fechas, np.column_stack([fechas.dayofweek, fechas.day])
+
+
+def _modelos_por_categoria(df, usuario_id=None):
+    """
+    Grupos (categoría, gastos) con al menos 3 gastos y su RandomForest.
+
+    Features temporales precalculadas en el frame; los modelos que falten se
+    entrenan a la vez en el pool y se devuelven en el orden de los grupos.
+    """
+    grupos = [
+        (category, cat_data)
+        for category, cat_data in df.groupby('categoria', observed=True, sort=False)
+        if len(cat_data) >= 3
+    ]
+    modelos = obtener_modelos_entrenados([
+        (usuario_id, category, 'rf-50-5',
+         cat_data[['dia_semana', 'dia_mes']].values, cat_data['monto'].values,
+         _crear_rf_categoria)
+        for category, cat_data in grupos
+    ])
+    return grupos, modelos
+
+
+def predict_by_category(df, days=30, usuario_id=None):
     """
     Predice gastos separados para cada categoría.
     
+    Todo el horizonte se predice con una sola llamada a model.predict y los
+    modelos se reutilizan desde el registro mientras los datos no cambien.
+    Las categorías sin modelo se entrenan en paralelo (PREDICCION_WORKERS).
+    
     Args:
         df: DataFrame con gastos
         days: Días a predecir (default: 30)
+        usuario_id: ID del usuario para el registro de modelos (opcional)
     
     Returns:
         Dict con predicciones por categoría
     """
-    predictions = {}
+    grupos, modelos = _modelos_por_categoria(df, usuario_id)
     
-    for category in df['categoria'].unique():
-        cat_data = df[df['categoria'] == category].copy()
-        
-        if len(cat_data) < 3:
-            continue
-        
-        # Features temporales
-        cat_data['day_of_week'] = cat_data['fecha'].dt.dayofweek
-        cat_data['day_of_month'] = cat_data['fecha'].dt.day
-        
-        X = cat_data[['day_of_week', 'day_of_month']].values
-        y = cat_data['monto'].values
-        
-        # Entrenar modelo
-        model = RandomForestRegressor(n_estimators=50, max_depth=5, random_state=42)
-        model.fit(X, y)
-        
-        # Predicciones
-        last_date = cat_data['fecha'].max()
-        preds = []
-        
-        for i in range(1, days + 1):
-            future_date = last_date + timedelta(days=i)
-            features = np.array([[future_date.weekday(), future_date.day]])
-            pred_value = max(0, model.predict(features)[0])
-            
-            preds.append({
-                'fecha': future_date.strftime('%Y-%m-%d'),
-                'monto': round(pred_value, 2)
-            })
+    predictions = {}
+    for (category, cat_data), model in zip(grupos, modelos):
+        # Predicciones de todo el horizonte en un solo lote
+        fechas, X_futuro = _horizonte_prediccion(cat_data['fecha'].max(), days)
+        montos = np.maximum(model.predict(X_futuro), 0).round(2)
+        total = round(float(montos.sum()), 2)
         
         predictions[category] = {
-            'predicciones': preds,
-            'total': round(sum(p['monto'] for p in preds), 2),
-            'promedio_diario': round(sum(p['monto'] for p in preds) / days, 2)
+            'predicciones': [
+                {'fecha': fecha, 'monto': monto}
+                for fecha, monto in zip(fechas.strftime('%Y-%m-%d'), montos.tolist())
+            ],
+            'total': total,
+            'promedio_diario': round(total / days, 2)
         }
     
     return predictions
@@ -442,19 +1149,22 @@ def predict_by_category(df, days=30):
 # 2️⃣ PREDICCIÓN MENSUAL (30 DÍAS)
 # ============================================================
 
-def predict_monthly(df, days=30):
+def predict_monthly(df, days=30, cubo=None):
     """
     Predice gastos para los próximos 30 días con intervalos de confianza.
     
     Args:
         df: DataFrame con gastos
         days: Días a predecir (default: 30)
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con predicciones diarias y resumen semanal
     """
-    # Agrupar por día
-    daily = df.groupby(df['fecha'].dt.date)['monto'].sum()
+    cubo = cubo or obtener_cubo_agregados(df)
+    
+    # Totales por día
+    daily = cubo['por_dia']['total']
     
     avg_daily = daily.mean()
     std_daily = daily.std()
@@ -509,80 +1219,385 @@ def predict_monthly(df, days=30):
 # 3️⃣ DETECCIÓN DE ANOMALÍAS
 # ============================================================
 
-def detect_anomalies(df, zscore_threshold=2.5):
+# Muestras por árbol del Isolation Forest: 'auto' (= min(256, n)), un entero
+# o una fracción del historial
+ANOMALIAS_MAX_SAMPLES = os.getenv('ANOMALIAS_MAX_SAMPLES', 'auto')
+if ANOMALIAS_MAX_SAMPLES != 'auto':
+    ANOMALIAS_MAX_SAMPLES = (float(ANOMALIAS_MAX_SAMPLES) if '.' in ANOMALIAS_MAX_SAMPLES
+                             else int(ANOMALIAS_MAX_SAMPLES))
+
+
+def _crear_isolation_forest():
+    """Detector de anomalías sin entrenar (el umbral se aplica aparte, ver detect_anomalies)."""
+    return IsolationForest(contamination='auto', max_samples=ANOMALIAS_MAX_SAMPLES, random_state=42)
+
+
+def detect_anomalies(df, zscore_threshold=2.5, usuario_id=None):
     """
     Detecta gastos anómalos usando múltiples métodos.
     
+    Cada gasto aparece como mucho una vez (identificado por su id): primero
+    los detectados por Z-Score y después los que solo marca Isolation Forest.
+    El Isolation Forest se toma del registro de modelos, así que solo se
+    reentrena cuando cambian los montos del usuario.
+    
     Args:
         df: DataFrame con gastos
         zscore_threshold: Umbral de desviación estándar
+        usuario_id: ID del usuario para el registro de modelos (opcional)
     
     Returns:
         Dict con anomalías detectadas
     """
-    anomalies = []
+    montos = df['monto'].to_numpy()
     
     # Método 1: Z-Score
     from scipy.stats import zscore
-    z_scores = np.abs(zscore(df['monto']))
-    z_anomalies = df[z_scores > zscore_threshold]
-    
-    for idx, row in z_anomalies.iterrows():
-        anomalies.append({
-            'fecha': row['fecha'].strftime('%Y-%m-%d'),
-            'monto': row['monto'],
-            'categoria': row['categoria'],
-            'metodo': 'Z-Score',
-            'razon': f"Desviación {z_scores[idx]:.2f}σ del promedio"
-        })
-    
-    # Método 2: Isolation Forest
-    iso = IsolationForest(contamination=0.1, random_state=42)
-    outliers = iso.fit_predict(df[['monto']].values) == -1
-    
-    for idx in df[outliers].index:
-        if idx not in z_anomalies.index:
-            row = df.loc[idx]
-            anomalies.append({
-                'fecha': row['fecha'].strftime('%Y-%m-%d'),
-                'monto': row['monto'],
-                'categoria': row['categoria'],
-                'metodo': 'Isolation Forest',
-                'razon': 'Patrón anómalo detectado'
-            })
-    
-    # Deduplicar
-    unique_anomalies = {
-        (a['fecha'], a['monto']): a 
-        for a in anomalies
-    }.values()
+    z_scores = np.abs(zscore(montos))
+    mask_z = z_scores > zscore_threshold
+    
+    # Método 2: Isolation Forest (equivalente a contamination=0.1). La
+    # puntuación solo depende del monto: se calcula una vez por monto distinto
+    # y el umbral es el percentil 10, sin puntuar dos veces como fit_predict
+    X = montos.reshape(-1, 1)
+    iso = obtener_modelo_entrenado(
+        usuario_id, '*', f'iso-100-{ANOMALIAS_MAX_SAMPLES}', X, None, _crear_isolation_forest
+    )
+    unicos, inversa = np.unique(montos, return_inverse=True)
+    puntuaciones = iso.score_samples(unicos.reshape(-1, 1))[inversa]
+    mask_iso = puntuaciones < np.percentile(puntuaciones, 10)
+    
+    # Posiciones sin duplicados: Z-Score primero, luego solo Isolation Forest
+    pos_z = np.flatnonzero(mask_z)
+    pos_iso = np.flatnonzero(mask_iso & ~mask_z)
+    posiciones = np.concatenate([pos_z, pos_iso])
+    
+    seleccion = df.iloc[posiciones]
+    razones = [f"Desviación {z:.2f}σ del promedio" for z in z_scores[pos_z]]
+    razones += ['Patrón anómalo detectado'] * len(pos_iso)
+    metodos = ['Z-Score'] * len(pos_z) + ['Isolation Forest'] * len(pos_iso)
+    
+    anomalies = [
+        {
+            'id': gasto_id,
+            'fecha': fecha,
+            'monto': monto,
+            'categoria': categoria,
+            'metodo': metodo,
+            'razon': razon
+        }
+        for gasto_id, fecha, monto, categoria, metodo, razon in zip(
+            seleccion['id'].tolist(),
+            seleccion['fecha'].dt.strftime('%Y-%m-%d').tolist(),
+            seleccion['monto'].tolist(),
+            seleccion['categoria'].astype(str).tolist(),
+            metodos,
+            razones
+        )
+    ]
     
     return {
-        'cantidad': len(unique_anomalies),
-        'anomalias': list(unique_anomalies),
-        'porcentaje': round((len(unique_anomalies) / len(df)) * 100, 2)
+        'cantidad': len(anomalies),
+        'anomalias': anomalies,
+        'porcentaje': round((len(anomalies) / len(df)) * 100, 2)
     }
 
 
 # ============================================================
-# 4️⃣ MÚLTIPLES MODELOS ML
+# 🚨 DETECCIÓN DE ANOMALÍAS EN LÍNEA (AL CREAR GASTOS)
 # ============================================================
+# Por usuario y categoría se mantienen media/varianza (Welford) y una
+# mediana/MAD aproximadas de forma incremental. Cada gasto nuevo se puntúa en
+# O(1) contra ese estado, sin reentrenar IsolationForest sobre el historial.
+# El estado se construye desde el frame del usuario en segundo plano (nunca
+# en el POST del gasto) y caduca con la misma frecuencia que la
+# resincronización completa de gastos.
+
+ANOMALIA_ZSCORE = float(os.getenv('ANOMALIA_ZSCORE', 2.5))
+# Umbral del z-score modificado (0.6745 · |x - mediana| / MAD)
+ANOMALIA_UMBRAL_ROBUSTO = float(os.getenv('ANOMALIA_UMBRAL_ROBUSTO', 3.5))
+# Gastos previos de la categoría necesarios para emitir un veredicto
+ANOMALIA_MIN_GASTOS = int(os.getenv('ANOMALIA_MIN_GASTOS', 5))
+# Tamaño del paso de la aproximación de mediana/MAD (fracción de la MAD)
+ANOMALIA_TASA_ROBUSTA = 0.05
+
+_detectores_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, GASTOS_RESYNC_COMPLETA_SEGUNDOS)
+_detectores_lock = threading.Lock()
+_detectores_construyendo = set()
+_pool_detectores = None
+
+
+def _detector_desde_frame(df):
+    """Estado inicial por categoría calculado en bloque a partir del historial."""
+    montos = df['monto']
+    grupos = montos.groupby(df['categoria'], observed=True)
+    resumen = pd.DataFrame({
+        'n': grupos.size(),
+        'media': grupos.mean(),
+        'varianza': grupos.var(ddof=0),
+        'mediana': grupos.median()
+    })
+    desviacion = (montos - resumen['mediana'].reindex(df['categoria']).to_numpy()).abs()
+    resumen['mad'] = desviacion.groupby(df['categoria'], observed=True).median()
 
-def compare_models(df):
+    return {
+        str(categoria): {
+            'n': int(fila['n']),
+            'media': float(fila['media']),
+            'm2': float(fila['varianza'] * fila['n']),
+            'mediana': float(fila['mediana']),
+            'mad': float(fila['mad'])
+        }
+        for categoria, fila in resumen.to_dict('index').items()
+    }
+
+
+def obtener_detector_anomalias(usuario_id):
+    """Devuelve el estado del detector del usuario (o None si no se pudo cargar)."""
+    detector = _cache_obtener(_detectores_cache, usuario_id)
+    if detector is not None:
+        return detector
+    df, error = obtener_frame_gastos(usuario_id)
+    if error:
+        return None
+    detector = _detector_desde_frame(df) if not df.empty else {}
+    _cache_guardar(_detectores_cache, usuario_id, detector)
+    return detector
+
+
+def _construir_detector(usuario_id):
+    try:
+        obtener_detector_anomalias(usuario_id)
+    except Exception as e:
+        print(f"⚠️ Error construyendo el detector de anomalías de {usuario_id}: {e}")
+    finally:
+        with _detectores_lock:
+            _detectores_construyendo.discard(usuario_id)
+
+
+def programar_construccion_detector(usuario_id):
+    """Construye el detector del usuario en segundo plano (como mucho una construcción en vuelo)."""
+    global _pool_detectores
+    with _detectores_lock:
+        if usuario_id in _detectores_construyendo:
+            return
+        _detectores_construyendo.add(usuario_id)
+        if _pool_detectores is None:
+            _pool_detectores = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detectores')
+    _pool_detectores.submit(_construir_detector, usuario_id)
+
+
+def evaluar_gasto(detector, categoria, monto):
     """
-    Entrena y compara múltiples modelos ML.
-    
+    Puntúa un gasto contra el historial de su categoría (no modifica el estado).
+
     Args:
-        df: DataFrame con gastos
-    
+        detector: Estado devuelto por obtener_detector_anomalias
+        categoria: Categoría del gasto
+        monto: Importe del gasto
+
     Returns:
-        Dict con resultados de comparación y mejor modelo
+        Dict con el veredicto, las puntuaciones y los umbrales usados
     """
-    results = {}
-    
-    X = np.arange(len(df)).reshape(-1, 1)
-    y = df['monto'].values
-    split = int(len(df) * 0.8)
+    estado = detector.get(str(categoria))
+    n = estado['n'] if estado else 0
+    veredicto = {
+        'es_anomalo': False,
+        'zscore': None,
+        'zscore_robusto': None,
+        'umbrales': {'zscore': ANOMALIA_ZSCORE, 'zscore_robusto': ANOMALIA_UMBRAL_ROBUSTO},
+        'gastos_previos_categoria': n,
+        'razon': None
+    }
+    if n < ANOMALIA_MIN_GASTOS:
+        veredicto['razon'] = f'Historial insuficiente en la categoría (mínimo {ANOMALIA_MIN_GASTOS} gastos)'
+        return veredicto
+
+    razones = []
+    desviacion = (estado['m2'] / n) ** 0.5
+    if desviacion > 0:
+        z = (monto - estado['media']) / desviacion
+        veredicto['zscore'] = round(z, 2)
+        if abs(z) > ANOMALIA_ZSCORE:
+            razones.append(f"Desviación {abs(z):.2f}σ del promedio de la categoría")
+    if estado['mad'] > 0:
+        z_robusto = 0.6745 * (monto - estado['mediana']) / estado['mad']
+        veredicto['zscore_robusto'] = round(z_robusto, 2)
+        if abs(z_robusto) > ANOMALIA_UMBRAL_ROBUSTO:
+            razones.append(f"Lejos de la mediana de la categoría ({estado['mediana']:.2f})")
+
+    veredicto['es_anomalo'] = bool(razones)
+    veredicto['razon'] = '; '.join(razones) if razones else 'Dentro del rango habitual de la categoría'
+    veredicto['media_categoria'] = round(estado['media'], 2)
+    veredicto['mediana_categoria'] = round(estado['mediana'], 2)
+    return veredicto
+
+
+def registrar_gasto_detector(detector, categoria, monto):
+    """Incorpora un gasto al estado de su categoría en O(1)."""
+    with _detectores_lock:
+        estado = detector.setdefault(str(categoria), {
+            'n': 0, 'media': 0.0, 'm2': 0.0, 'mediana': float(monto), 'mad': 0.0
+        })
+        # Welford
+        estado['n'] += 1
+        delta = monto - estado['media']
+        estado['media'] += delta / estado['n']
+        estado['m2'] += delta * (monto - estado['media'])
+
+        # Aproximación estocástica de mediana y MAD: pasos proporcionales a la escala
+        escala = max(estado['mad'], abs(estado['mediana']) * 0.01, 0.01)
+        paso = ANOMALIA_TASA_ROBUSTA * escala
+        estado['mediana'] += paso * np.sign(monto - estado['mediana'])
+        estado['mad'] = max(0.0, estado['mad'] + paso * np.sign(abs(monto - estado['mediana']) - estado['mad']))
+
+
+# ============================================================
+# 📐 SKETCHES DE CUANTILES (KLL) POR USUARIO Y CATEGORÍA
+# ============================================================
+# Sketch KLL: niveles de muestras donde cada elemento del nivel h representa
+# 2^h gastos. Se actualiza en O(1) amortizado, se puede fusionar (por
+# ejemplo todas las categorías de un usuario) y responde cuantiles con un
+# error de rango de ~1.7/k. Para historiales grandes los límites IQR se
+# obtienen del sketch en lugar de ordenar toda la columna de montos.
+
+CUANTILES_K = int(os.getenv('CUANTILES_K', 200))
+# A partir de cuántos gastos se usan los sketches (por debajo, cuantiles exactos)
+CUANTILES_SKETCH_MIN_GASTOS = int(os.getenv('CUANTILES_SKETCH_MIN_GASTOS', 10000))
+
+_sketches_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, GASTOS_RESYNC_COMPLETA_SEGUNDOS)
+_sketches_lock = threading.Lock()
+
+
+def crear_sketch_cuantiles(k=None):
+    """Sketch KLL vacío (dict serializable)."""
+    return {'k': k or CUANTILES_K, 'n': 0, 'niveles': [[]], 'paridad': 0}
+
+
+def _capacidad_nivel(sketch, nivel):
+    # Los niveles altos (más pesados) guardan k elementos y cada nivel inferior 2/3 de ese tamaño
+    altura = len(sketch['niveles'])
+    return max(2, int(np.ceil(sketch['k'] * (2 / 3) ** (altura - 1 - nivel))))
+
+
+def _compactar_sketch(sketch):
+    """Compacta los niveles que superan su capacidad hasta que todos caben."""
+    niveles = sketch['niveles']
+    while True:
+        llenos = [h for h, items in enumerate(niveles) if len(items) > _capacidad_nivel(sketch, h)]
+        if not llenos:
+            return
+        h = llenos[0]
+        if h + 1 == len(niveles):
+            niveles.append([])
+        items = np.sort(np.asarray(niveles[h], dtype=float))
+        # Con un número impar de elementos uno se queda en el nivel
+        resto, items = (items[:1], items[1:]) if len(items) % 2 else (items[:0], items)
+        # Se promociona uno de cada dos, alternando pares/impares para no sesgar
+        niveles[h] = resto.tolist()
+        niveles[h + 1].extend(items[sketch['paridad']::2].tolist())
+        sketch['paridad'] ^= 1
+
+
+def sketch_agregar(sketch, valores):
+    """Añade uno o varios valores al sketch."""
+    valores = np.atleast_1d(np.asarray(valores, dtype=float))
+    sketch['niveles'][0].extend(valores.tolist())
+    sketch['n'] += len(valores)
+    _compactar_sketch(sketch)
+    return sketch
+
+
+def fusionar_sketches(*sketches):
+    """Devuelve un sketch nuevo equivalente a haber añadido los datos de todos."""
+    fusion = crear_sketch_cuantiles(max((s['k'] for s in sketches), default=CUANTILES_K))
+    altura = max((len(s['niveles']) for s in sketches), default=1)
+    fusion['niveles'] = [
+        [v for s in sketches if h < len(s['niveles']) for v in s['niveles'][h]]
+        for h in range(altura)
+    ]
+    fusion['n'] = sum(s['n'] for s in sketches)
+    _compactar_sketch(fusion)
+    return fusion
+
+
+def sketch_cuantiles(sketch, probabilidades):
+    """Cuantiles aproximados (lista de floats) para las probabilidades dadas."""
+    valores = np.concatenate([np.asarray(items, dtype=float) for items in sketch['niveles']])
+    if not len(valores):
+        return [float('nan')] * len(probabilidades)
+    pesos = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(sketch['niveles'])])
+    orden = np.argsort(valores, kind='stable')
+    acumulado = np.cumsum(pesos[orden])
+    posiciones = np.searchsorted(acumulado, np.asarray(probabilidades) * acumulado[-1], side='left')
+    return valores[orden][np.minimum(posiciones, len(valores) - 1)].tolist()
+
+
+def _sketches_desde_frame(df):
+    """Un sketch por categoría a partir del historial del usuario."""
+    return {
+        str(categoria): sketch_agregar(crear_sketch_cuantiles(), montos.to_numpy())
+        for categoria, montos in df.groupby('categoria', observed=True)['monto']
+    }
+
+
+def obtener_sketches_usuario(usuario_id):
+    """Sketches por categoría del usuario (o None si no se pudieron cargar los gastos)."""
+    sketches = _cache_obtener(_sketches_cache, usuario_id)
+    if sketches is not None:
+        return sketches
+    df, error = obtener_frame_gastos(usuario_id)
+    if error:
+        return None
+    sketches = _sketches_desde_frame(df)
+    _cache_guardar(_sketches_cache, usuario_id, sketches)
+    return sketches
+
+
+def registrar_gasto_sketch(sketches, categoria, monto):
+    """Incorpora un gasto nuevo al sketch de su categoría."""
+    with _sketches_lock:
+        sketch_agregar(sketches.setdefault(str(categoria), crear_sketch_cuantiles()), monto)
+
+
+def cuantiles_gastos(df, probabilidades, usuario_id=None):
+    """
+    Cuantiles de 'monto' del frame.
+
+    Con usuario_id y un historial de al menos CUANTILES_SKETCH_MIN_GASTOS gastos
+    se responden con la fusión de los sketches por categoría del usuario,
+    siempre que cubran exactamente los mismos gastos que el frame; en otro
+    caso se calculan de forma exacta.
+
+    Returns:
+        Lista de floats en el orden de las probabilidades
+    """
+    if usuario_id and len(df) >= CUANTILES_SKETCH_MIN_GASTOS:
+        sketches = obtener_sketches_usuario(usuario_id)
+        if sketches and sum(s['n'] for s in sketches.values()) == len(df):
+            return sketch_cuantiles(fusionar_sketches(*sketches.values()), probabilidades)
+    return [float(df['monto'].quantile(p)) for p in probabilidades]
+
+
+# ============================================================
+# 4️⃣ MÚLTIPLES MODELOS ML
+# ============================================================
+
+def compare_models(df):
+    """
+    Entrena y compara múltiples modelos ML.
+    
+    Args:
+        df: DataFrame con gastos
+    
+    Returns:
+        Dict con resultados de comparación y mejor modelo
+    """
+    results = {}
+    
+    X = np.arange(len(df)).reshape(-1, 1)
+    y = df['monto'].values
+    split = int(len(df) * 0.8)
     
     X_train, X_test = X[:split], X[split:]
     y_train, y_test = y[:split], y[split:]
@@ -643,40 +1658,43 @@ def compare_models(df):
 # 5️⃣ ANÁLISIS DE ESTACIONALIDAD
 # ============================================================
 
-def analyze_seasonality(df):
+def analyze_seasonality(df, cubo=None):
     """
     Detecta patrones semanales y mensuales.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con patrones identificados
     """
     patterns = {}
+    cubo = cubo or obtener_cubo_agregados(df)
     
-    # Por día de semana
-    df['dia_semana'] = df['fecha'].dt.day_name()
-    df['num_dia'] = df['fecha'].dt.weekday
+    # Por día de semana (índice 0=lunes ... 6=domingo)
+    por_dia_semana = cubo['por_dia_semana']
     
     weekly = []
     dias = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     
     for i, day in enumerate(dias):
-        day_data = df[df['num_dia'] == i]
-        if len(day_data) > 0:
+        if i in por_dia_semana.index:
+            fila = por_dia_semana.loc[i]
             weekly.append({
                 'dia': day,
-                'promedio': round(day_data['monto'].mean(), 2),
-                'total': round(day_data['monto'].sum(), 2)
+                'promedio': round(fila['promedio'], 2),
+                'total': round(fila['total'], 2)
             })
     
     patterns['semanal'] = weekly
     
     # Fin de semana vs entre semana
-    is_weekend = df['num_dia'].isin([5, 6])
-    weekend_avg = df[is_weekend]['monto'].mean()
-    weekday_avg = df[~is_weekend]['monto'].mean()
+    is_weekend = por_dia_semana.index >= 5
+    fin_semana = por_dia_semana[is_weekend]
+    entre_semana = por_dia_semana[~is_weekend]
+    weekend_avg = fin_semana['total'].sum() / fin_semana['n'].sum() if fin_semana['n'].sum() else np.nan
+    weekday_avg = entre_semana['total'].sum() / entre_semana['n'].sum() if entre_semana['n'].sum() else np.nan
     
     patterns['fin_semana_vs_semana'] = {
         'fin_semana': round(weekend_avg, 2),
@@ -696,73 +1714,111 @@ def analyze_seasonality(df):
 # 6️⃣ ANÁLISIS DE CORRELACIONES
 # ============================================================
 
-def analyze_correlations(df):
+def analyze_correlations(df, cubo=None, p_valores=False, top_k=None):
     """
     Encuentra relaciones entre categorías de gastos.
     
+    Todas las correlaciones salen de una sola llamada sobre la matriz
+    día × categoría del cubo: cada par usa solo los días en los que ambas
+    categorías tuvieron gastos (mínimo 3).
+    
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
+        p_valores: Incluir p-valores (prueba t de Pearson) de cada par
+        top_k: Incluir la lista de los k pares con mayor |correlación| (opcional)
     
     Returns:
         Dict con correlaciones y patrones
     """
-    correlations = {}
-    categories = df['categoria'].unique()
-    
-    # Agrupar por categoría y fecha
-    df['fecha_dia'] = df['fecha'].dt.date
-    
-    for cat in categories:
-        correlations[cat] = {}
-    
-    # Calcular correlaciones entre categorías
-    for i, cat1 in enumerate(categories):
-        for cat2 in categories[i+1:]:
-            cat1_data = df[df['categoria'] == cat1].groupby('fecha_dia')['monto'].sum()
-            cat2_data = df[df['categoria'] == cat2].groupby('fecha_dia')['monto'].sum()
-            
-            # Alinear índices
-            common_dates = cat1_data.index.intersection(cat2_data.index)
-            
-            if len(common_dates) > 2:
-                corr, _ = pearsonr(
-                    cat1_data[common_dates].values,
-                    cat2_data[common_dates].values
-                )
-                correlations[cat1][cat2] = round(corr, 3)
-                correlations[cat2][cat1] = round(corr, 3)
-    
-    # Encontrar categorías más correlacionadas
-    max_corr = {'cat1': '', 'cat2': '', 'valor': -1}
-    for cat, corrs in correlations.items():
-        for other_cat, corr_value in corrs.items():
-            if corr_value > max_corr['valor']:
-                max_corr = {'cat1': cat, 'cat2': other_cat, 'valor': corr_value}
+    cubo = cubo or obtener_cubo_agregados(df)
+    matriz = cubo['matriz_dia_categoria']
+    categories = matriz.columns.tolist()
+    
+    corr = matriz.corr(min_periods=3).to_numpy(copy=True)
+    np.fill_diagonal(corr, np.nan)
+    
+    # Pares con correlación definida (triángulo superior, en orden de categorías)
+    filas, columnas = np.nonzero(np.triu(~np.isnan(corr), k=1))
+    valores = corr[filas, columnas].round(3)
+    
+    correlations = {cat: {} for cat in categories}
+    for i, j, valor in zip(filas.tolist(), columnas.tolist(), valores.tolist()):
+        correlations[categories[i]][categories[j]] = valor
+        correlations[categories[j]][categories[i]] = valor
+    
+    # Categorías más correlacionadas
+    max_corr = None
+    if len(valores):
+        mejor = int(np.argmax(valores))
+        max_corr = {
+            'cat1': categories[filas[mejor]],
+            'cat2': categories[columnas[mejor]],
+            'valor': valores[mejor].item()
+        }
     
-    return {
+    result = {
         'correlaciones': correlations,
-        'mas_correlacionadas': max_corr if max_corr['valor'] > -1 else None,
+        'mas_correlacionadas': max_corr,
         'interpretacion': 'Valores cerca de 1 indican gasto simultáneo'
     }
+    
+    if p_valores or top_k:
+        # Días en común de cada par y p-valor bilateral con n - 2 grados de libertad
+        presentes = matriz.notna().to_numpy(dtype=float)
+        dias = (presentes.T @ presentes)[filas, columnas]
+        r = np.clip(corr[filas, columnas], -1.0, 1.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estadistico_t = r * np.sqrt((dias - 2) / (1.0 - r ** 2))
+        p = np.where(np.abs(r) >= 1.0, 0.0, 2 * distribucion_t.sf(np.abs(estadistico_t), dias - 2)).round(4)
+    
+    if p_valores:
+        p_vals = {cat: {} for cat in categories}
+        for i, j, valor in zip(filas.tolist(), columnas.tolist(), p.tolist()):
+            p_vals[categories[i]][categories[j]] = valor
+            p_vals[categories[j]][categories[i]] = valor
+        result['p_valores'] = p_vals
+    
+    if top_k:
+        orden = np.argsort(-np.abs(valores), kind='stable')[:top_k]
+        result['top'] = [
+            {
+                'cat1': categories[filas[k]],
+                'cat2': categories[columnas[k]],
+                'valor': valores[k].item(),
+                'p_valor': p[k].item(),
+                'dias_comunes': int(dias[k])
+            }
+            for k in orden
+        ]
+    
+    return result
+
+
+def _leer_opciones_correlacion():
+    """Lee ?p_valores=true y ?top=k de la petición. Devuelve (p_valores, top_k)."""
+    p_valores = request.args.get('p_valores') == 'true'
+    top_k = request.args.get('top', type=int)
+    return p_valores, (top_k if top_k and top_k > 0 else None)
 
 
 # ============================================================
 # 7️⃣ ANÁLISIS TEMPORAL - MES ACTUAL VS ANTERIOR
 # ============================================================
 
-def analyze_temporal_comparison(df):
+def analyze_temporal_comparison(df, cubo=None):
     """
     Compara gastos del mes actual vs mes anterior.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con comparación temporal
     """
-    df['año_mes'] = df['fecha'].dt.to_period('M')
-    
-    monthly_totals = df.groupby('año_mes')['monto'].agg(['sum', 'count', 'mean']).reset_index()
+    cubo = cubo or obtener_cubo_agregados(df)
+    monthly_totals = cubo['por_mes'].reset_index()
     monthly_totals = monthly_totals.sort_values('año_mes', ascending=False)
     
     if len(monthly_totals) < 2:
@@ -772,12 +1828,13 @@ def analyze_temporal_comparison(df):
     previous_month = monthly_totals.iloc[1]
     
     # Calcular variaciones
-    change_amount = current_month['sum'] - previous_month['sum']
-    change_pct = (change_amount / previous_month['sum'] * 100) if previous_month['sum'] > 0 else 0
+    change_amount = current_month['total'] - previous_month['total']
+    change_pct = (change_amount / previous_month['total'] * 100) if previous_month['total'] > 0 else 0
     
     # Análisis por categoría
-    current_cat = df[df['año_mes'] == current_month['año_mes']].groupby('categoria')['monto'].sum()
-    previous_cat = df[df['año_mes'] == previous_month['año_mes']].groupby('categoria')['monto'].sum()
+    mes_categoria = cubo['por_mes_categoria']['total']
+    current_cat = mes_categoria.xs(current_month['año_mes'], level='año_mes')
+    previous_cat = mes_categoria.xs(previous_month['año_mes'], level='año_mes')
     
     cat_changes = {}
     for cat in current_cat.index:
@@ -794,13 +1851,13 @@ def analyze_temporal_comparison(df):
     return {
         'mes_actual': str(current_month['año_mes']),
         'mes_anterior': str(previous_month['año_mes']),
-        'total_actual': round(current_month['sum'], 2),
-        'total_anterior': round(previous_month['sum'], 2),
+        'total_actual': round(current_month['total'], 2),
+        'total_anterior': round(previous_month['total'], 2),
         'cambio_absoluto': round(change_amount, 2),
         'cambio_porcentual': round(change_pct, 2),
         'tendencia': 'AUMENTO' if change_pct > 0 else 'DISMINUCIÓN',
-        'transacciones_actual': int(current_month['count']),
-        'transacciones_anterior': int(previous_month['count']),
+        'transacciones_actual': int(current_month['n']),
+        'transacciones_anterior': int(previous_month['n']),
         'por_categoria': cat_changes
     }
 
@@ -809,106 +1866,353 @@ def analyze_temporal_comparison(df):
 # 8️⃣ CLUSTERING - AGRUPAR GASTOS SIMILARES
 # ============================================================
 
-def perform_clustering(df, n_clusters=3):
+# Algoritmos de perform_clustering (?algorithm=): KMeans completo, MiniBatchKMeans
+# o partición óptima exacta en 1-D (programación dinámica tipo ckmeans)
+ALGORITMOS_CLUSTERING = ('full', 'minibatch', 'exact')
+# Máximo de grupos que se prueban con n_clusters=auto
+CLUSTERING_K_MAX = int(os.getenv('CLUSTERING_K_MAX', 8))
+
+
+def _fila_dp_1d(anterior, coste, k, n):
+    """
+    Una fila de la programación dinámica de k-medias en 1-D.
+
+    fila[i] = min_j anterior[j-1] + coste(j, i) con j = inicio del último grupo.
+    El j óptimo es monótono en i, así que se resuelve con divide y vencerás;
+    todos los segmentos de un mismo nivel se evalúan juntos con numpy.
+    """
+    fila = np.full(n, np.inf)
+    inicio = np.zeros(n, dtype=np.int64)
+    # Segmentos pendientes: rango de i [lo_i, hi_i] y rango de j admisible [lo_j, hi_j]
+    lo_i = np.array([k]); hi_i = np.array([n - 1])
+    lo_j = np.array([k]); hi_j = np.array([n - 1])
+    while len(lo_i):
+        medio = (lo_i + hi_i) // 2
+        tope = np.minimum(hi_j, medio)
+        cuenta = tope - lo_j + 1
+        desplaz = np.concatenate([[0], np.cumsum(cuenta)[:-1]])
+        segmento = np.repeat(np.arange(len(lo_i)), cuenta)
+        j = lo_j[segmento] + np.arange(cuenta.sum()) - desplaz[segmento]
+        i = medio[segmento]
+        valores = anterior[j - 1] + coste(j, i)
+
+        minimos = np.minimum.reduceat(valores, desplaz)
+        empates = np.flatnonzero(valores == minimos[segmento])
+        _, primero = np.unique(segmento[empates], return_index=True)
+        mejor_j = j[empates[primero]]
+
+        fila[medio] = minimos
+        inicio[medio] = mejor_j
+
+        izquierda = lo_i <= medio - 1
+        derecha = medio + 1 <= hi_i
+        lo_i, hi_i, lo_j, hi_j = (
+            np.concatenate([lo_i[izquierda], (medio + 1)[derecha]]),
+            np.concatenate([(medio - 1)[izquierda], hi_i[derecha]]),
+            np.concatenate([lo_j[izquierda], mejor_j[derecha]]),
+            np.concatenate([mejor_j[izquierda], hi_j[derecha]])
+        )
+    return fila, inicio
+
+
+def kmedias_1d_exacto(valores, k_max):
+    """
+    Particiones de mínima suma de cuadrados de valores 1-D en 1..k_max grupos.
+
+    Trabaja sobre los valores distintos ponderados por su frecuencia, así que
+    el resultado es determinista y no depende de inicializaciones.
+
+    Args:
+        valores: Array de valores
+        k_max: Número máximo de grupos
+
+    Returns:
+        Función k -> etiquetas (0..k-1 ordenadas por valor) y array de SSE por k (índice k-1)
     """
-    Agrupa gastos similares automáticamente usando KMeans.
+    unicos, inversa, pesos = np.unique(valores, return_inverse=True, return_counts=True)
+    n = len(unicos)
+    k_max = max(1, min(k_max, n))
+    s0 = np.concatenate([[0.0], np.cumsum(pesos)])
+    s1 = np.concatenate([[0.0], np.cumsum(pesos * unicos)])
+    s2 = np.concatenate([[0.0], np.cumsum(pesos * unicos ** 2)])
+
+    def coste(j, i):
+        suma = s1[i + 1] - s1[j]
+        return np.maximum(s2[i + 1] - s2[j] - suma * suma / (s0[i + 1] - s0[j]), 0.0)
+
+    filas = [coste(np.zeros(n, dtype=np.int64), np.arange(n))]
+    inicios = [np.zeros(n, dtype=np.int64)]
+    for k in range(1, k_max):
+        fila, inicio = _fila_dp_1d(filas[-1], coste, k, n)
+        filas.append(fila)
+        inicios.append(inicio)
+
+    def etiquetas(k):
+        k = min(k, k_max)
+        grupo_unico = np.empty(n, dtype=np.int64)
+        fin = n - 1
+        for grupo in range(k - 1, -1, -1):
+            j = inicios[grupo][fin]
+            grupo_unico[j:fin + 1] = grupo
+            fin = j - 1
+        return grupo_unico[inversa]
+
+    return etiquetas, np.array([fila[-1] for fila in filas])
+
+
+def silhouette_1d(valores, etiquetas):
+    """
+    Coeficiente de silhouette exacto para datos 1-D en O(n·k·log n).
+
+    La distancia media de cada punto a un grupo sale de sumas prefijas sobre
+    los valores ordenados del grupo, sin construir la matriz de distancias.
+    """
+    a = np.zeros(len(valores))
+    b = np.full(len(valores), np.inf)
+    tamaños = np.zeros(len(valores))
+    for grupo in np.unique(etiquetas):
+        propio = etiquetas == grupo
+        miembros = np.sort(valores[propio])
+        cuenta = len(miembros)
+        prefijo = np.concatenate([[0.0], np.cumsum(miembros)])
+        pos = np.searchsorted(miembros, valores, side='right')
+        distancia = (valores * pos - prefijo[pos]) + (prefijo[-1] - prefijo[pos] - valores * (cuenta - pos))
+        a[propio] = distancia[propio] / max(cuenta - 1, 1)
+        tamaños[propio] = cuenta
+        b[~propio] = np.minimum(b[~propio], distancia[~propio] / cuenta)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(tamaños > 1, (b - a) / np.maximum(a, b), 0.0)
+    return float(np.nan_to_num(s).mean())
+
+
+def _etiquetas_clustering(valores, n_clusters, algorithm, exacto=None):
+    """Etiquetas de grupo para los montos según el algoritmo elegido."""
+    if algorithm == 'exact':
+        return exacto(n_clusters)
+    X_scaled = StandardScaler().fit_transform(valores.reshape(-1, 1))
+    if algorithm == 'minibatch':
+        modelo = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, n_init=3, batch_size=1024)
+    else:
+        modelo = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+    return modelo.fit_predict(X_scaled)
+
+
+def perform_clustering(df, n_clusters=3, algorithm='full'):
+    """
+    Agrupa gastos similares automáticamente por monto.
     
     Args:
         df: DataFrame con gastos
-        n_clusters: Número de grupos (default: 3)
+        n_clusters: Número de grupos (default: 3) o 'auto' para elegirlo por silhouette
+        algorithm: 'full' (KMeans), 'minibatch' (MiniBatchKMeans) o 'exact' (óptimo 1-D)
     
     Returns:
         Dict con clusters identificados
     """
-    if len(df) < n_clusters:
+    valores = df['monto'].to_numpy(dtype=float)
+    n_unicos = len(np.unique(valores))
+    exacto = None
+    
+    seleccion_k = None
+    if n_clusters == 'auto':
+        candidatos = list(range(2, max(2, min(CLUSTERING_K_MAX, n_unicos - 1)) + 1))
+        if algorithm == 'exact':
+            # Una sola programación dinámica sirve para todos los k
+            exacto, _ = kmedias_1d_exacto(valores, candidatos[-1])
+        puntuaciones = {
+            k: silhouette_1d(valores, _etiquetas_clustering(valores, k, algorithm, exacto))
+            for k in candidatos
+        }
+        n_clusters = max(puntuaciones, key=puntuaciones.get)
+        seleccion_k = {
+            'criterio': 'silhouette',
+            'puntuaciones': {str(k): round(p, 4) for k, p in puntuaciones.items()}
+        }
+    elif len(df) < n_clusters:
         n_clusters = max(2, len(df) // 2)
     
-    # Preparar features
-    X = df[['monto']].values
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-    
-    # Entrenar KMeans
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-    df['cluster'] = kmeans.fit_predict(X_scaled)
-    
-    # Analizar clusters
-    clusters_info = []
-    for cluster_id in range(n_clusters):
-        cluster_data = df[df['cluster'] == cluster_id]
-        
-        clusters_info.append({
-            'id': cluster_id,
-            'cantidad_gastos': len(cluster_data),
-            'monto_minimo': round(cluster_data['monto'].min(), 2),
-            'monto_maximo': round(cluster_data['monto'].max(), 2),
-            'monto_promedio': round(cluster_data['monto'].mean(), 2),
-            'total': round(cluster_data['monto'].sum(), 2),
-            'categorias': cluster_data['categoria'].unique().tolist(),
-            'descripcion': f"Gastos de ${cluster_data['monto'].min():.2f} a ${cluster_data['monto'].max():.2f}"
-        })
+    if algorithm == 'exact':
+        n_clusters = min(n_clusters, n_unicos)
+        if exacto is None:
+            exacto, _ = kmedias_1d_exacto(valores, n_clusters)
+    
+    etiquetas = _etiquetas_clustering(valores, n_clusters, algorithm, exacto)
+    
+    # Estadísticas de todos los grupos en una sola agrupación
+    grupos = df.groupby(etiquetas)
+    resumen = grupos['monto'].agg(['size', 'min', 'max', 'mean', 'sum'])
+    categorias = grupos['categoria'].unique()
+    
+    clusters_info = [
+        {
+            'id': int(cluster_id),
+            'cantidad_gastos': int(fila['size']),
+            'monto_minimo': round(fila['min'], 2),
+            'monto_maximo': round(fila['max'], 2),
+            'monto_promedio': round(fila['mean'], 2),
+            'total': round(fila['sum'], 2),
+            'categorias': list(categorias[cluster_id]),
+            'descripcion': f"Gastos de ${fila['min']:.2f} a ${fila['max']:.2f}"
+        }
+        for cluster_id, fila in resumen.to_dict('index').items()
+    ]
     
     clusters_info = sorted(clusters_info, key=lambda x: x['monto_promedio'])
     
-    return {
+    result = {
         'numero_clusters': n_clusters,
+        'algoritmo': algorithm,
         'clusters': clusters_info,
         'distribucion': [c['cantidad_gastos'] for c in clusters_info]
     }
+    if seleccion_k:
+        result['seleccion_k'] = seleccion_k
+    return result
+
+
+def _leer_opciones_clustering():
+    """Lee ?n_clusters= (entero o 'auto') y ?algorithm=. Devuelve (opciones, error)."""
+    algorithm = request.args.get('algorithm', 'full')
+    if algorithm not in ALGORITMOS_CLUSTERING:
+        return None, f"algorithm debe ser uno de: {', '.join(ALGORITMOS_CLUSTERING)}"
+    n_clusters = request.args.get('n_clusters', '3')
+    if n_clusters != 'auto':
+        try:
+            n_clusters = int(n_clusters)
+        except ValueError:
+            n_clusters = 0
+        if n_clusters < 1:
+            return None, "n_clusters debe ser un entero positivo o 'auto'"
+    return {'n_clusters': n_clusters, 'algorithm': algorithm}, None
 
 
 # ============================================================
 # 9️⃣ ANÁLISIS DE TENDENCIAS
 # ============================================================
 
-def detect_trends(df):
+# Resoluciones de detect_trends (plural para los mensajes de error)
+RESOLUCIONES_TENDENCIA = {'dia': 'días', 'semana': 'semanas', 'mes': 'meses'}
+
+
+def _serie_tendencia(cubo, resolucion):
+    """
+    Totales del cubo en la resolución pedida, con etiquetas legibles por periodo.
+
+    Los rollups del cubo solo tienen los periodos con gasto: aquí se completan
+    todos los periodos entre el primero y el último (con 0) para que los
+    cambios, el promedio móvil y las pendientes se calculen sobre periodos
+    consecutivos.
+    """
+    if resolucion == 'dia':
+        serie = cubo['por_dia']['total']
+        if len(serie):
+            serie = serie.reindex(pd.date_range(serie.index.min(), serie.index.max(), freq='D'), fill_value=0)
+        etiquetas = [d.date().isoformat() for d in serie.index]
+    elif resolucion == 'mes':
+        serie = cubo['por_mes']['total']
+        if len(serie):
+            serie = serie.reindex(pd.period_range(serie.index.min(), serie.index.max(), freq='M'), fill_value=0)
+        etiquetas = [str(p) for p in serie.index]
+    else:
+        serie = cubo['por_semana']
+        if len(serie):
+            # Lunes de cada semana ISO -> rango semanal completo
+            lunes = pd.DatetimeIndex([datetime.fromisocalendar(int(año), int(semana), 1) for año, semana in serie.index])
+            completo = pd.date_range(lunes.min(), lunes.max(), freq='7D')
+            serie = pd.Series(serie.to_numpy(), index=lunes).reindex(completo, fill_value=0)
+            iso = completo.isocalendar()
+            etiquetas = [f'{año}-W{semana:02d}' for año, semana in zip(iso['year'], iso['week'])]
+        else:
+            etiquetas = []
+    return serie.reset_index(drop=True).astype(float), etiquetas
+
+
+def pendiente_ols(y, confianza=0.95):
+    """
+    Pendiente de mínimos cuadrados de y frente a 0..n-1 en forma cerrada.
+
+    Returns:
+        Tupla (pendiente, inferior, superior); el intervalo es None con menos de 3 puntos
+    """
+    n = len(y)
+    x = np.arange(n, dtype=float)
+    xc = x - x.mean()
+    sxx = float(xc @ xc)
+    pendiente = float(xc @ (y - y.mean())) / sxx
+    if n < 3:
+        return pendiente, None, None
+    residuos = y - (y.mean() + pendiente * xc)
+    error = np.sqrt(float(residuos @ residuos) / (n - 2) / sxx)
+    margen = float(distribucion_t.ppf(0.5 + confianza / 2, n - 2) * error)
+    return pendiente, pendiente - margen, pendiente + margen
+
+
+def tendencia_robusta(y, confianza=0.95):
+    """Pendiente de Theil-Sen con su intervalo y prueba de Mann-Kendall sobre y."""
+    x = np.arange(len(y))
+    pendiente, _, inferior, superior = theilslopes(y, x, alpha=confianza)
+    tau, p_valor = kendalltau(x, y)
+    if np.isnan(p_valor) or p_valor >= 1 - confianza:
+        tendencia = 'SIN TENDENCIA'
+    else:
+        tendencia = 'AUMENTANDO' if tau > 0 else 'DISMINUYENDO'
+    return {
+        'theil_sen': {
+            'pendiente': round(float(pendiente), 2),
+            'inferior': round(float(inferior), 2),
+            'superior': round(float(superior), 2)
+        },
+        'mann_kendall': {
+            'tau': None if np.isnan(tau) else round(float(tau), 3),
+            'p_valor': None if np.isnan(p_valor) else round(float(p_valor), 4),
+            'tendencia': tendencia
+        }
+    }
+
+
+def detect_trends(df, cubo=None, resolucion='semana', ventana=3, robusto=False, confianza=0.95):
     """
     Detecta si los gastos están subiendo o bajando en el tiempo.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
+        resolucion: 'dia', 'semana' (default) o 'mes'
+        ventana: Periodos del promedio móvil (default: 3)
+        robusto: Añadir Theil-Sen y Mann-Kendall
+        confianza: Nivel del intervalo de confianza de la pendiente
     
     Returns:
-        Dict con tendencias identificadas
-    """
-    # Agrupar por semana
-    df['semana'] = df['fecha'].dt.isocalendar().week
-    df['año'] = df['fecha'].dt.isocalendar().year
-    
-    weekly_totals = df.groupby(['año', 'semana'])['monto'].sum().reset_index()
-    weekly_totals = weekly_totals.sort_values(['año', 'semana'])
-    
-    if len(weekly_totals) < 2:
-        return {'error': 'Se necesitan al menos 2 semanas de datos'}
-    
-    # Calcular tendencia con regresión simple
-    x = np.arange(len(weekly_totals)).reshape(-1, 1)
-    y = weekly_totals['monto'].values
-    
-    model = LinearRegression()
-    model.fit(x, y)
-    slope = model.coef_[0]
-    
-    # Variación semana a semana
-    week_changes = []
-    for i in range(1, len(weekly_totals)):
-        prev = weekly_totals.iloc[i-1]['monto']
-        curr = weekly_totals.iloc[i]['monto']
-        change_pct = ((curr - prev) / prev * 100) if prev > 0 else 0
-        week_changes.append({
-            'semana': i,
-            'gasto': round(curr, 2),
-            'cambio_pct': round(change_pct, 2)
-        })
+        Dict con tendencias identificadas. Las claves no dependen de los
+        parámetros (cambios, promedio_movil, ventana, gasto_promedio); con
+        resolucion='semana' se añaden además las claves históricas
+        cambios_semanales, gasto_promedio_semanal y, con ventana=3,
+        promedio_movil_3sem.
+    """
+    plural = RESOLUCIONES_TENDENCIA[resolucion]
     
-    # Promedio móvil (3 semanas)
-    moving_avg = []
-    for i in range(len(weekly_totals)):
-        if i < 2:
-            moving_avg.append(round(weekly_totals.iloc[i]['monto'], 2))
-        else:
-            avg = weekly_totals.iloc[i-2:i+1]['monto'].mean()
-            moving_avg.append(round(avg, 2))
+    # Totales por periodo (ya ordenados en el cubo)
+    cubo = cubo or obtener_cubo_agregados(df)
+    totales, etiquetas = _serie_tendencia(cubo, resolucion)
+    
+    if len(totales) < 2:
+        return {'error': f'Se necesitan al menos 2 {plural} de datos'}
+    
+    y = totales.to_numpy()
+    slope, inferior, superior = pendiente_ols(y, confianza)
+    
+    # Variación entre periodos consecutivos (0 si el anterior no tuvo gasto)
+    anterior = totales.shift(1)
+    cambios = np.where(anterior > 0, totales.pct_change() * 100, 0.0).round(2)
+    period_changes = [
+        {resolucion: i, 'periodo': etiqueta, 'gasto': gasto, 'cambio_pct': cambio}
+        for i, etiqueta, gasto, cambio in zip(
+            range(1, len(y)), etiquetas[1:], y[1:].round(2).tolist(), cambios[1:].tolist()
+        )
+    ]
+    
+    # Promedio móvil (los primeros periodos, sin ventana completa, quedan tal cual)
+    moving_avg = totales.rolling(ventana).mean().fillna(totales).round(2).tolist()
     
     # Clasificar tendencia
     if slope > 0:
@@ -921,26 +2225,58 @@ def detect_trends(df):
         tendencia_general = 'ESTABLE'
         consejo = 'Los gastos se mantienen relativamente estables.'
     
-    return {
+    result = {
         'tendencia_general': tendencia_general,
         'pendiente': round(slope, 2),
+        'intervalo_confianza': {
+            'nivel': confianza,
+            'inferior': None if inferior is None else round(inferior, 2),
+            'superior': None if superior is None else round(superior, 2)
+        },
+        'resolucion': resolucion,
         'consejo': consejo,
-        'cambios_semanales': week_changes,
-        'promedio_movil_3sem': moving_avg,
-        'gasto_promedio_semanal': round(y.mean(), 2)
+        'cambios': period_changes,
+        'ventana': ventana,
+        'promedio_movil': moving_avg,
+        'gasto_promedio': round(float(y.mean()), 2)
     }
+    if resolucion == 'semana':
+        # Claves de la versión solo semanal, para los clientes existentes
+        result['cambios_semanales'] = period_changes
+        result['gasto_promedio_semanal'] = result['gasto_promedio']
+        if ventana == 3:
+            result['promedio_movil_3sem'] = moving_avg
+    if robusto:
+        result['robusto'] = tendencia_robusta(y, confianza)
+    return result
+
+
+def _leer_opciones_tendencia():
+    """Lee ?resolucion=, ?ventana= y ?robusto=true. Devuelve (opciones, error)."""
+    resolucion = request.args.get('resolucion', 'semana')
+    if resolucion not in RESOLUCIONES_TENDENCIA:
+        return None, f"resolucion debe ser una de: {', '.join(RESOLUCIONES_TENDENCIA)}"
+    ventana = request.args.get('ventana', 3, type=int)
+    if ventana is None or ventana < 1:
+        return None, 'ventana debe ser un entero mayor o igual que 1'
+    return {
+        'resolucion': resolucion,
+        'ventana': ventana,
+        'robusto': request.args.get('robusto') == 'true'
+    }, None
 
 
 # ============================================================
 # 🔟 DETECCIÓN DE OUTLIERS (IQR + Z-Score)
 # ============================================================
 
-def detect_outliers_iqr(df):
+def detect_outliers_iqr(df, usuario_id=None):
     """
     Identifica gastos atípicos usando IQR y Z-Score.
     
     Args:
         df: DataFrame con gastos
+        usuario_id: ID del usuario para tomar Q1/Q3 de sus sketches (opcional)
     
     Returns:
         Dict con outliers y clasificación
@@ -951,8 +2287,7 @@ def detect_outliers_iqr(df):
     outlier_indices = set()
     
     # Método 1: IQR
-    Q1 = df['monto'].quantile(0.25)
-    Q3 = df['monto'].quantile(0.75)
+    Q1, Q3 = cuantiles_gastos(df, [0.25, 0.75], usuario_id)
     IQR = Q3 - Q1
     
     lower_bound = Q1 - 1.5 * IQR
@@ -1009,7 +2344,7 @@ def detect_outliers_iqr(df):
 # 1️⃣1️⃣ METAS DE AHORRO
 # ============================================================
 
-def calculate_savings_goals(df, goal_name, target_amount, months=12):
+def calculate_savings_goals(df, goal_name, target_amount, months=12, cubo=None):
     """
     Calcula cuánto ahorrar mensualmente para alcanzar metas específicas.
     
@@ -1018,11 +2353,13 @@ def calculate_savings_goals(df, goal_name, target_amount, months=12):
         goal_name: Nombre de la meta (ej: "Vacaciones", "Coche")
         target_amount: Monto a ahorrar
         months: Meses para alcanzar meta
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con desglose de meta y plan de ahorro
     """
-    monthly_spend = df.groupby(df['fecha'].dt.to_period('M'))['monto'].sum()
+    cubo = cubo or obtener_cubo_agregados(df)
+    monthly_spend = cubo['por_mes']['total']
     
     if len(monthly_spend) == 0:
         return {'error': 'Sin datos de gastos'}
@@ -1036,17 +2373,16 @@ def calculate_savings_goals(df, goal_name, target_amount, months=12):
     reduction_pct = (monthly_savings_needed / avg_monthly_spend) * 100
     
     # Identificar categorías donde se puede reducir
-    category_spend = df.groupby('categoria')['monto'].agg(['sum', 'count', 'mean'])
-    category_spend = category_spend.sort_values('sum', ascending=False)
+    category_spend = cubo['por_categoria'].sort_values('total', ascending=False)
     
     reductions = []
     for cat, row in category_spend.iterrows():
-        potential_reduction = row['sum'] * 0.1  # 10% de reducción
+        potential_reduction = row['total'] * 0.1  # 10% de reducción
         reductions.append({
             'categoria': cat,
-            'gasto_actual': round(row['sum'], 2),
+            'gasto_actual': round(row['total'], 2),
             'reduccion_10pct': round(potential_reduction, 2),
-            'promedio_gasto': round(row['mean'], 2)
+            'promedio_gasto': round(row['promedio'], 2)
         })
     
     return {
@@ -1065,21 +2401,24 @@ def calculate_savings_goals(df, goal_name, target_amount, months=12):
 # 1️⃣2️⃣ TIPS PERSONALIZADOS
 # ============================================================
 
-def generate_personalized_tips(df):
+def generate_personalized_tips(df, cubo=None, usuario_id=None):
     """
     Genera recomendaciones basadas en patrones de gasto individual.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
+        usuario_id: ID del usuario para tomar cuantiles de sus sketches (opcional)
     
     Returns:
         List de tips personalizados con prioridad
     """
     tips = []
-    total_spend = df['monto'].sum()
+    cubo = cubo or obtener_cubo_agregados(df)
+    total_spend = cubo['total']
     
     # Análisis por categoría
-    category_spend = df.groupby('categoria')['monto'].sum().sort_values(ascending=False)
+    category_spend = cubo['por_categoria']['total'].sort_values(ascending=False)
     
     # Tip 1: Categoría dominante
     if len(category_spend) > 0:
@@ -1096,7 +2435,8 @@ def generate_personalized_tips(df):
             })
     
     # Tip 2: Frecuencia de gastos pequeños
-    small_expenses = df[df['monto'] < df['monto'].quantile(0.25)]
+    q1, = cuantiles_gastos(df, [0.25], usuario_id)
+    small_expenses = df[df['monto'] < q1]
     if len(small_expenses) > 0:
         small_total = small_expenses['monto'].sum()
         small_pct = (small_total / total_spend) * 100
@@ -1111,9 +2451,9 @@ def generate_personalized_tips(df):
             })
     
     # Tip 3: Patrones de fin de semana
-    df['dia_semana'] = df['fecha'].dt.weekday
-    weekend_spend = df[df['dia_semana'].isin([5, 6])]['monto'].sum()
-    weekday_spend = df[~df['dia_semana'].isin([5, 6])]['monto'].sum()
+    por_dia_semana = cubo['por_dia_semana']['total']
+    weekend_spend = por_dia_semana[por_dia_semana.index >= 5].sum()
+    weekday_spend = por_dia_semana[por_dia_semana.index < 5].sum()
     
     if weekday_spend > 0:
         weekend_pct = (weekend_spend / (weekend_spend + weekday_spend)) * 100
@@ -1127,7 +2467,7 @@ def generate_personalized_tips(df):
             })
     
     # Tip 4: Tendencia alcista
-    monthly = df.groupby(df['fecha'].dt.to_period('M'))['monto'].sum()
+    monthly = cubo['por_mes']['total']
     if len(monthly) >= 3:
         recent_avg = monthly.tail(2).mean()
         earlier_avg = monthly.head(2).mean()
@@ -1157,31 +2497,229 @@ def generate_personalized_tips(df):
 # 1️⃣3️⃣ ALERTAS DE PRESUPUESTO
 # ============================================================
 
-def generate_budget_alerts(df, monthly_budget):
+# Acumulador del mes en curso: gasto por día natural del mes de la fecha más
+# reciente (con la duración real del mes) y gasto acumulado por día de la
+# semana de todo el historial. Se construye desde el cubo en O(días), se
+# guarda por usuario y cada gasto nuevo lo actualiza en O(1), de modo que las
+# alertas de presupuesto no necesitan volver a filtrar el historial. Si al
+# crear un gasto no está en caché, se construye en segundo plano (como el
+# detector de anomalías) y los umbrales se comprueban al terminar. El
+# presupuesto mensual se guarda junto a él para no leer budget/current en
+# cada gasto.
+
+METODOS_PROYECCION = ('lineal', 'dia_semana', 'modelo')
+PRESUPUESTO_PROYECCION = os.getenv('PRESUPUESTO_PROYECCION', 'lineal')
+
+_acumuladores_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, GASTOS_RESYNC_COMPLETA_SEGUNDOS)
+_acumuladores_lock = threading.Lock()
+_acumuladores_construyendo = set()
+_acumuladores_pendientes = set()
+_pool_acumuladores = None
+
+# budget/current normalizado por usuario ({} si no tiene presupuesto)
+_presupuestos_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, GASTOS_CACHE_TTL_SEGUNDOS)
+
+
+def _nuevo_mes_acumulador(acumulador, fecha):
+    """Reinicia el acumulador en el mes de 'fecha'."""
+    acumulador['año'] = fecha.year
+    acumulador['mes'] = fecha.month
+    acumulador['dias_mes'] = fecha.days_in_month
+    acumulador['por_dia'] = np.zeros(fecha.days_in_month)
+    acumulador['dia_referencia'] = fecha.day
+
+
+def acumulador_mes_desde_frame(df, cubo=None):
+    """Acumulador del mes de la fecha más reciente del frame (dict)."""
+    cubo = cubo or obtener_cubo_agregados(df)
+    por_dia = cubo['por_dia']['total']
+    fecha_ref = pd.Timestamp(df['fecha'].max())
+
+    acumulador = {
+        'n': len(df),
+        'primer_dia': por_dia.index.min(),
+        'suma_semana': cubo['por_dia_semana']['total'].reindex(range(7), fill_value=0).to_numpy(dtype=float, copy=True)
+    }
+    _nuevo_mes_acumulador(acumulador, fecha_ref)
+
+    del_mes = por_dia[por_dia.index >= pd.Timestamp(fecha_ref.year, fecha_ref.month, 1)]
+    np.add.at(acumulador['por_dia'], del_mes.index.day - 1, del_mes.to_numpy(dtype=float))
+    return acumulador
+
+
+def obtener_acumulador_mes(usuario_id):
+    """Acumulador del mes del usuario (o None si no se pudieron cargar los gastos)."""
+    acumulador = _cache_obtener(_acumuladores_cache, usuario_id)
+    if acumulador is not None:
+        return acumulador
+    df, error = obtener_frame_gastos(usuario_id)
+    if error:
+        return None
+    acumulador = acumulador_mes_desde_frame(df)
+    _cache_guardar(_acumuladores_cache, usuario_id, acumulador)
+    return acumulador
+
+
+def _construir_acumulador(usuario_id):
+    try:
+        df, error = obtener_frame_gastos(usuario_id)
+        if not error:
+            # Ya incluye el gasto que pidió la construcción
+            acumulador = acumulador_mes_desde_frame(df)
+            _cache_guardar(_acumuladores_cache, usuario_id, acumulador)
+            comprobar_umbrales_presupuesto(usuario_id, acumulador)
+    except Exception as e:
+        print(f"⚠️ Error construyendo el acumulador del mes de {usuario_id}: {e}")
+    finally:
+        with _acumuladores_lock:
+            repetir = usuario_id in _acumuladores_pendientes
+            _acumuladores_pendientes.discard(usuario_id)
+            if not repetir:
+                _acumuladores_construyendo.discard(usuario_id)
+    if repetir:
+        # Llegaron gastos mientras se construía y puede que no los incluya:
+        # se reconstruye y reemplaza al guardado
+        _pool_acumuladores.submit(_construir_acumulador, usuario_id)
+
+
+def programar_construccion_acumulador(usuario_id):
+    """Construye el acumulador del mes en segundo plano (como mucho una construcción en vuelo)."""
+    global _pool_acumuladores
+    with _acumuladores_lock:
+        if usuario_id in _acumuladores_construyendo:
+            _acumuladores_pendientes.add(usuario_id)
+            return
+        _acumuladores_construyendo.add(usuario_id)
+        if _pool_acumuladores is None:
+            _pool_acumuladores = ThreadPoolExecutor(max_workers=1, thread_name_prefix='acumuladores')
+    _pool_acumuladores.submit(_construir_acumulador, usuario_id)
+
+
+def obtener_presupuesto_mensual(usuario_id):
+    """Presupuesto mensual del usuario (caché de budget/current) o None si no tiene."""
+    budget_info = _cache_obtener(_presupuestos_cache, usuario_id)
+    if budget_info is None:
+        budget_info, _ = obtener_budget_usuario(usuario_id)
+    return (budget_info or {}).get('monthly_budget')
+
+
+def invalidar_presupuesto(usuario_id=None):
+    """Descarta el presupuesto en caché (llamar tras escribir budget/current)."""
+    _cache_invalidar(_presupuestos_cache, usuario_id)
+
+
+def registrar_gasto_acumulador(acumulador, fecha, monto):
+    """
+    Incorpora un gasto nuevo al acumulador.
+
+    Un gasto de un mes posterior abre un mes nuevo; los de meses anteriores
+    solo cuentan para el perfil por día de la semana.
+    """
+    fecha = pd.Timestamp(fecha).normalize()
+    with _acumuladores_lock:
+        acumulador['n'] += 1
+        acumulador['suma_semana'][fecha.dayofweek] += monto
+        acumulador['primer_dia'] = min(acumulador['primer_dia'], fecha)
+
+        mes = (fecha.year, fecha.month)
+        actual = (acumulador['año'], acumulador['mes'])
+        if mes > actual:
+            _nuevo_mes_acumulador(acumulador, fecha)
+        if mes >= actual:
+            acumulador['por_dia'][fecha.day - 1] += monto
+            acumulador['dia_referencia'] = max(acumulador['dia_referencia'], fecha.day)
+
+
+def _perfil_dia_semana(acumulador):
+    """Gasto medio por día natural de cada día de la semana (lunes=0) en el historial."""
+    inicio = acumulador['primer_dia']
+    fin = pd.Timestamp(acumulador['año'], acumulador['mes'], acumulador['dia_referencia'])
+    semanas, resto = divmod((fin - inicio).days + 1, 7)
+    conteo = semanas + ((np.arange(7) - inicio.dayofweek) % 7 < resto)
+    return np.divide(acumulador['suma_semana'], conteo, out=np.zeros(7), where=conteo > 0)
+
+
+def proyectar_fin_de_mes(acumulador, metodo='lineal', df=None, usuario_id=None):
+    """
+    Proyección del gasto total del mes en curso.
+
+    Métodos:
+        lineal: gasto diario medio del mes × días restantes
+        dia_semana: días restantes ponderados por el perfil histórico de cada
+            día de la semana, escalado al ritmo del mes en curso
+        modelo: suma de los RandomForest por categoría (predict_by_category)
+            en las fechas restantes del mes; requiere df
+
+    Returns:
+        Gasto proyectado a fin de mes (float)
+    """
+    gasto = float(acumulador['por_dia'].sum())
+    transcurridos = acumulador['dia_referencia']
+    restantes = acumulador['dias_mes'] - transcurridos
+    if restantes <= 0:
+        return gasto
+
+    if metodo == 'dia_semana':
+        perfil = _perfil_dia_semana(acumulador)
+        primer_dia_semana = pd.Timestamp(acumulador['año'], acumulador['mes'], 1).dayofweek
+        pesos = perfil[(primer_dia_semana + np.arange(acumulador['dias_mes'])) % 7]
+        esperado = pesos[:transcurridos].sum()
+        if esperado > 0:
+            return gasto + gasto / esperado * float(pesos[transcurridos:].sum())
+
+    elif metodo == 'modelo' and df is not None:
+        _, modelos = _modelos_por_categoria(df, usuario_id)
+        if modelos:
+            fechas = pd.date_range(
+                pd.Timestamp(acumulador['año'], acumulador['mes'], transcurridos + 1),
+                periods=restantes, freq='D'
+            )
+            X_futuro = np.column_stack([fechas.dayofweek, fechas.day])
+            return gasto + float(sum(np.maximum(modelo.predict(X_futuro), 0).sum() for modelo in modelos))
+
+    return gasto + gasto / transcurridos * restantes
+
+
+def _leer_opciones_presupuesto():
+    """Lee ?proyeccion= (lineal, dia_semana o modelo). Devuelve (metodo, error)."""
+    metodo = request.args.get('proyeccion', PRESUPUESTO_PROYECCION)
+    if metodo not in METODOS_PROYECCION:
+        return None, f"proyeccion debe ser una de: {', '.join(METODOS_PROYECCION)}"
+    return metodo, None
+
+
+def generate_budget_alerts(df, monthly_budget, cubo=None, usuario_id=None, proyeccion='lineal'):
     """
     Genera alertas cuando se aproxima o excede el presupuesto mensual.
     
+    El estado del mes sale del acumulador del mes en curso (duración real del
+    mes); con usuario_id se usa el acumulador en caché del usuario, que se
+    mantiene al día con cada gasto nuevo.
+    
     Args:
         df: DataFrame con gastos
         monthly_budget: Presupuesto mensual disponible
+        cubo: Cubo de agregados ya calculado (opcional)
+        usuario_id: ID del usuario para reutilizar su acumulador (opcional)
+        proyeccion: 'lineal', 'dia_semana' o 'modelo' (default: 'lineal')
     
     Returns:
         Dict con alertas y estado de presupuesto
     """
-    current_date = df['fecha'].max()
-    current_month_start = pd.Timestamp(current_date.year, current_date.month, 1)
-    current_month_data = df[df['fecha'] >= current_month_start]
+    acumulador = obtener_acumulador_mes(usuario_id) if usuario_id else None
+    if acumulador is None or acumulador['n'] != len(df):
+        acumulador = acumulador_mes_desde_frame(df, cubo)
     
-    current_spend = current_month_data['monto'].sum()
-    days_passed = (current_date - current_month_start).days + 1
-    days_in_month = 31  # Aproximado
+    current_spend = float(acumulador['por_dia'].sum())
+    days_passed = acumulador['dia_referencia']
+    days_in_month = acumulador['dias_mes']
     
-    remaining_days = max(1, days_in_month - days_passed)
+    remaining_days = days_in_month - days_passed
     remaining_budget = monthly_budget - current_spend
     
     # Proyección
     daily_avg = current_spend / days_passed if days_passed > 0 else 0
-    projected_end_month = current_spend + (daily_avg * remaining_days)
+    projected_end_month = proyectar_fin_de_mes(acumulador, proyeccion, df=df, usuario_id=usuario_id)
     
     # Determinar estado
     budget_pct = (current_spend / monthly_budget * 100) if monthly_budget > 0 else 0
@@ -1229,7 +2767,7 @@ def generate_budget_alerts(df, monthly_budget):
             'tipo': '⚡ PROYECCIÓN',
             'titulo': f'Proyección excede presupuesto en {(projection_ratio - 1) * 100:.1f}%',
             'descripcion': f'Si continúas al ritmo actual, terminarás con ${projected_end_month:.2f}',
-            'accion': f'Necesitas reducir gasto diario a ${remaining_budget / remaining_days:.2f}',
+            'accion': f'Necesitas reducir gasto diario a ${remaining_budget / max(1, remaining_days):.2f}',
             'severidad': 2
         })
     
@@ -1240,8 +2778,10 @@ def generate_budget_alerts(df, monthly_budget):
         'presupuesto_restante': round(remaining_budget, 2),
         'dias_transcurridos': days_passed,
         'dias_restantes': remaining_days,
+        'dias_mes': days_in_month,
         'gasto_diario_promedio': round(daily_avg, 2),
         'proyeccion_mes': round(projected_end_month, 2),
+        'metodo_proyeccion': proyeccion,
         'alertas': alerts
     }
 
@@ -1250,22 +2790,24 @@ def generate_budget_alerts(df, monthly_budget):
 # 1️⃣4️⃣ GAMIFICACIÓN - PUNTUACIÓN FINANCIERA
 # ============================================================
 
-def calculate_financial_health_score(df, monthly_budget):
+def calculate_financial_health_score(df, monthly_budget, cubo=None):
     """
     Calcula puntuación de "salud financiera" basada en múltiples factores.
     
     Args:
         df: DataFrame con gastos
         monthly_budget: Presupuesto mensual
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con puntuación y desglose de factores
     """
     score = 100  # Comenzar con puntuación máxima
     factors = []
+    cubo = cubo or obtener_cubo_agregados(df)
     
     # Factor 1: Control de presupuesto (-30 puntos máximo)
-    current_spend = df.groupby(df['fecha'].dt.to_period('M')).tail(1)['monto'].sum()
+    current_spend = df.groupby('año_mes').tail(1)['monto'].sum()
     if current_spend > 0:
         budget_ratio = current_spend / monthly_budget if monthly_budget > 0 else 0
         if budget_ratio > 1.0:
@@ -1284,7 +2826,7 @@ def calculate_financial_health_score(df, monthly_budget):
             })
     
     # Factor 2: Consistencia de gastos (-15 puntos máximo)
-    monthly = df.groupby(df['fecha'].dt.to_period('M'))['monto'].sum()
+    monthly = cubo['por_mes']['total']
     if len(monthly) > 1:
         cv = monthly.std() / monthly.mean() if monthly.mean() > 0 else 0
         if cv > 0.5:  # Coeficiente de variación
@@ -1302,7 +2844,7 @@ def calculate_financial_health_score(df, monthly_budget):
             })
     
     # Factor 3: Diversificación de gastos (+10 puntos máximo)
-    categories = df['categoria'].nunique()
+    categories = len(cubo['por_categoria'])
     if categories >= 5:
         score += 10
         bonus = 10
@@ -1321,7 +2863,7 @@ def calculate_financial_health_score(df, monthly_budget):
     # Factor 4: Ausencia de anomalías (-15 puntos)
     from scipy.stats import zscore
     z_scores = np.abs(zscore(df['monto']))
-    anomalies = (z_scores > 2.5).sum()
+    anomalies = int((z_scores > 2.5).sum())
     
     if anomalies > 0:
         deduction = min(15, anomalies * 2)
@@ -1400,11 +2942,10 @@ def generate_weekly_report(df):
         Dict con resumen semanal estructurado
     """
     # Obtener última semana completa
-    df['fecha'] = pd.to_datetime(df['fecha'])
-    end_date = df['fecha'].max()
+    end_date = df['dia'].max()
     start_date = end_date - timedelta(days=7)
     
-    week_data = df[(df['fecha'] >= start_date) & (df['fecha'] <= end_date)]
+    week_data = df[(df['dia'] >= start_date) & (df['dia'] <= end_date)]
     
     if len(week_data) == 0:
         return {'error': 'Sin datos de la última semana'}
@@ -1415,7 +2956,7 @@ def generate_weekly_report(df):
     avg_transaction = total_spend / num_transactions if num_transactions > 0 else 0
     
     # Por categoría
-    category_breakdown = week_data.groupby('categoria').agg({
+    category_breakdown = week_data.groupby('categoria', observed=True).agg({
         'monto': ['sum', 'count', 'mean']
     }).round(2)
     
@@ -1431,9 +2972,9 @@ def generate_weekly_report(df):
     category_list = sorted(category_list, key=lambda x: x['total'], reverse=True)
     
     # Día más costoso
-    daily_spend = week_data.groupby(week_data['fecha'].dt.date)['monto'].sum()
+    daily_spend = week_data.groupby('dia')['monto'].sum()
     if len(daily_spend) > 0:
-        costliest_day = daily_spend.idxmax()
+        costliest_day = daily_spend.idxmax().date()
         costliest_amount = daily_spend.max()
     else:
         costliest_day = None
@@ -1498,12 +3039,13 @@ def generate_weekly_report(df):
 # 1️⃣6️⃣ CALENDARIO DE CALOR (HEATMAP)
 # ============================================================
 
-def generate_heatmap(df):
+def generate_heatmap(df, cubo=None):
     """
     Crea un calendario de calor mostrando gastos por día.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con datos del heatmap y configuración
@@ -1511,13 +3053,15 @@ def generate_heatmap(df):
     if not PLOTLY_AVAILABLE:
         return {'error': 'Plotly no disponible. Instala: pip install plotly'}
     
-    # Preparar datos
-    df['fecha'] = pd.to_datetime(df['fecha'])
-    df['dia'] = df['fecha'].dt.date
-    daily_spend = df.groupby('dia')['monto'].sum().reset_index()
-    daily_spend['fecha'] = pd.to_datetime(daily_spend['dia'])
-    daily_spend['semana'] = daily_spend['fecha'].dt.isocalendar().week
-    daily_spend['dia_semana'] = daily_spend['fecha'].dt.weekday
+    # Preparar datos a partir de los totales diarios del cubo
+    cubo = cubo or obtener_cubo_agregados(df)
+    por_dia = cubo['por_dia']['total']
+    daily_spend = pd.DataFrame({
+        'dia': por_dia.index,
+        'semana': por_dia.index.isocalendar()['week'].values,
+        'dia_semana': por_dia.index.dayofweek,
+        'monto': por_dia.values
+    })
     
     # Crear matriz para heatmap
     pivot_data = daily_spend.pivot_table(
@@ -1551,9 +3095,9 @@ def generate_heatmap(df):
         'titulo': '📅 Calendario de Calor',
         'grafico_json': fig.to_json(),
         'datos_resumen': {
-            'dia_max_gasto': daily_spend.loc[daily_spend['monto'].idxmax()]['dia'].isoformat(),
+            'dia_max_gasto': daily_spend.loc[daily_spend['monto'].idxmax()]['dia'].date().isoformat(),
             'monto_max': round(daily_spend['monto'].max(), 2),
-            'dia_min_gasto': daily_spend.loc[daily_spend['monto'].idxmin()]['dia'].isoformat(),
+            'dia_min_gasto': daily_spend.loc[daily_spend['monto'].idxmin()]['dia'].date().isoformat(),
             'monto_min': round(daily_spend['monto'].min(), 2),
             'promedio_diario': round(daily_spend['monto'].mean(), 2)
         }
@@ -1564,12 +3108,13 @@ def generate_heatmap(df):
 # 1️⃣7️⃣ GRÁFICO SANKEY (FLUJO DE DINERO)
 # ============================================================
 
-def generate_sankey_diagram(df):
+def generate_sankey_diagram(df, cubo=None):
     """
     Crea un diagrama Sankey mostrando flujo de dinero por categoría.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con diagrama Sankey
@@ -1577,8 +3122,9 @@ def generate_sankey_diagram(df):
     if not PLOTLY_AVAILABLE:
         return {'error': 'Plotly no disponible. Instala: pip install plotly'}
     
-    # Agrupar por categoría
-    cat_spend = df.groupby('categoria')['monto'].sum().reset_index()
+    # Totales por categoría
+    cubo = cubo or obtener_cubo_agregados(df)
+    cat_spend = cubo['por_categoria']['total'].rename('monto').reset_index()
     cat_spend = cat_spend.sort_values('monto', ascending=False)
     
     # Crear nodos: "Ingresos" -> Categorías -> "Total Gastado"
@@ -1631,12 +3177,13 @@ def generate_sankey_diagram(df):
 # 1️⃣8️⃣ DASHBOARD INTERACTIVO
 # ============================================================
 
-def generate_interactive_dashboard(df):
+def generate_interactive_dashboard(df, cubo=None):
     """
     Crea un dashboard interactivo con múltiples gráficos.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con múltiples gráficos en subplots
@@ -1645,9 +3192,10 @@ def generate_interactive_dashboard(df):
         return {'error': 'Plotly no disponible. Instala: pip install plotly'}
     
     # Preparar datos
-    cat_spend = df.groupby('categoria')['monto'].sum().sort_values(ascending=False).head(10)
-    monthly = df.groupby(df['fecha'].dt.to_period('M'))['monto'].sum()
-    daily = df.groupby(df['fecha'].dt.date)['monto'].sum().tail(30)
+    cubo = cubo or obtener_cubo_agregados(df)
+    cat_spend = cubo['por_categoria']['total'].sort_values(ascending=False).head(10)
+    monthly = cubo['por_mes']['total']
+    daily = cubo['por_dia']['total'].tail(30)
     
     # Crear subplots
     from plotly.subplots import make_subplots
@@ -1697,9 +3245,9 @@ def generate_interactive_dashboard(df):
         'titulo': '📊 Dashboard Interactivo',
         'grafico_json': fig.to_json(),
         'resumen': {
-            'total_gasto': round(df['monto'].sum(), 2),
-            'transacciones': len(df),
-            'promedio': round(df['monto'].mean(), 2),
+            'total_gasto': round(cubo['total'], 2),
+            'transacciones': cubo['n'],
+            'promedio': round(cubo['media'], 2),
             'max_gasto': round(df['monto'].max(), 2),
             'min_gasto': round(df['monto'].min(), 2)
         }
@@ -1710,12 +3258,13 @@ def generate_interactive_dashboard(df):
 # 1️⃣9️⃣ COMPARATIVAS (MES VS MES)
 # ============================================================
 
-def generate_month_comparison_chart(df):
+def generate_month_comparison_chart(df, cubo=None):
     """
     Crea gráficos comparativos entre meses.
     
     Args:
         df: DataFrame con gastos
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con gráficos de comparación
@@ -1723,10 +3272,9 @@ def generate_month_comparison_chart(df):
     if not PLOTLY_AVAILABLE:
         return {'error': 'Plotly no disponible. Instala: pip install plotly'}
     
-    # Agrupar por mes y categoría
-    df['año_mes'] = df['fecha'].dt.to_period('M')
-    
-    monthly_cat = df.groupby(['año_mes', 'categoria'])['monto'].sum().reset_index()
+    # Totales por mes y categoría
+    cubo = cubo or obtener_cubo_agregados(df)
+    monthly_cat = cubo['por_mes_categoria']['total'].rename('monto').reset_index()
     monthly_cat = monthly_cat.sort_values('año_mes', ascending=False).head(50)
     
     # Obtener últimos 2 meses completos
@@ -1794,13 +3342,14 @@ def generate_month_comparison_chart(df):
 # 2️⃣0️⃣ EXPORTAR GRÁFICOS COMO IMAGEN
 # ============================================================
 
-def export_graphics_as_image(df, output_format='json'):
+def export_graphics_as_image(df, output_format='json', cubo=None):
     """
     Exporta gráficos principales en formato JSON o BASE64.
     
     Args:
         df: DataFrame con gastos
         output_format: 'json' (gráficos interactivos) o 'base64' (imágenes)
+        cubo: Cubo de agregados ya calculado (opcional)
     
     Returns:
         Dict con datos de exportación
@@ -1815,12 +3364,13 @@ def export_graphics_as_image(df, output_format='json'):
     }
     
     # Gráfico 1: Pie de categorías
-    cat_spend = df.groupby('categoria')['monto'].sum()
+    cubo = cubo or obtener_cubo_agregados(df)
+    cat_spend = cubo['por_categoria']['total']
     fig1 = go.Figure(data=[go.Pie(labels=cat_spend.index, values=cat_spend.values)])
     fig1.update_layout(title='Distribución de Gastos por Categoría')
     
     # Gráfico 2: Series temporal
-    daily = df.groupby(df['fecha'].dt.date)['monto'].sum()
+    daily = cubo['por_dia']['total']
     fig2 = go.Figure(data=[go.Scatter(x=daily.index.astype(str), y=daily.values, 
                                        mode='lines', fill='tozeroy')])
     fig2.update_layout(title='Gastos Diarios', xaxis_title='Fecha', yaxis_title='Monto ($)')
@@ -1831,9 +3381,8 @@ def export_graphics_as_image(df, output_format='json'):
     
     # Gráfico 4: Box plot
     df_categories = []
-    for cat in df['categoria'].unique():
-        montos = df[df['categoria'] == cat]['monto'].tolist()
-        df_categories.append({'categoria': cat, 'montos': montos})
+    for cat, montos in df.groupby('categoria', observed=True)['monto']:
+        df_categories.append({'categoria': cat, 'montos': montos.tolist()})
     
     fig4_data = []
     for item in df_categories:
@@ -1882,6 +3431,42 @@ def export_graphics_as_image(df, output_format='json'):
 # � NOTIFICACIONES PUSH - FIREBASE CLOUD MESSAGING
 # ============================================================
 
+# Registro de tokens por usuario en memoria del proceso: se carga bajo demanda
+# desde usuarios/{id}/device_tokens, caduca a los NOTIF_TOKENS_TTL_SEGUNDOS
+# (para ver altas/bajas hechas por otros procesos) y se mantiene al día con
+# register/unregister_device_token y con los tokens que FCM da por inválidos.
+NOTIF_TOKENS_TTL_SEGUNDOS = float(os.getenv('NOTIF_TOKENS_TTL_SEGUNDOS', 600))
+
+_tokens_dispositivo_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS * 4, NOTIF_TOKENS_TTL_SEGUNDOS)
+
+
+def _consultar_tokens_dispositivo(usuario_id):
+    tokens_ref = db.collection('usuarios').document(usuario_id).collection('device_tokens')
+    return tuple(doc.id for doc in tokens_ref.where('activo', '==', True).select(['activo']).stream())
+
+
+def obtener_tokens_dispositivo(usuario_id):
+    """Tokens activos del usuario (tupla) desde el registro o, si no está, desde Firestore."""
+    tokens = _cache_obtener(_tokens_dispositivo_cache, usuario_id)
+    if tokens is None:
+        tokens = _consultar_tokens_dispositivo(usuario_id)
+        _cache_guardar(_tokens_dispositivo_cache, usuario_id, tokens)
+    return tokens
+
+
+def _actualizar_tokens_registro(usuario_id, agregar=(), quitar=()):
+    """Aplica altas/bajas al registro si el usuario está cargado (sin renovar su TTL)."""
+    quitar = set(quitar)
+    with _tokens_dispositivo_cache['lock']:
+        entrada = _tokens_dispositivo_cache['entradas'].get(usuario_id)
+        if entrada is None:
+            return
+        guardado_en, tokens = entrada
+        tokens = tuple(t for t in tokens if t not in quitar)
+        tokens += tuple(t for t in dict.fromkeys(agregar) if t not in tokens)
+        _tokens_dispositivo_cache['entradas'][usuario_id] = (guardado_en, tokens)
+
+
 def register_device_token(usuario_id, device_token, dispositivo_info=None):
     """
     Registra un token de dispositivo para un usuario.
@@ -1906,6 +3491,7 @@ def register_device_token(usuario_id, device_token, dispositivo_info=None):
             'dispositivo_info': dispositivo_info or {},
             'activo': True
         }, merge=True)
+        _actualizar_tokens_registro(usuario_id, agregar=[device_token])
         return True, 'Token registrado exitosamente'
     except Exception as e:
         return False, f'Error registrando token: {str(e)}'
@@ -1928,15 +3514,141 @@ def unregister_device_token(usuario_id, device_token):
     try:
         tokens_ref = db.collection('usuarios').document(usuario_id).collection('device_tokens')
         tokens_ref.document(device_token).delete()
+        _actualizar_tokens_registro(usuario_id, quitar=[device_token])
         return True, 'Token desregistrado'
     except Exception as e:
         return False, f'Error: {str(e)}'
 
 
+# FCM admite hasta 500 tokens por MulticastMessage y Firestore 500 escrituras por batch
+FCM_MAX_TOKENS_MULTICAST = 500
+FIRESTORE_MAX_ESCRITURAS_BATCH = 500
+
+# Transporte FCM: 'multicast' recibe un MulticastMessage y 'lote' una lista
+# de Message; ambos devuelven un BatchResponse. Por defecto
+# messaging.send_each_for_multicast y messaging.send_each; se pueden sustituir
+# (p. ej. por un transporte falso para probar sin red) con
+# configurar_transporte_push.
+_transporte_push = {'multicast': None, 'lote': None}
+
+
+def configurar_transporte_push(multicast=None, lote=None):
+    """Sustituye el envío a FCM (None restaura el envío real)."""
+    _transporte_push['multicast'] = multicast
+    _transporte_push['lote'] = lote
+
+
+def _enviar_multicast(mensaje):
+    if _transporte_push['multicast'] is not None:
+        return _transporte_push['multicast'](mensaje)
+    from firebase_admin import messaging
+    return messaging.send_each_for_multicast(mensaje)
+
+
+def _enviar_lote_mensajes(mensajes):
+    if _transporte_push['lote'] is not None:
+        return _transporte_push['lote'](mensajes)
+    from firebase_admin import messaging
+    return messaging.send_each(mensajes)
+
+
+def _trozos(valores, tamaño):
+    """Divide una lista en trozos de como mucho 'tamaño' elementos."""
+    return [valores[i:i + tamaño] for i in range(0, len(valores), tamaño)]
+
+
+def _config_plataformas(titulo, cuerpo):
+    """Notificación y configuración Android/APNs/Web comunes a todos los mensajes."""
+    from firebase_admin import messaging
+    return {
+        'notification': messaging.Notification(
+            title=titulo[:100],  # Límite de 100 caracteres
+            body=cuerpo[:240]    # Límite de 240 caracteres
+        ),
+        'android': messaging.AndroidConfig(
+            priority='high',
+            notification=messaging.AndroidNotification(
+                sound='default',
+                color='#f45342',
+            ),
+        ),
+        'apns': messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(
+                    alert=messaging.ApsAlert(title=titulo, body=cuerpo),
+                    sound='default',
+                    badge=1,
+                    mutable_content=True,
+                ),
+            ),
+        ),
+        'webpush': messaging.WebpushConfig(
+            notification=messaging.WebpushNotification(
+                title=titulo,
+                body=cuerpo,
+                icon='https://www.example.com/icon.png'
+            ),
+        )
+    }
+
+
+def _construir_multicast(tokens, titulo, cuerpo, mensaje_data):
+    """MulticastMessage multiplataforma (Android, APNs y Web) para varios tokens."""
+    from firebase_admin import messaging
+    return messaging.MulticastMessage(tokens=tokens, data=mensaje_data, **_config_plataformas(titulo, cuerpo))
+
+
+def _token_invalido(error):
+    """True si FCM indica que el token ya no es válido y debe eliminarse."""
+    from firebase_admin import messaging
+    return isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError))
+
+
+def _enviar_a_tokens(tokens, titulo, cuerpo, mensaje_data):
+    """
+    Envía la notificación a una lista de tokens en lotes multicast.
+
+    Returns:
+        Lista de (token, message_id, error) en el orden de los tokens
+    """
+    resultados = []
+    for lote in _trozos(tokens, FCM_MAX_TOKENS_MULTICAST):
+        try:
+            respuesta = _enviar_multicast(_construir_multicast(lote, titulo, cuerpo, mensaje_data))
+            resultados.extend(
+                (token, r.message_id if r.success else None, None if r.success else r.exception)
+                for token, r in zip(lote, respuesta.responses)
+            )
+        except Exception as e:
+            resultados.extend((token, None, e) for token in lote)
+    return resultados
+
+
+def _escribir_resultados_envio(escrituras):
+    """
+    Aplica en batches de Firestore las escrituras de un envío.
+
+    Args:
+        escrituras: Lista de (doc_ref, datos) para set o (doc_ref, None) para delete
+    """
+    for lote in _trozos(escrituras, FIRESTORE_MAX_ESCRITURAS_BATCH):
+        batch = db.batch()
+        for ref, datos in lote:
+            if datos is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, datos)
+        batch.commit()
+
+
 def send_push_notification(usuario_id, titulo, cuerpo, datos_extra=None, device_token=None):
     """
     Envía una notificación push a un usuario o dispositivo específico.
     
+    Todos los dispositivos se envían con un único MulticastMessage
+    (send_each_for_multicast), el historial se guarda en un batch y los tokens
+    que FCM da por no registrados se eliminan de device_tokens.
+    
     Args:
         usuario_id: ID del usuario
         titulo: Título de la notificación
@@ -1951,18 +3663,15 @@ def send_push_notification(usuario_id, titulo, cuerpo, datos_extra=None, device_
         return {'exito': False, 'mensaje': 'Firebase no disponible'}
     
     try:
-        from firebase_admin import messaging
+        tokens_ref = db.collection('usuarios').document(usuario_id).collection('device_tokens')
         
         # Si se proporciona token específico, usarlo
         if device_token:
             tokens = [device_token]
         else:
-            # Obtener todos los tokens del usuario
-            tokens = []
+            # Obtener todos los tokens del usuario (registro en memoria)
             try:
-                tokens_ref = db.collection('usuarios').document(usuario_id).collection('device_tokens')
-                docs = tokens_ref.where('activo', '==', True).stream()
-                tokens = [doc.id for doc in docs]
+                tokens = list(obtener_tokens_dispositivo(usuario_id))
             except:
                 tokens = []
         
@@ -1973,93 +3682,55 @@ def send_push_notification(usuario_id, titulo, cuerpo, datos_extra=None, device_
                 'tokens_enviados': 0
             }
         
-        # Construir mensaje de notificación
-        notificacion = messaging.Notification(
-            title=titulo[:100],  # Límite de 100 caracteres
-            body=cuerpo[:240]    # Límite de 240 caracteres
-        )
-        
         # Datos adicionales (máximo 4KB)
-        # ⚠️ IMPORTANTE: Firebase Cloud Messaging requiere que TODOS los valores sean strings
-        mensaje_data = {}
-        if datos_extra:
-            for clave, valor in datos_extra.items():
-                # Convertir todos los valores a strings
-                mensaje_data[str(clave)] = str(valor)
-        
-        mensaje_data['usuario_id'] = usuario_id
-        mensaje_data['enviado_en'] = datetime.now().isoformat()
+        mensaje_data = _datos_mensaje(usuario_id, datos_extra)
         
-        # Enviar a cada token
         resultados = {
             'exitosos': 0,
             'fallidos': 0,
+            'tokens_invalidos_eliminados': 0,
             'detalles': []
         }
         
-        for token in tokens:
-            try:
-                # Crear mensaje multiplatforma
-                mensaje = messaging.Message(
-                    notification=notificacion,
-                    data=mensaje_data,
-                    token=token,
-                    android=messaging.AndroidConfig(
-                        priority='high',
-                        notification=messaging.AndroidNotification(
-                            sound='default',
-                            color='#f45342',
-                        ),
-                    ),
-                    apns=messaging.APNSConfig(
-                        payload=messaging.APNSPayload(
-                            aps=messaging.Aps(
-                                alert=messaging.ApsAlert(title=titulo, body=cuerpo),
-                                sound='default',
-                                badge=1,
-                                mutable_content=True,
-                            ),
-                        ),
-                    ),
-                    webpush=messaging.WebpushConfig(
-                        notification=messaging.WebpushNotification(
-                            title=titulo,
-                            body=cuerpo,
-                            icon='https://www.example.com/icon.png'
-                        ),
-                    )
-                )
-                
-                # Enviar
-                response = messaging.send(mensaje)
+        historial_ref = db.collection('usuarios').document(usuario_id).collection('notificaciones_historial')
+        fecha_envio = datetime.now().isoformat()
+        escrituras = []
+        
+        for token, message_id, error in _enviar_a_tokens(tokens, titulo, cuerpo, mensaje_data):
+            if error is None:
                 resultados['exitosos'] += 1
                 resultados['detalles'].append({
                     'token': token[:20] + '...',
                     'estado': 'enviado',
-                    'message_id': response
+                    'message_id': message_id
                 })
-                
-                # Guardar notificación en historial
-                try:
-                    historial_ref = db.collection('usuarios').document(usuario_id).collection('notificaciones_historial')
-                    historial_ref.add({
-                        'titulo': titulo,
-                        'cuerpo': cuerpo,
-                        'datos': mensaje_data,
-                        'fecha_envio': datetime.now().isoformat(),
-                        'token': token,
-                        'exitoso': True
-                    })
-                except:
-                    pass
-                    
-            except Exception as e:
+                escrituras.append((historial_ref.document(), {
+                    'titulo': titulo,
+                    'cuerpo': cuerpo,
+                    'datos': mensaje_data,
+                    'fecha_envio': fecha_envio,
+                    'token': token,
+                    'exitoso': True
+                }))
+            else:
                 resultados['fallidos'] += 1
-                resultados['detalles'].append({
+                detalle = {
                     'token': token[:20] + '...',
                     'estado': 'error',
-                    'error': str(e)
-                })
+                    'error': str(error)
+                }
+                if _token_invalido(error):
+                    detalle['estado'] = 'token_invalido'
+                    resultados['tokens_invalidos_eliminados'] += 1
+                    escrituras.append((tokens_ref.document(token), None))
+                resultados['detalles'].append(detalle)
+        
+        # Historial y limpieza de tokens en batches (no rompe el envío si falla)
+        _actualizar_tokens_registro(usuario_id, quitar=[ref.id for ref, datos in escrituras if datos is None])
+        try:
+            _escribir_resultados_envio(escrituras)
+        except Exception:
+            pass
         
         return {
             'exito': resultados['exitosos'] > 0,
@@ -2074,19 +3745,130 @@ def send_push_notification(usuario_id, titulo, cuerpo, datos_extra=None, device_
         }
 
 
-def send_bulk_notifications(usuarios_ids, titulo, cuerpo, datos_extra=None):
+# Envíos masivos: tokens de todos los usuarios resueltos de una vez, mensajes
+# en lotes de 500 (messaging.send_each) enviados en paralelo con un límite de
+# mensajes por segundo (token bucket) para no superar la cuota de FCM.
+NOTIF_MASIVAS_WORKERS = int(os.getenv('NOTIF_MASIVAS_WORKERS', 8))
+NOTIF_MASIVAS_MENSAJES_POR_SEGUNDO = float(os.getenv('NOTIF_MASIVAS_MENSAJES_POR_SEGUNDO', 5000))
+
+
+def crear_limitador_tasa(tasa, capacidad=None):
+    """Token bucket (dict): 'tasa' fichas por segundo hasta 'capacidad'. tasa <= 0 desactiva el límite."""
+    capacidad = float(capacidad or tasa)
+    return {
+        'tasa': float(tasa),
+        'capacidad': capacidad,
+        'fichas': capacidad,
+        'ultimo': time.monotonic(),
+        'lock': threading.Lock()
+    }
+
+
+def limitador_esperar(limitador, n=1):
+    """Bloquea hasta poder consumir n fichas del limitador."""
+    if limitador['tasa'] <= 0:
+        return
+    n = min(n, limitador['capacidad'])
+    while True:
+        with limitador['lock']:
+            ahora = time.monotonic()
+            limitador['fichas'] = min(
+                limitador['capacidad'],
+                limitador['fichas'] + (ahora - limitador['ultimo']) * limitador['tasa']
+            )
+            limitador['ultimo'] = ahora
+            if limitador['fichas'] >= n:
+                limitador['fichas'] -= n
+                return
+            espera = (n - limitador['fichas']) / limitador['tasa']
+        time.sleep(espera)
+
+
+def _datos_mensaje(usuario_id, datos_extra=None):
+    """Payload 'data' del mensaje: FCM exige que TODOS los valores sean strings."""
+    mensaje_data = {str(clave): str(valor) for clave, valor in (datos_extra or {}).items()}
+    mensaje_data['usuario_id'] = usuario_id
+    mensaje_data['enviado_en'] = datetime.now().isoformat()
+    return mensaje_data
+
+
+def obtener_tokens_usuarios(usuarios_ids):
+    """
+    Tokens activos de varios usuarios: {usuario_id: [tokens]}.
+
+    Los usuarios presentes en el registro de tokens no se consultan. El resto
+    se consulta con una query por usuario, NOTIF_MASIVAS_WORKERS en paralelo,
+    así que las lecturas dependen de la campaña y no del total de tokens de
+    la base. Lo leído se guarda en el registro.
+    """
+    tokens = {}
+    pendientes = []
+    for usuario_id in usuarios_ids:
+        en_registro = _cache_obtener(_tokens_dispositivo_cache, usuario_id)
+        if en_registro is None:
+            pendientes.append(usuario_id)
+        else:
+            tokens[usuario_id] = list(en_registro)
+    if not pendientes:
+        return tokens
+
+    def _tokens_de(usuario_id):
+        try:
+            return list(_consultar_tokens_dispositivo(usuario_id))
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(NOTIF_MASIVAS_WORKERS, len(pendientes)))) as pool:
+        for usuario_id, encontrados in zip(pendientes, pool.map(_tokens_de, pendientes)):
+            if encontrados is None:
+                encontrados = []
+            else:
+                _cache_guardar(_tokens_dispositivo_cache, usuario_id, tuple(encontrados))
+            tokens[usuario_id] = encontrados
+    return tokens
+
+
+def _enviar_lote_masivo(lote, titulo, cuerpo, datos_usuario, limitador):
+    """Envía un lote de (usuario_id, token) y devuelve [(usuario_id, token, message_id, error)]."""
+    from firebase_admin import messaging
+    plataformas = _config_plataformas(titulo, cuerpo)
+    mensajes = [
+        messaging.Message(token=token, data=datos_usuario[usuario_id], **plataformas)
+        for usuario_id, token in lote
+    ]
+    limitador_esperar(limitador, len(mensajes))
+    try:
+        respuesta = _enviar_lote_mensajes(mensajes)
+        return [
+            (usuario_id, token, r.message_id if r.success else None, None if r.success else r.exception)
+            for (usuario_id, token), r in zip(lote, respuesta.responses)
+        ]
+    except Exception as e:
+        return [(usuario_id, token, None, e) for usuario_id, token in lote]
+
+
+def send_bulk_notifications(usuarios_ids, titulo, cuerpo, datos_extra=None, workers=None, mensajes_por_segundo=None):
     """
     Envía notificaciones a múltiples usuarios.
     
+    Los tokens se resuelven de una vez (obtener_tokens_usuarios), los mensajes
+    se agrupan en lotes de 500 y los lotes se envían en un pool acotado con
+    límite de mensajes por segundo. El historial y la limpieza de tokens
+    inválidos se escriben en batches de Firestore.
+    
     Args:
         usuarios_ids: Lista de IDs de usuarios
         titulo: Título de la notificación
         cuerpo: Cuerpo del mensaje
         datos_extra: Datos adicionales
+        workers: Lotes enviados a la vez (default: NOTIF_MASIVAS_WORKERS)
+        mensajes_por_segundo: Límite de tasa (default: NOTIF_MASIVAS_MENSAJES_POR_SEGUNDO, 0 = sin límite)
     
     Returns:
-        Diccionario con resumen de resultados
+        Diccionario con resumen de resultados y estadísticas agregadas
     """
+    inicio = time.perf_counter()
+    usuarios_ids = list(dict.fromkeys(usuarios_ids))
     resultados = {
         'total_usuarios': len(usuarios_ids),
         'exitosos': 0,
@@ -2094,29 +3876,164 @@ def send_bulk_notifications(usuarios_ids, titulo, cuerpo, datos_extra=None):
         'detalles': []
     }
     
+    if not FIREBASE_AVAILABLE or not db:
+        resultados['fallidos'] = len(usuarios_ids)
+        resultados['detalles'] = [
+            {'usuario_id': usuario_id, 'exito': False, 'mensaje': 'Firebase no disponible'}
+            for usuario_id in usuarios_ids
+        ]
+        return resultados
+    
+    tokens_por_usuario = obtener_tokens_usuarios(usuarios_ids)
+    datos_usuario = {usuario_id: _datos_mensaje(usuario_id, datos_extra) for usuario_id in usuarios_ids}
+    envios = [(usuario_id, token) for usuario_id in usuarios_ids for token in tokens_por_usuario[usuario_id]]
+    lotes = _trozos(envios, FCM_MAX_TOKENS_MULTICAST)
+    
+    tasa = NOTIF_MASIVAS_MENSAJES_POR_SEGUNDO if mensajes_por_segundo is None else mensajes_por_segundo
+    limitador = crear_limitador_tasa(tasa, max(tasa, FCM_MAX_TOKENS_MULTICAST))
+    
+    enviados = dict.fromkeys(usuarios_ids, 0)
+    estadisticas = {
+        'usuarios_sin_dispositivos': sum(1 for usuario_id in usuarios_ids if not tokens_por_usuario[usuario_id]),
+        'mensajes': len(envios),
+        'mensajes_exitosos': 0,
+        'mensajes_fallidos': 0,
+        'tokens_invalidos_eliminados': 0,
+        'lotes': len(lotes)
+    }
+    fecha_envio = datetime.now().isoformat()
+    escrituras = []
+    
+    with ThreadPoolExecutor(max_workers=max(1, workers or NOTIF_MASIVAS_WORKERS), thread_name_prefix='notif-masivas') as pool:
+        futuros = [pool.submit(_enviar_lote_masivo, lote, titulo, cuerpo, datos_usuario, limitador) for lote in lotes]
+        for futuro in futuros:
+            for usuario_id, token, message_id, error in futuro.result():
+                usuario_ref = db.collection('usuarios').document(usuario_id)
+                if error is None:
+                    enviados[usuario_id] += 1
+                    estadisticas['mensajes_exitosos'] += 1
+                    escrituras.append((usuario_ref.collection('notificaciones_historial').document(), {
+                        'titulo': titulo,
+                        'cuerpo': cuerpo,
+                        'datos': datos_usuario[usuario_id],
+                        'fecha_envio': fecha_envio,
+                        'token': token,
+                        'exitoso': True
+                    }))
+                else:
+                    estadisticas['mensajes_fallidos'] += 1
+                    if _token_invalido(error):
+                        estadisticas['tokens_invalidos_eliminados'] += 1
+                        escrituras.append((usuario_ref.collection('device_tokens').document(token), None))
+                        _actualizar_tokens_registro(usuario_id, quitar=[token])
+    
+    try:
+        _escribir_resultados_envio(escrituras)
+    except Exception:
+        pass
+    
     for usuario_id in usuarios_ids:
-        resultado = send_push_notification(usuario_id, titulo, cuerpo, datos_extra)
-        if resultado.get('exito'):
-            resultados['exitosos'] += 1
+        exito = enviados[usuario_id] > 0
+        if not tokens_por_usuario[usuario_id]:
+            mensaje = 'No hay dispositivos registrados para este usuario'
         else:
-            resultados['fallidos'] += 1
-        
-        resultados['detalles'].append({
-            'usuario_id': usuario_id,
-            'exito': resultado.get('exito'),
-            'mensaje': resultado.get('mensaje')
-        })
-    
+            mensaje = f'Notificación enviada a {enviados[usuario_id]} dispositivo(s)'
+        resultados['exitosos' if exito else 'fallidos'] += 1
+        resultados['detalles'].append({'usuario_id': usuario_id, 'exito': exito, 'mensaje': mensaje})
+    
+    duracion = time.perf_counter() - inicio
+    estadisticas['duracion_segundos'] = round(duracion, 3)
+    estadisticas['mensajes_por_segundo'] = round(len(envios) / duracion, 1) if duracion > 0 else 0
+    resultados['estadisticas'] = estadisticas
     return resultados
 
 
-def get_notification_history(usuario_id, limite=50):
+# Historial de notificaciones paginado por cursor: cada página es una
+# consulta order_by(fecha_envio) + start_after + limit con proyección de
+# campos, así que el coste por página no depende del tamaño del historial.
+# El job de retención agrupa las entradas antiguas en documentos de resumen
+# mensual (notificaciones_resumen/{YYYY-MM}) y las elimina.
+NOTIF_HISTORIAL_PAGINA_MAX = int(os.getenv('NOTIF_HISTORIAL_PAGINA_MAX', 100))
+NOTIF_HISTORIAL_RETENCION_DIAS = int(os.getenv('NOTIF_HISTORIAL_RETENCION_DIAS', 90))
+
+CAMPOS_HISTORIAL_COMPACTO = ['titulo', 'cuerpo', 'fecha_envio', 'exitoso', 'datos.tipo_alerta', 'datos.tipo']
+
+
+def _codificar_cursor_historial(doc_id, fecha_envio):
+    crudo = json.dumps({'id': doc_id, 'f': fecha_envio}).encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii')
+
+
+def _decodificar_cursor_historial(cursor):
+    """Cursor opaco -> (doc_id, fecha_envio). ValueError si no es válido."""
+    try:
+        datos = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(datos['id']), str(datos['f'])
+    except Exception:
+        raise ValueError('cursor inválido')
+
+
+def _entrada_historial_compacta(doc_id, datos):
+    extra = datos.get('datos') or {}
+    return {
+        'id': doc_id,
+        'titulo': datos.get('titulo'),
+        'cuerpo': datos.get('cuerpo'),
+        'fecha_envio': datos.get('fecha_envio'),
+        'exitoso': datos.get('exitoso'),
+        'tipo': extra.get('tipo_alerta') or extra.get('tipo')
+    }
+
+
+def obtener_pagina_historial(usuario_id, limite=50, cursor=None, completo=False):
+    """
+    Una página del historial de notificaciones, de la más reciente a la más antigua.
+
+    Args:
+        usuario_id: ID del usuario
+        limite: Tamaño de página (máx. NOTIF_HISTORIAL_PAGINA_MAX)
+        cursor: Cursor devuelto por la página anterior (opcional)
+        completo: Devolver los documentos completos en lugar de la proyección compacta
+
+    Returns:
+        Tupla (notificaciones, siguiente_cursor); siguiente_cursor es None en la última página
     """
-    Obtiene el historial de notificaciones de un usuario.
+    limite = max(1, min(int(limite), NOTIF_HISTORIAL_PAGINA_MAX))
+    historial_ref = db.collection('usuarios').document(usuario_id).collection('notificaciones_historial')
+    consulta = historial_ref.order_by('fecha_envio', direction='DESCENDING')
+
+    if cursor:
+        doc_id, fecha_envio = _decodificar_cursor_historial(cursor)
+        ultimo = historial_ref.document(doc_id).get()
+        if ultimo.exists:
+            consulta = consulta.start_after(ultimo)
+        else:
+            # El documento se compactó: continuar por fecha
+            consulta = consulta.where('fecha_envio', '<', fecha_envio)
+    if not completo:
+        consulta = consulta.select(CAMPOS_HISTORIAL_COMPACTO)
+
+    # Se pide uno más para saber si hay página siguiente
+    docs = list(consulta.limit(limite + 1).stream())
+    hay_mas = len(docs) > limite
+    docs = docs[:limite]
+
+    if completo:
+        notificaciones = [{'id': doc.id, **doc.to_dict()} for doc in docs]
+    else:
+        notificaciones = [_entrada_historial_compacta(doc.id, doc.to_dict()) for doc in docs]
+    siguiente = _codificar_cursor_historial(docs[-1].id, docs[-1].to_dict().get('fecha_envio')) if hay_mas else None
+    return notificaciones, siguiente
+
+
+def get_notification_history(usuario_id, limite=50, cursor=None):
+    """
+    Obtiene el historial de notificaciones de un usuario (primera página o la del cursor).
     
     Args:
         usuario_id: ID del usuario
         limite: Cantidad máxima de registros
+        cursor: Cursor de paginación (ver obtener_pagina_historial)
     
     Returns:
         Lista de notificaciones
@@ -2125,20 +4042,557 @@ def get_notification_history(usuario_id, limite=50):
         return []
     
     try:
-        historial_ref = db.collection('usuarios').document(usuario_id).collection('notificaciones_historial')
-        docs = historial_ref.order_by('fecha_envio', direction='DESCENDING').limit(limite).stream()
-        
-        notificaciones = []
-        for doc in docs:
-            notificaciones.append({
-                'id': doc.id,
-                **doc.to_dict()
-            })
+        notificaciones, _ = obtener_pagina_historial(usuario_id, limite, cursor, completo=True)
         return notificaciones
     except Exception as e:
         return []
 
 
+def obtener_resumenes_historial(usuario_id):
+    """Resúmenes mensuales del historial ya compactado, del más reciente al más antiguo."""
+    resumen_ref = db.collection('usuarios').document(usuario_id).collection('notificaciones_resumen')
+    return sorted((doc.to_dict() for doc in resumen_ref.stream()), key=lambda r: r.get('mes', ''), reverse=True)
+
+
+def compactar_historial_notificaciones(dias_retencion=None, usuario_id=None, client=None):
+    """
+    Job de retención: resume por mes y elimina las entradas más antiguas que dias_retencion.
+
+    Sin usuario_id recorre todos los usuarios con una consulta collection_group.
+    Esa consulta (rango y orden sobre fecha_envio) necesita un índice de campo
+    único con ámbito de grupo de colecciones, que Firestore no crea por sí solo:
+    fecha_envio ascendente en el grupo notificaciones_historial (ver
+    retencion_notificaciones.py). Sin él falla con FAILED_PRECONDITION. Con
+    usuario_id basta el índice automático de la colección.
+    Cada página (como mucho la mitad de un batch) actualiza los resúmenes y
+    borra sus entradas en el mismo batch, de modo que un fallo a mitad no
+    cuenta dos veces ninguna entrada.
+
+    Args:
+        dias_retencion: Días de historial detallado a conservar (default: NOTIF_HISTORIAL_RETENCION_DIAS)
+        usuario_id: Compactar solo este usuario (opcional)
+        client: Cliente Firestore (default: el global db)
+
+    Returns:
+        Dict con entradas compactadas, resúmenes escritos y usuarios afectados
+    """
+    client = client or db
+    if not client:
+        raise RuntimeError('Firebase no disponible')
+    dias = NOTIF_HISTORIAL_RETENCION_DIAS if dias_retencion is None else dias_retencion
+    corte = (datetime.now() - timedelta(days=dias)).isoformat()
+    pagina = FIRESTORE_MAX_ESCRITURAS_BATCH // 2
+
+    if usuario_id:
+        origen = client.collection('usuarios').document(usuario_id).collection('notificaciones_historial')
+    else:
+        origen = client.collection_group('notificaciones_historial')
+    consulta = (origen.where('fecha_envio', '<', corte)
+                .order_by('fecha_envio')
+                .select(['fecha_envio', 'exitoso', 'datos.tipo_alerta', 'datos.tipo'])
+                .limit(pagina))
+
+    resumen = {'compactadas': 0, 'resumenes_escritos': 0, 'usuarios': set()}
+    inicio = time.monotonic()
+    while True:
+        docs = list(consulta.stream())
+        if not docs:
+            break
+
+        grupos = {}
+        for doc in docs:
+            datos = doc.to_dict()
+            usuario_ref = doc.reference.parent.parent
+            grupo = grupos.setdefault((usuario_ref.id, datos['fecha_envio'][:7]), {'ref': usuario_ref, 'docs': []})
+            grupo['docs'].append((doc.reference, datos))
+
+        refs_resumen = {
+            clave: grupo['ref'].collection('notificaciones_resumen').document(clave[1])
+            for clave, grupo in grupos.items()
+        }
+        existentes = {snap.reference.path: snap.to_dict() for snap in client.get_all(list(refs_resumen.values())) if snap.exists}
+
+        batch = client.batch()
+        for clave, grupo in grupos.items():
+            ref = refs_resumen[clave]
+            actual = existentes.get(ref.path) or {
+                'mes': clave[1], 'total': 0, 'exitosos': 0, 'por_tipo': {}, 'primera': None, 'ultima': None
+            }
+            for doc_ref, datos in grupo['docs']:
+                extra = datos.get('datos') or {}
+                tipo = extra.get('tipo_alerta') or extra.get('tipo') or 'sin_tipo'
+                fecha = datos['fecha_envio']
+                actual['total'] += 1
+                actual['exitosos'] += 1 if datos.get('exitoso') else 0
+                actual['por_tipo'][tipo] = actual['por_tipo'].get(tipo, 0) + 1
+                actual['primera'] = min(actual['primera'] or fecha, fecha)
+                actual['ultima'] = max(actual['ultima'] or fecha, fecha)
+                batch.delete(doc_ref)
+            actual['compactado_en'] = datetime.now().isoformat()
+            batch.set(ref, actual)
+            resumen['usuarios'].add(clave[0])
+        batch.commit()
+
+        resumen['compactadas'] += len(docs)
+        resumen['resumenes_escritos'] += len(grupos)
+        if len(docs) < pagina:
+            break
+
+    resumen['usuarios'] = len(resumen['usuarios'])
+    resumen['corte'] = corte
+    resumen['segundos'] = round(time.monotonic() - inicio, 2)
+    return resumen
+
+
+# ============================================================
+# 📮 OUTBOX DE NOTIFICACIONES (ENVÍO EN SEGUNDO PLANO)
+# ============================================================
+# Opcional (NOTIF_OUTBOX_ACTIVO=true, desactivado por defecto porque cambia la
+# respuesta de /api/v2/me/send-notification de 200 a 202).
+# Las notificaciones se guardan en una tabla SQLite local (sobrevive a
+# reinicios) y la petición HTTP responde 202 sin esperar a FCM. Un hilo
+# despachador reclama los registros pendientes, los envía con
+# send_push_notification y reintenta los fallos con backoff exponencial.
+# La clave de idempotencia (por usuario) evita encolar dos veces la misma
+# notificación. La entrega es "al menos una vez": un envío interrumpido se
+# reintenta cuando vence su reserva.
+# El despachador arranca con cada worker (gunicorn.conf.py, post_worker_init)
+# y al arrancar vacía lo que quedó pendiente. La base debe estar en un disco
+# persistente (ruta absoluta en NOTIF_OUTBOX_DB): el disco del contenedor se
+# pierde en cada despliegue. Todos los workers pueden compartir el fichero:
+# cada registro se reclama con una reserva dentro de una transacción, de uno
+# en uno y justo antes de enviarlo.
+
+NOTIF_OUTBOX_ACTIVO = os.getenv('NOTIF_OUTBOX_ACTIVO', 'false').lower() == 'true'
+NOTIF_OUTBOX_DB = os.getenv('NOTIF_OUTBOX_DB', '')
+NOTIF_OUTBOX_MAX_INTENTOS = int(os.getenv('NOTIF_OUTBOX_MAX_INTENTOS', 5))
+NOTIF_OUTBOX_BACKOFF_SEGUNDOS = float(os.getenv('NOTIF_OUTBOX_BACKOFF_SEGUNDOS', 2))
+NOTIF_OUTBOX_BACKOFF_MAX_SEGUNDOS = float(os.getenv('NOTIF_OUTBOX_BACKOFF_MAX_SEGUNDOS', 300))
+NOTIF_OUTBOX_RESERVA_SEGUNDOS = float(os.getenv('NOTIF_OUTBOX_RESERVA_SEGUNDOS', 120))
+NOTIF_OUTBOX_INTERVALO_SEGUNDOS = float(os.getenv('NOTIF_OUTBOX_INTERVALO_SEGUNDOS', 5))
+NOTIF_OUTBOX_LOTE = int(os.getenv('NOTIF_OUTBOX_LOTE', 50))
+
+# pendiente -> enviando -> enviado | sin_dispositivos | fallido (o de vuelta a pendiente)
+ESTADOS_OUTBOX = ('pendiente', 'enviando', 'enviado', 'sin_dispositivos', 'fallido')
+
+_outbox_lock = threading.Lock()
+_outbox_inicializado = False
+_outbox_despertar = threading.Event()
+_outbox_hilo = None
+
+if NOTIF_OUTBOX_ACTIVO and not os.path.isabs(NOTIF_OUTBOX_DB):
+    raise RuntimeError(
+        'NOTIF_OUTBOX_ACTIVO=true requiere NOTIF_OUTBOX_DB con una ruta absoluta en un disco '
+        'persistente (p. ej. /var/data/notificaciones_outbox.db); '
+        f'valor actual: {NOTIF_OUTBOX_DB!r}'
+    )
+
+
+def _conexion_outbox():
+    """Conexión SQLite nueva (una por operación: sqlite3 no comparte conexiones entre hilos)."""
+    global _outbox_inicializado
+    conexion = sqlite3.connect(NOTIF_OUTBOX_DB, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    if not _outbox_inicializado:
+        with _outbox_lock:
+            if not _outbox_inicializado:
+                conexion.execute('PRAGMA journal_mode=WAL')
+                conexion.execute('''
+                    CREATE TABLE IF NOT EXISTS outbox (
+                        id TEXT PRIMARY KEY,
+                        usuario_id TEXT NOT NULL,
+                        clave_idempotencia TEXT NOT NULL,
+                        payload TEXT NOT NULL,
+                        estado TEXT NOT NULL,
+                        intentos INTEGER NOT NULL DEFAULT 0,
+                        proximo_intento REAL NOT NULL,
+                        creado_en REAL NOT NULL,
+                        actualizado_en REAL NOT NULL,
+                        ultimo_error TEXT,
+                        resultado TEXT,
+                        UNIQUE (usuario_id, clave_idempotencia)
+                    )
+                ''')
+                conexion.execute('CREATE INDEX IF NOT EXISTS outbox_pendientes ON outbox (estado, proximo_intento)')
+                conexion.commit()
+                _outbox_inicializado = True
+    return conexion
+
+
+def _registro_outbox(fila):
+    """Fila de la tabla -> dict para la API."""
+    return {
+        'notificacion_id': fila['id'],
+        'usuario_id': fila['usuario_id'],
+        'clave_idempotencia': fila['clave_idempotencia'],
+        'estado': fila['estado'],
+        'intentos': fila['intentos'],
+        'creado_en': datetime.fromtimestamp(fila['creado_en']).isoformat(),
+        'actualizado_en': datetime.fromtimestamp(fila['actualizado_en']).isoformat(),
+        'ultimo_error': fila['ultimo_error'],
+        'resultado': json.loads(fila['resultado']) if fila['resultado'] else None
+    }
+
+
+def encolar_notificacion(usuario_id, titulo, cuerpo, datos_extra=None, clave_idempotencia=None):
+    """
+    Guarda una notificación en el outbox y despierta al despachador.
+
+    Args:
+        usuario_id: ID del usuario destinatario
+        titulo: Título de la notificación
+        cuerpo: Cuerpo del mensaje
+        datos_extra: Datos adicionales (dict)
+        clave_idempotencia: Clave única por usuario (opcional, default: uuid nuevo)
+
+    Returns:
+        Tupla (registro, creado): creado=False si la clave ya estaba encolada
+    """
+    clave_idempotencia = str(clave_idempotencia or uuid.uuid4())
+    ahora = time.time()
+    payload = json.dumps({'titulo': titulo, 'cuerpo': cuerpo, 'datos_extra': datos_extra or {}},
+                         ensure_ascii=False, default=str)
+    conexion = _conexion_outbox()
+    try:
+        with conexion:
+            cursor = conexion.execute(
+                'INSERT OR IGNORE INTO outbox (id, usuario_id, clave_idempotencia, payload, estado, '
+                'proximo_intento, creado_en, actualizado_en) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(uuid.uuid4()), usuario_id, clave_idempotencia, payload, 'pendiente', ahora, ahora, ahora)
+            )
+        fila = conexion.execute(
+            'SELECT * FROM outbox WHERE usuario_id = ? AND clave_idempotencia = ?',
+            (usuario_id, clave_idempotencia)
+        ).fetchone()
+    finally:
+        conexion.close()
+    iniciar_despachador_outbox()
+    _outbox_despertar.set()
+    return _registro_outbox(fila), cursor.rowcount == 1
+
+
+def obtener_notificacion_outbox(usuario_id, notificacion_id):
+    """Registro del outbox del usuario (o None si no existe)."""
+    conexion = _conexion_outbox()
+    try:
+        fila = conexion.execute(
+            'SELECT * FROM outbox WHERE id = ? AND usuario_id = ?', (notificacion_id, usuario_id)
+        ).fetchone()
+    finally:
+        conexion.close()
+    return _registro_outbox(fila) if fila else None
+
+
+def _reclamar_siguiente_outbox():
+    """
+    Marca como 'enviando' (con reserva) el registro vencido más antiguo y lo
+    devuelve (None si no hay ninguno). Se reclama de uno en uno, justo antes
+    de enviarlo: una reserva por lote podría vencer mientras se envían los
+    anteriores y otro worker volvería a enviar los que aún no se habían tocado.
+    """
+    ahora = time.time()
+    conexion = _conexion_outbox()
+    try:
+        conexion.execute('BEGIN IMMEDIATE')
+        fila = conexion.execute(
+            "SELECT * FROM outbox WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= ? "
+            'ORDER BY proximo_intento LIMIT 1', (ahora,)
+        ).fetchone()
+        if fila is not None:
+            conexion.execute(
+                "UPDATE outbox SET estado = 'enviando', proximo_intento = ?, actualizado_en = ? WHERE id = ?",
+                (ahora + NOTIF_OUTBOX_RESERVA_SEGUNDOS, ahora, fila['id'])
+            )
+        conexion.commit()
+        return fila
+    finally:
+        conexion.close()
+
+
+def _espera_reintento(intentos):
+    """Backoff exponencial con jitter para el intento número 'intentos'."""
+    espera = min(NOTIF_OUTBOX_BACKOFF_MAX_SEGUNDOS, NOTIF_OUTBOX_BACKOFF_SEGUNDOS * 2 ** (intentos - 1))
+    return espera * (0.5 + np.random.random() / 2)
+
+
+def _despachar_notificacion_outbox(fila):
+    """Envía un registro reclamado y guarda su nuevo estado."""
+    payload = json.loads(fila['payload'])
+    intentos = fila['intentos'] + 1
+    try:
+        resultado = send_push_notification(
+            fila['usuario_id'], payload['titulo'], payload['cuerpo'], payload['datos_extra']
+        )
+    except Exception as e:
+        resultado = {'exito': False, 'mensaje': f'Error enviando notificación: {str(e)}'}
+
+    ahora = time.time()
+    proximo = ahora
+    error = None
+    if resultado.get('exito'):
+        estado = 'enviado'
+    elif 'No hay dispositivos' in resultado.get('mensaje', ''):
+        estado = 'sin_dispositivos'
+    else:
+        errores = {d['error'] for d in (resultado.get('resultados') or {}).get('detalles', []) if d.get('error')}
+        error = '; '.join(sorted(errores)) or resultado.get('mensaje')
+        if intentos >= NOTIF_OUTBOX_MAX_INTENTOS:
+            estado = 'fallido'
+        else:
+            estado = 'pendiente'
+            proximo = ahora + _espera_reintento(intentos)
+
+    resumen = {k: v for k, v in (resultado.get('resultados') or {}).items() if k != 'detalles'}
+    conexion = _conexion_outbox()
+    try:
+        with conexion:
+            conexion.execute(
+                'UPDATE outbox SET estado = ?, intentos = ?, proximo_intento = ?, actualizado_en = ?, '
+                'ultimo_error = ?, resultado = ? WHERE id = ?',
+                (estado, intentos, proximo, ahora, error, json.dumps(resumen) if resumen else None, fila['id'])
+            )
+    finally:
+        conexion.close()
+    return estado
+
+
+def despachar_outbox(limite=None):
+    """Envía hasta 'limite' notificaciones vencidas. Devuelve cuántas se procesaron."""
+    procesadas = 0
+    while procesadas < (limite or NOTIF_OUTBOX_LOTE):
+        fila = _reclamar_siguiente_outbox()
+        if fila is None:
+            break
+        _despachar_notificacion_outbox(fila)
+        procesadas += 1
+    return procesadas
+
+
+def _segundos_hasta_proximo_outbox():
+    """Segundos hasta el próximo registro vencido (como mucho NOTIF_OUTBOX_INTERVALO_SEGUNDOS)."""
+    conexion = _conexion_outbox()
+    try:
+        proximo = conexion.execute(
+            "SELECT MIN(proximo_intento) FROM outbox WHERE estado IN ('pendiente', 'enviando')"
+        ).fetchone()[0]
+    finally:
+        conexion.close()
+    if proximo is None:
+        return NOTIF_OUTBOX_INTERVALO_SEGUNDOS
+    return min(NOTIF_OUTBOX_INTERVALO_SEGUNDOS, max(0.0, proximo - time.time()))
+
+
+def _bucle_despachador_outbox():
+    while True:
+        espera = NOTIF_OUTBOX_INTERVALO_SEGUNDOS
+        try:
+            if despachar_outbox():
+                continue
+            espera = _segundos_hasta_proximo_outbox()
+        except Exception as e:
+            print(f"⚠️  Error en el despachador de notificaciones: {e}")
+        _outbox_despertar.wait(espera)
+        _outbox_despertar.clear()
+
+
+def iniciar_despachador_outbox():
+    """
+    Arranca (una vez por proceso) el hilo que vacía el outbox.
+
+    Se llama al arrancar cada worker: su primera pasada envía lo que quedó
+    pendiente antes del reinicio y las reservas vencidas de envíos
+    interrumpidos. No hace nada si el outbox está desactivado.
+    """
+    global _outbox_hilo
+    if not NOTIF_OUTBOX_ACTIVO:
+        return
+    with _outbox_lock:
+        if _outbox_hilo is not None and _outbox_hilo.is_alive():
+            return
+        arranque = _outbox_hilo is None
+        _outbox_hilo = threading.Thread(target=_bucle_despachador_outbox, name='outbox-notificaciones', daemon=True)
+        _outbox_hilo.start()
+    if arranque:
+        try:
+            estados = estadisticas_outbox()
+            print(f"📮 Outbox de notificaciones en {NOTIF_OUTBOX_DB}: "
+                  f"{estados.get('pendiente', 0)} pendientes, {estados.get('enviando', 0)} en envío al arrancar")
+        except Exception as e:
+            print(f"⚠️  No se pudo leer el outbox de notificaciones: {e}")
+
+
+def estadisticas_outbox():
+    """Registros del outbox por estado."""
+    conexion = _conexion_outbox()
+    try:
+        filas = conexion.execute('SELECT estado, COUNT(*) AS n FROM outbox GROUP BY estado').fetchall()
+    finally:
+        conexion.close()
+    return {fila['estado']: fila['n'] for fila in filas}
+
+
+# ============================================================
+# 🔔 ALERTAS DE PRESUPUESTO POR UMBRAL (PUSH)
+# ============================================================
+# Tras cada gasto nuevo se compara el gasto del mes (acumulador del mes) con
+# el presupuesto de users/{id}/budget/current. Solo los umbrales que se
+# cruzan por primera vez en el mes generan una notificación push. Cada umbral
+# se reclama creando users/{id}/alertas_presupuesto/{YYYY-MM}-{umbral}: create()
+# falla si el documento ya existe, así que entre todos los workers (y tras un
+# reinicio) solo uno lo consigue y solo ese envía la push. Las push se envían
+# a través del outbox si está activo y, si no, en un pool de hilos en segundo
+# plano.
+
+def _leer_umbrales(valor):
+    """'70,85,100' -> (70, 85, 100) ordenados."""
+    return tuple(sorted(int(u) if u.strip().isdigit() else float(u) for u in valor.split(',') if u.strip()))
+
+
+UMBRALES_ALERTA_PRESUPUESTO = _leer_umbrales(os.getenv('UMBRALES_ALERTA_PRESUPUESTO', '70,85,100'))
+ALERTAS_PRESUPUESTO_PUSH = os.getenv('ALERTAS_PRESUPUESTO_PUSH', 'true').lower() == 'true'
+ALERTAS_PRESUPUESTO_WORKERS = int(os.getenv('ALERTAS_PRESUPUESTO_WORKERS', 2))
+
+TEXTOS_ALERTA_PRESUPUESTO = (
+    (100, '🚨 Presupuesto excedido', 'Has gastado ${gasto:.2f} de tu presupuesto de ${presupuesto:.2f}'),
+    (85, '⚠️ Presupuesto casi agotado', 'Has utilizado el {porcentaje:.1f}% de tu presupuesto mensual'),
+    (0, '📌 Atención a tu presupuesto', 'Has gastado el {porcentaje:.1f}% de tu presupuesto mensual'),
+)
+
+# Umbrales ya reclamados por usuario en este proceso: {'mes': 'YYYY-MM', 'umbrales': set}.
+# Solo evita repetir reclamaciones; quien decide si se avisa es Firestore
+_alertas_presupuesto_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, GASTOS_RESYNC_COMPLETA_SEGUNDOS)
+_alertas_presupuesto_lock = threading.Lock()
+_pool_alertas_presupuesto = None
+
+
+def _doc_umbral_presupuesto(usuario_id, mes, umbral):
+    return (db.collection('users').document(usuario_id)
+            .collection('alertas_presupuesto').document(f'{mes}-{umbral}'))
+
+
+def _estado_alertas_presupuesto(usuario_id, mes):
+    """Umbrales del mes que este proceso ya sabe reclamados."""
+    with _alertas_presupuesto_lock:
+        estado = _cache_obtener(_alertas_presupuesto_cache, usuario_id, contar=False)
+        if estado is None or estado['mes'] != mes:
+            estado = {'mes': mes, 'umbrales': set()}
+            _cache_guardar(_alertas_presupuesto_cache, usuario_id, estado)
+        return estado
+
+
+def _reclamar_umbral_presupuesto(usuario_id, alerta):
+    """
+    Reclama en Firestore el aviso del umbral de 'alerta'.
+
+    Returns:
+        True si lo reclamó esta llamada, False si ya estaba reclamado
+    """
+    try:
+        _doc_umbral_presupuesto(usuario_id, alerta['mes'], alerta['umbral']).create({
+            **alerta,
+            'avisado_en': datetime.now().isoformat()
+        })
+        return True
+    except AlreadyExists:
+        return False
+
+
+def _enviar_alerta_presupuesto(usuario_id, titulo, cuerpo, datos):
+    """Envía la push de un umbral cruzado sin outbox (se ejecuta en segundo plano)."""
+    try:
+        send_push_notification(usuario_id, titulo, cuerpo, datos)
+    except Exception:
+        pass
+
+
+def _notificar_alerta_presupuesto(usuario_id, alerta):
+    """Encola (o, sin outbox, envía en segundo plano) la push de un umbral cruzado."""
+    global _pool_alertas_presupuesto
+    for minimo, titulo, plantilla in TEXTOS_ALERTA_PRESUPUESTO:
+        if alerta['umbral'] >= minimo:
+            break
+    cuerpo = plantilla.format(**alerta)
+    datos = {'tipo': 'alerta_presupuesto', **alerta}
+    if NOTIF_OUTBOX_ACTIVO:
+        # Clave de idempotencia por mes y umbral
+        encolar_notificacion(
+            usuario_id, titulo, cuerpo, datos,
+            clave_idempotencia=f"presupuesto-{alerta['mes']}-{alerta['umbral']}"
+        )
+        return
+    with _alertas_presupuesto_lock:
+        if _pool_alertas_presupuesto is None:
+            _pool_alertas_presupuesto = ThreadPoolExecutor(
+                max_workers=max(1, ALERTAS_PRESUPUESTO_WORKERS),
+                thread_name_prefix='alertas-presupuesto'
+            )
+    _pool_alertas_presupuesto.submit(_enviar_alerta_presupuesto, usuario_id, titulo, cuerpo, datos)
+
+
+def comprobar_umbrales_presupuesto(usuario_id, acumulador, presupuesto=None):
+    """
+    Detecta los umbrales de presupuesto cruzados por primera vez este mes.
+
+    Si se cruzan varios a la vez (p. ej. de 60% a 101%) se reclaman todos y se
+    envía una sola push con el más alto de los que reclamó esta llamada.
+
+    Args:
+        usuario_id: ID del usuario
+        acumulador: Acumulador del mes ya actualizado con el gasto nuevo
+        presupuesto: Presupuesto mensual (default: el de obtener_presupuesto_mensual)
+
+    Returns:
+        Dict con el umbral avisado o None si no se cruzó ninguno nuevo (o si
+        otro worker ya lo había reclamado)
+    """
+    if presupuesto is None:
+        presupuesto = obtener_presupuesto_mensual(usuario_id)
+    try:
+        presupuesto = float(presupuesto)
+    except (TypeError, ValueError):
+        return None
+    if presupuesto <= 0:
+        return None
+
+    gasto = float(acumulador['por_dia'].sum())
+    porcentaje = gasto / presupuesto * 100
+    mes = f"{acumulador['año']:04d}-{acumulador['mes']:02d}"
+
+    estado = _estado_alertas_presupuesto(usuario_id, mes)
+    with _alertas_presupuesto_lock:
+        candidatos = [u for u in UMBRALES_ALERTA_PRESUPUESTO if porcentaje >= u and u not in estado['umbrales']]
+    if not candidatos:
+        return None
+
+    base = {
+        'mes': mes,
+        'porcentaje': round(porcentaje, 2),
+        'gasto': round(gasto, 2),
+        'presupuesto': round(presupuesto, 2)
+    }
+    reclamados = []
+    for umbral in candidatos:
+        try:
+            if _reclamar_umbral_presupuesto(usuario_id, {'umbral': umbral, **base}):
+                reclamados.append(umbral)
+        except Exception as e:
+            # Sin reclamación no se avisa; se reintenta con el siguiente gasto
+            print(f"⚠️ No se pudo reclamar el umbral {umbral}% de {usuario_id}: {e}")
+            continue
+        with _alertas_presupuesto_lock:
+            estado['umbrales'].add(umbral)
+    if not reclamados:
+        return None
+
+    alerta = {'umbral': reclamados[-1], **base}
+    if ALERTAS_PRESUPUESTO_PUSH:
+        try:
+            _notificar_alerta_presupuesto(usuario_id, alerta)
+        except Exception:
+            pass
+    return alerta
+
+
 # ============================================================
 # �🚀 INICIALIZAR FLASK Y ENDPOINTS
 # ============================================================
@@ -2187,6 +4641,40 @@ def get_token():
     except Exception as e:
         return jsonify({'error': f'Error generando token: {str(e)}'}), 500
 
+
+@app.route('/api/v2/auth/revoke', methods=['POST'])
+@token_required
+def revoke_token():
+    """
+    Revoca un token JWT antes de su expiración (logout).
+    
+    Sin body revoca el token con el que se hace la petición. Con
+    {"token": "<jwt>"} revoca otro token del mismo usuario.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        payload = g.token_payload
+        if data.get('token'):
+            try:
+                payload = jwt.decode(data['token'], SECRET_KEY, algorithms=['HS256'],
+                                     options={'require': ['exp', 'token_id']})
+            except jwt.ExpiredSignatureError:
+                return jsonify({'status': 'success', 'mensaje': 'El token ya había expirado'}), 200
+            except jwt.InvalidTokenError:
+                return jsonify({'error': 'Token a revocar inválido'}), 400
+            if payload.get('user_id') != g.user_id:
+                return jsonify({'error': 'Solo se pueden revocar tokens del mismo usuario'}), 403
+        
+        revocar_token(payload['token_id'], payload['exp'])
+        return jsonify({
+            'status': 'success',
+            'mensaje': 'Token revocado',
+            'token_id': payload['token_id'],
+            'revocado_hasta': datetime.utcfromtimestamp(payload['exp']).isoformat() + 'Z'
+        }), 200
+    except Exception as e:
+        return jsonify({'error': f'Error revocando token: {str(e)}'}), 500
+
 @app.route('/api/v2/me/send-notification', methods=['POST'])
 @token_required
 def send_notification_me():
@@ -2273,6 +4761,22 @@ def send_notification_me():
         if datos_extra:
             datos_notificacion.update(datos_extra)
         
+        # Outbox: se encola y el despachador la envía en segundo plano
+        if NOTIF_OUTBOX_ACTIVO:
+            clave = request.headers.get('Idempotency-Key') or data.get('clave_idempotencia')
+            registro, creado = encolar_notificacion(usuario_id, titulo, cuerpo, datos_notificacion, clave)
+            return jsonify({
+                'status': 'encolada',
+                'usuario_id': usuario_id,
+                'tipo_alerta': tipo_alerta,
+                'notificacion_id': registro['notificacion_id'],
+                'clave_idempotencia': registro['clave_idempotencia'],
+                'estado': registro['estado'],
+                'duplicada': not creado,
+                'mensaje': 'Notificación encolada; se enviará en segundo plano',
+                'estado_url': f"/api/v2/me/send-notification/{registro['notificacion_id']}"
+            }), 202
+        
         resultado = send_push_notification(
             usuario_id=usuario_id,
             titulo=titulo,
@@ -2312,6 +4816,62 @@ def send_notification_me():
         }), 500
 
 
+@app.route('/api/v2/me/send-notification/<notificacion_id>', methods=['GET'])
+@token_required
+def notification_status_me(notificacion_id):
+    """Estado de una notificación encolada con /api/v2/me/send-notification. REQUIERE TOKEN."""
+    if not NOTIF_OUTBOX_ACTIVO:
+        return jsonify({'status': 'error', 'mensaje': 'Outbox de notificaciones desactivado (NOTIF_OUTBOX_ACTIVO)'}), 404
+    try:
+        registro = obtener_notificacion_outbox(g.get('user_id'), notificacion_id)
+        if not registro:
+            return jsonify({'status': 'error', 'mensaje': 'Notificación no encontrada'}), 404
+        return jsonify({'status': 'success', 'data': registro}), 200
+    except Exception as e:
+        return jsonify({'status': 'error', 'mensaje': str(e)}), 500
+
+
+@app.route('/api/v2/me/notification-history', methods=['GET'])
+@token_required
+def notification_history_me():
+    """
+    Historial de notificaciones del usuario autenticado, paginado por cursor. REQUIERE TOKEN.
+    
+    Query: ?limite=50 (máx. NOTIF_HISTORIAL_PAGINA_MAX), ?cursor=<siguiente_cursor>,
+    ?completo=true (documentos completos), ?resumen=true (resúmenes mensuales compactados).
+    """
+    if not FIREBASE_AVAILABLE or not db:
+        return jsonify({'status': 'error', 'mensaje': 'Firebase no disponible'}), 503
+    
+    try:
+        usuario_id = g.get('user_id')
+        limite = request.args.get('limite', 50, type=int)
+        if limite is None or limite < 1:
+            return jsonify({'status': 'error', 'mensaje': 'limite debe ser un entero mayor o igual que 1'}), 400
+        
+        try:
+            notificaciones, siguiente = obtener_pagina_historial(
+                usuario_id,
+                limite=limite,
+                cursor=request.args.get('cursor'),
+                completo=request.args.get('completo') == 'true'
+            )
+        except ValueError as e:
+            return jsonify({'status': 'error', 'mensaje': str(e)}), 400
+        
+        respuesta = {
+            'status': 'success',
+            'usuario_id': usuario_id,
+            'data': notificaciones,
+            'siguiente_cursor': siguiente
+        }
+        if request.args.get('resumen') == 'true':
+            respuesta['resumenes_mensuales'] = obtener_resumenes_historial(usuario_id)
+        return jsonify(respuesta), 200
+    except Exception as e:
+        return jsonify({'status': 'error', 'mensaje': str(e)}), 500
+
+
 
 # ============================================================
 # 📊 ENDPOINTS DE LA API
@@ -2397,6 +4957,22 @@ def firebase_debug():
             except Exception as e:
                 info['gastos_error'] = str(e)
         
+        info['cache_gastos'] = estadisticas_cache_gastos()
+        info['cache_cubos'] = _cache_estadisticas(_cubos_cache)
+        info['cache_modelos'] = estadisticas_modelos()
+        info['cache_detectores'] = _cache_estadisticas(_detectores_cache)
+        info['cache_sketches'] = _cache_estadisticas(_sketches_cache)
+        info['cache_acumuladores_mes'] = _cache_estadisticas(_acumuladores_cache)
+        info['cache_presupuestos'] = _cache_estadisticas(_presupuestos_cache)
+        info['cache_alertas_presupuesto'] = _cache_estadisticas(_alertas_presupuesto_cache)
+        info['cache_tokens_dispositivo'] = _cache_estadisticas(_tokens_dispositivo_cache)
+        if NOTIF_OUTBOX_ACTIVO:
+            try:
+                info['outbox_notificaciones'] = estadisticas_outbox()
+            except Exception as e:
+                info['outbox_notificaciones'] = {'error': str(e)}
+        info['resultados_precalculados'] = estadisticas_resultados()
+        
         return jsonify({'status': 'success', 'data': info}), 200
     except Exception as e:
         return jsonify({'error': f'Debug Firestore: {str(e)}'}), 500
@@ -2523,18 +5099,12 @@ def get_gastos_procesados_firebase(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos = []
         path_used = f'users/{usuario_id}/gastos'
         
-        # Path único: users/{uid}/gastos
-        try:
-            docs = db.collection('users').document(usuario_id).collection('gastos').stream()
-            for doc in docs:
-                gasto = doc.to_dict()
-                gasto['id'] = doc.id
-                gastos.append(gasto)
-        except Exception as e:
-            return jsonify({'error': f'Error leyendo gastos: {str(e)}'}), 500
+        # Path único: users/{uid}/gastos (snapshot en caché)
+        gastos, error = obtener_gastos_firebase(usuario_id)
+        if error:
+            return jsonify({'error': f'Error leyendo gastos: {error}'}), 500
         
         if not gastos:
             return jsonify({
@@ -2656,6 +5226,12 @@ def crear_gasto_firebase(usuario_id):
             except Exception as e:
                 return jsonify({'error': 'ID token inválido', 'detalle': str(e)}), 401
 
+        # Puntuar contra el historial antes de escribir (el estado aún no lo
+        # incluye). Solo con un detector ya construido: si no lo hay o caducó,
+        # no se puntúa y se construye en segundo plano tras la escritura
+        detector = _cache_obtener(_detectores_cache, usuario_id)
+        anomalia = evaluar_gasto(detector, categoria, gasto['cantidad']) if detector is not None else None
+        
         # Guardar en Firebase: path único users/{uid}/gastos
         path_used = f'users/{usuario_id}/gastos'
         try:
@@ -2665,12 +5241,37 @@ def crear_gasto_firebase(usuario_id):
         except Exception as e:
             return jsonify({'error': f'Error escribiendo en Firebase: {str(e)}'}), 500
         
+        # El snapshot en caché ya no refleja la colección
+        invalidar_cache_gastos(usuario_id)
+        invalidar_resultados(usuario_id)
+        if detector is not None:
+            registrar_gasto_detector(detector, categoria, gasto['cantidad'])
+        else:
+            # Se construye desde el snapshot ya invalidado, así que incluye este gasto
+            programar_construccion_detector(usuario_id)
+        sketches = _cache_obtener(_sketches_cache, usuario_id, contar=False)
+        if sketches is not None:
+            registrar_gasto_sketch(sketches, categoria, gasto['cantidad'])
+        # Acumulador del mes: si no estaba en caché se construye en segundo
+        # plano (ya con este gasto) y los umbrales se comprueban allí
+        acumulador = _cache_obtener(_acumuladores_cache, usuario_id, contar=False)
+        alerta_presupuesto = None
+        if acumulador is not None:
+            fecha_gasto = normalizar_fechas([gasto['fecha']])[0].iloc[0]
+            if not pd.isna(fecha_gasto):
+                registrar_gasto_acumulador(acumulador, fecha_gasto, gasto['cantidad'])
+            alerta_presupuesto = comprobar_umbrales_presupuesto(usuario_id, acumulador)
+        else:
+            programar_construccion_acumulador(usuario_id)
+        
         return jsonify({
             'status': 'success',
             'mensaje': 'Gasto creado correctamente',
             'gasto_id': doc_ref.id,
             'path_usado': path_used,
-            'data': gasto
+            'data': gasto,
+            'anomalia': anomalia,
+            'alerta_presupuesto': alerta_presupuesto
         }), 201
     except Exception as e:
         return jsonify({'error': f'Error creando gasto: {str(e)}'}), 500
@@ -2679,18 +5280,25 @@ def crear_gasto_firebase(usuario_id):
 @app.route('/api/v2/predict-category', methods=['GET'])
 @token_required
 def predict_category():
-    """Predicción separada por categoría (30 días). Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
+    """Predicción separada por categoría (?days=30 por defecto, máx. 365). Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        days, err_days = _leer_dias_prediccion()
+        if err_days:
+            return jsonify({'error': err_days}), 400
+        
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        predictions = predict_by_category(df, days=30)
+        predictions = pronostico_precalculado(usuario_id, df, days, 'por_categoria')
+        precalculado = predictions is not None
+        if not precalculado:
+            predictions = predict_by_category(df, days=days, usuario_id=usuario_id)
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
+            'precalculado': precalculado,
             'data': predictions
         }), 200
     except Exception as e:
@@ -2702,16 +5310,19 @@ def predict_category():
 def predict_monthly_endpoint():
     """Predicción mensual con 30 días. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        predictions = predict_monthly(df, days=30)
+        predictions = pronostico_precalculado(usuario_id, df, 30, 'mensual')
+        precalculado = predictions is not None
+        if not precalculado:
+            predictions = predict_monthly(df, days=30)
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
+            'precalculado': precalculado,
             'data': predictions
         }), 200
     except Exception as e:
@@ -2723,12 +5334,11 @@ def predict_monthly_endpoint():
 def detect_anomalies_endpoint():
     """Detección automática de anomalías. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        anomalies = detect_anomalies(df)
+        anomalies = detect_anomalies(df, usuario_id=usuario_id)
         
         return jsonify({
             'status': 'success',
@@ -2744,11 +5354,10 @@ def detect_anomalies_endpoint():
 def compare_models_endpoint():
     """Comparación de múltiples modelos ML. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         comparison = compare_models(df)
         
         return jsonify({
@@ -2765,11 +5374,10 @@ def compare_models_endpoint():
 def seasonality_endpoint():
     """Análisis de estacionalidad. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         seasonality = analyze_seasonality(df)
         
         return jsonify({
@@ -2786,18 +5394,18 @@ def seasonality_endpoint():
 def analysis_complete():
     """Análisis completo con las 5 mejoras. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'prediccion_categoria': predict_by_category(df),
-            'prediccion_mensual': predict_monthly(df),
-            'anomalias': detect_anomalies(df),
+            'prediccion_categoria': predict_by_category(df, usuario_id=usuario_id),
+            'prediccion_mensual': predict_monthly(df, cubo=cubo),
+            'anomalias': detect_anomalies(df, usuario_id=usuario_id),
             'comparacion_modelos': compare_models(df),
-            'estacionalidad': analyze_seasonality(df),
+            'estacionalidad': analyze_seasonality(df, cubo=cubo),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -2815,12 +5423,12 @@ def analysis_complete():
 def correlations_endpoint():
     """Análisis de correlaciones entre categorías. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        correlations = analyze_correlations(df)
+        p_valores, top_k = _leer_opciones_correlacion()
+        correlations = analyze_correlations(df, p_valores=p_valores, top_k=top_k)
         
         return jsonify({
             'status': 'success',
@@ -2836,11 +5444,10 @@ def correlations_endpoint():
 def temporal_comparison_endpoint():
     """Comparación mes actual vs anterior. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         comparison = analyze_temporal_comparison(df)
         
         return jsonify({
@@ -2857,13 +5464,15 @@ def temporal_comparison_endpoint():
 def clustering_endpoint():
     """Agrupamiento automático de gastos similares. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        n_clusters = request.args.get('n_clusters', 3, type=int)
-        if not expenses:
+        opciones, err_opciones = _leer_opciones_clustering()
+        if err_opciones:
+            return jsonify({'error': err_opciones}), 400
+        
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        clusters = perform_clustering(df, n_clusters=n_clusters)
+        clusters = perform_clustering(df, **opciones)
         
         return jsonify({
             'status': 'success',
@@ -2879,12 +5488,15 @@ def clustering_endpoint():
 def trends_endpoint():
     """Detección de tendencias en gastos. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
-        if not expenses:
+        opciones, err_opciones = _leer_opciones_tendencia()
+        if err_opciones:
+            return jsonify({'error': err_opciones}), 400
+        
+        df, usuario_id, err = _get_user_expenses_from_token()
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        trends = detect_trends(df)
+        trends = detect_trends(df, **opciones)
         
         return jsonify({
             'status': 'success',
@@ -2900,13 +5512,12 @@ def trends_endpoint():
 def outliers_endpoint():
     """Detección de gastos atípicos con IQR y Z-Score. Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
+        df, usuario_id, err = _get_user_expenses_from_token()
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        outliers = detect_outliers_iqr(df)
+        outliers = detect_outliers_iqr(df, usuario_id=usuario_id)
         
         return jsonify({
             'status': 'success',
@@ -2922,19 +5533,19 @@ def outliers_endpoint():
 def statistical_analysis_complete():
     """Análisis estadístico completo (todas las 5 mejoras). Carga automáticamente gastos del usuario. REQUIERE TOKEN."""
     try:
-        expenses, usuario_id, err = _get_user_expenses_from_token()
+        df, usuario_id, err = _get_user_expenses_from_token()
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'No hay gastos disponibles', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'correlaciones': analyze_correlations(df),
-            'comparacion_temporal': analyze_temporal_comparison(df),
+            'correlaciones': analyze_correlations(df, cubo=cubo),
+            'comparacion_temporal': analyze_temporal_comparison(df, cubo=cubo),
             'clustering': perform_clustering(df),
-            'tendencias': detect_trends(df),
-            'outliers': detect_outliers_iqr(df),
+            'tendencias': detect_trends(df, cubo=cubo),
+            'outliers': detect_outliers_iqr(df, usuario_id=usuario_id),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -2953,7 +5564,7 @@ def savings_goals_endpoint():
     """Calcular metas de ahorro personalizadas."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         goal_name = data.get('goal_name') or request.args.get('goal_name', 'Meta')
         target_amount = data.get('target_amount') or request.args.get('target_amount', 1000)
         months = data.get('months') or request.args.get('months', 12)
@@ -2966,10 +5577,9 @@ def savings_goals_endpoint():
         except Exception:
             months = 12
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         goals = calculate_savings_goals(df, goal_name, target_amount, months)
         
         return jsonify({
@@ -2986,12 +5596,11 @@ def personalized_tips_endpoint():
     """Generar tips personalizados de ahorro."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         tips = generate_personalized_tips(df)
         
         return jsonify({
@@ -3008,18 +5617,21 @@ def budget_alerts_endpoint():
     """Generar alertas de presupuesto."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         monthly_budget = data.get('monthly_budget') or request.args.get('monthly_budget', 3000)
         try:
             monthly_budget = float(monthly_budget)
         except Exception:
             monthly_budget = 3000
         
-        if not expenses:
+        proyeccion, err_proyeccion = _leer_opciones_presupuesto()
+        if err_proyeccion:
+            return jsonify({'error': err_proyeccion}), 400
+        
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
-        alerts = generate_budget_alerts(df, monthly_budget)
+        alerts = generate_budget_alerts(df, monthly_budget, proyeccion=proyeccion)
         
         return jsonify({
             'status': 'success',
@@ -3035,17 +5647,16 @@ def health_score_endpoint():
     """Calcular puntuación de salud financiera."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         monthly_budget = data.get('monthly_budget') or request.args.get('monthly_budget', 3000)
         try:
             monthly_budget = float(monthly_budget)
         except Exception:
             monthly_budget = 3000
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         score = calculate_financial_health_score(df, monthly_budget)
         
         return jsonify({
@@ -3062,12 +5673,11 @@ def weekly_report_endpoint():
     """Generar resumen semanal para reportes automáticos."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         report = generate_weekly_report(df)
         
         return jsonify({
@@ -3084,7 +5694,7 @@ def savings_analysis_complete():
     """Análisis completo de recomendaciones (todas las 5 mejoras)."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         goal_name = (data.get('goal_name') or request.args.get('goal_name') or 'Meta general')
         target_amount = (data.get('target_amount') or request.args.get('target_amount') or 5000)
         months = (data.get('months') or request.args.get('months') or 12)
@@ -3102,16 +5712,16 @@ def savings_analysis_complete():
         except Exception:
             monthly_budget = 3000
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'metas_ahorro': calculate_savings_goals(df, goal_name, target_amount, months),
-            'tips_personalizados': generate_personalized_tips(df),
-            'alertas_presupuesto': generate_budget_alerts(df, monthly_budget),
-            'salud_financiera': calculate_financial_health_score(df, monthly_budget),
+            'metas_ahorro': calculate_savings_goals(df, goal_name, target_amount, months, cubo=cubo),
+            'tips_personalizados': generate_personalized_tips(df, cubo=cubo),
+            'alertas_presupuesto': generate_budget_alerts(df, monthly_budget, cubo=cubo),
+            'salud_financiera': calculate_financial_health_score(df, monthly_budget, cubo=cubo),
             'reporte_semanal': generate_weekly_report(df),
             'timestamp': datetime.now().isoformat()
         }
@@ -3130,12 +5740,11 @@ def heatmap_endpoint():
     """Generar calendario de calor de gastos."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
         
-        df = prepare_dataframe(expenses)
         heatmap = generate_heatmap(df)
         
         return jsonify({
@@ -3152,10 +5761,9 @@ def sankey_endpoint():
     """Generar diagrama Sankey de flujo de dinero."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
-        if not expenses:
+        df, err = _get_expenses_or_firebase(data)
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         sankey = generate_sankey_diagram(df)
         
         return jsonify({
@@ -3172,10 +5780,9 @@ def dashboard_endpoint():
     """Generar dashboard interactivo."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
-        if not expenses:
+        df, err = _get_expenses_or_firebase(data)
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         dashboard = generate_interactive_dashboard(df)
         
         return jsonify({
@@ -3192,10 +5799,9 @@ def comparison_endpoint():
     """Generar gráficos comparativos mes vs mes."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
-        if not expenses:
+        df, err = _get_expenses_or_firebase(data)
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         comparison = generate_month_comparison_chart(df)
         
         return jsonify({
@@ -3212,11 +5818,10 @@ def export_graphics_endpoint():
     """Exportar gráficos como imágenes (JSON o BASE64)."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
+        df, err = _get_expenses_or_firebase(data)
         output_format = (data.get('format') or request.args.get('format') or 'json')
-        if not expenses:
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         exported = export_graphics_as_image(df, output_format)
         
         return jsonify({
@@ -3233,17 +5838,17 @@ def charts_complete():
     """Generar todos los gráficos disponibles."""
     try:
         data = request.get_json(silent=True) or {}
-        expenses, err = _get_expenses_or_firebase(data)
-        if not expenses:
+        df, err = _get_expenses_or_firebase(data)
+        if df is None:
             return jsonify({'error': 'Datos inválidos o no hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'heatmap': generate_heatmap(df),
-            'sankey': generate_sankey_diagram(df),
-            'dashboard': generate_interactive_dashboard(df),
-            'comparacion_meses': generate_month_comparison_chart(df),
-            'exportacion': export_graphics_as_image(df, 'json'),
+            'heatmap': generate_heatmap(df, cubo=cubo),
+            'sankey': generate_sankey_diagram(df, cubo=cubo),
+            'dashboard': generate_interactive_dashboard(df, cubo=cubo),
+            'comparacion_meses': generate_month_comparison_chart(df, cubo=cubo),
+            'exportacion': export_graphics_as_image(df, 'json', cubo=cubo),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -3327,6 +5932,209 @@ if __name__ == '__main__':
     print("="*80 + "\n")
 
 
+# ============================================================
+# 📦 PRONÓSTICOS POR LOTES (TODOS LOS USUARIOS)
+# ============================================================
+# Precalcula predict_monthly + predict_by_category de cada usuario de la
+# colección 'users' en un pool de procesos y guarda el resultado en
+# users/{id}/pronosticos/actual (o en un directorio local como JSON). Los
+# endpoints de predicción lo sirven mientras su huella coincida con la de los
+# gastos actuales; si está obsoleto calculan en vivo.
+# Ejecutar con: python pronosticos_lote.py --help
+
+PRONOSTICOS_COLECCION = os.getenv('PRONOSTICOS_COLECCION', 'pronosticos')
+PRONOSTICOS_DOCUMENTO = 'actual'
+LOTE_WORKERS = int(os.getenv('LOTE_WORKERS', os.cpu_count() or 1))
+# Segundos que se reutiliza en memoria el documento leído (o su ausencia)
+PRONOSTICOS_CACHE_TTL_SEGUNDOS = int(os.getenv('PRONOSTICOS_CACHE_TTL_SEGUNDOS', 300))
+
+_pronosticos_cache = _crear_cache_lru(GASTOS_CACHE_MAX_USUARIOS, PRONOSTICOS_CACHE_TTL_SEGUNDOS)
+
+
+def _a_nativo(valor):
+    """Convierte un resultado a tipos JSON/Firestore (claves str, escalares de Python)."""
+    if isinstance(valor, dict):
+        return {str(k): _a_nativo(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_a_nativo(v) for v in valor]
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, (pd.Timestamp, datetime)):
+        return valor.isoformat()
+    return valor
+
+
+def _inicializar_worker_lote():
+    """Los procesos del lote ya reparten el trabajo: dentro de cada uno se entrena en serie."""
+    global PREDICCION_WORKERS, _pool_modelos
+    PREDICCION_WORKERS = 1
+    _pool_modelos = None
+
+
+def pronosticar_gastos(gastos, dias=30):
+    """
+    Calcula los pronósticos de una lista de gastos (se ejecuta en el pool del lote).
+
+    Args:
+        gastos: Lista de dicts de gastos tal como están en Firestore
+        dias: Horizonte de predicción
+
+    Returns:
+        Dict serializable con 'mensual' y 'por_categoria', o None si no hay gastos válidos
+    """
+    df = construir_frame_gastos(gastos)
+    if df.empty:
+        return None
+    cubo = obtener_cubo_agregados(df)
+    return _a_nativo({
+        'mensual': predict_monthly(df, dias, cubo=cubo),
+        'por_categoria': predict_by_category(df, dias),
+        'dias': dias,
+        'huella': calcular_huella_frame(df),
+        'n_gastos': len(df),
+        'ultimo_gasto': df['fecha'].max(),
+        'calculado_en': datetime.now()
+    })
+
+
+def _ruta_pronostico(directorio, usuario_id):
+    nombre = hashlib.blake2b(str(usuario_id).encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(directorio, f'{nombre}.json')
+
+
+def guardar_pronostico(usuario_id, resultado, client=None, directorio=None):
+    """Guarda el pronóstico precalculado en Firestore o, si se indica, en un directorio local."""
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+        ruta = _ruta_pronostico(directorio, usuario_id)
+        temporal = f'{ruta}.{uuid.uuid4().hex}.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'usuario_id': usuario_id, **resultado}, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+        return
+    client = client or db
+    (client.collection('users').document(usuario_id)
+     .collection(PRONOSTICOS_COLECCION).document(PRONOSTICOS_DOCUMENTO).set(resultado))
+
+
+def leer_pronostico(usuario_id, client=None, directorio=None):
+    """Devuelve el pronóstico precalculado del usuario (o None si todavía no existe)."""
+    if directorio:
+        ruta = _ruta_pronostico(directorio, usuario_id)
+        if not os.path.exists(ruta):
+            return None
+        with open(ruta, encoding='utf-8') as f:
+            resultado = json.load(f)
+        resultado.pop('usuario_id', None)
+        return resultado
+    client = client or db
+    if not client:
+        return None
+    doc = (client.collection('users').document(usuario_id)
+           .collection(PRONOSTICOS_COLECCION).document(PRONOSTICOS_DOCUMENTO).get())
+    return doc.to_dict() if doc.exists else None
+
+
+def pronostico_precalculado(usuario_id, df, dias, parte):
+    """
+    Devuelve una parte ('mensual' o 'por_categoria') del pronóstico del lote si sigue vigente.
+
+    Solo se sirve para el frame completo del usuario (el de obtener_frame_gastos)
+    cuando el horizonte coincide y la huella guardada es la de los gastos
+    actuales. En cualquier otro caso devuelve None y el endpoint calcula en vivo.
+    """
+    huella = huella_registrada(df) if usuario_id and df is not None else None
+    if huella is None:
+        return None
+    guardado = _cache_obtener(_pronosticos_cache, usuario_id)
+    if guardado is None:
+        try:
+            guardado = leer_pronostico(usuario_id) or {}
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el pronóstico precalculado de {usuario_id}: {e}")
+            guardado = {}
+        _cache_guardar(_pronosticos_cache, usuario_id, guardado)
+    if guardado.get('huella') != huella or guardado.get('dias') != dias:
+        return None
+    return guardado.get(parte)
+
+
+def ejecutar_pronosticos_lote(client=None, dias=30, workers=None, directorio=None,
+                              usuarios=None, modo='process'):
+    """
+    Recalcula los pronósticos de todos los usuarios de la colección 'users'.
+
+    Los gastos se leen en el proceso principal (un usuario cada vez) y el
+    cálculo se reparte en un pool; como mucho hay 2 × workers usuarios en
+    vuelo, así que la memoria no crece con el número de usuarios.
+
+    Args:
+        client: Cliente Firestore (por defecto el global db; admite un doble en memoria)
+        dias: Horizonte de predicción
+        workers: Tamaño del pool (default: LOTE_WORKERS)
+        directorio: Si se indica, los resultados se guardan ahí como JSON en lugar de en Firestore
+        usuarios: Lista de IDs a procesar (default: todos los de 'users')
+        modo: 'process' o 'thread'
+
+    Returns:
+        Dict con el resumen de la ejecución
+    """
+    client = client or db
+    if not client:
+        raise RuntimeError('Firebase no disponible')
+    workers = max(1, workers or LOTE_WORKERS)
+    if usuarios is None:
+        usuarios = (doc.id for doc in client.collection('users').stream())
+
+    resumen = {'usuarios': 0, 'procesados': 0, 'sin_datos': 0, 'errores': {}}
+    inicio = time.monotonic()
+
+    if modo == 'process':
+        # spawn: el proceso principal ya tiene abierto el cliente gRPC de
+        # Firestore y no se puede heredar con fork; los workers solo calculan
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_inicializar_worker_lote,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lote')
+
+    def recoger(futuros):
+        for futuro in futuros:
+            usuario_id = en_vuelo.pop(futuro)
+            try:
+                resultado = futuro.result()
+                if resultado is None:
+                    resumen['sin_datos'] += 1
+                    continue
+                guardar_pronostico(usuario_id, resultado, client=client, directorio=directorio)
+                resumen['procesados'] += 1
+            except Exception as e:
+                resumen['errores'][usuario_id] = str(e)
+
+    en_vuelo = {}
+    with pool:
+        for usuario_id in usuarios:
+            resumen['usuarios'] += 1
+            try:
+                gastos = list(_leer_gastos_completo(client, usuario_id).values())
+            except Exception as e:
+                resumen['errores'][usuario_id] = str(e)
+                continue
+            if not gastos:
+                resumen['sin_datos'] += 1
+                continue
+            en_vuelo[pool.submit(pronosticar_gastos, gastos, dias)] = usuario_id
+            if len(en_vuelo) >= 2 * workers:
+                hechos, _ = wait(list(en_vuelo), return_when=FIRST_COMPLETED)
+                recoger(hechos)
+        recoger(list(en_vuelo))
+
+    resumen['segundos'] = round(time.monotonic() - inicio, 2)
+    return resumen
+
+
 # ============================================================
 # 🤖 ASESOR FINANCIERO IA - ENDPOINTS AVANZADOS
 # ============================================================
@@ -3337,24 +6145,61 @@ if __name__ == '__main__':
 # 4. Datos para gráficos interactivos
 # ============================================================
 
-def obtener_gastos_firebase(usuario_id):
-    """Obtiene todos los gastos de un usuario desde Firebase"""
+def _snapshot_gastos(usuario_id, usar_cache=True):
+    """
+    Devuelve (entrada, error) con el snapshot sincronizado de gastos del usuario.
+
+    Usa un snapshot en caché por usuario para que las peticiones en paralelo
+    de un mismo dashboard no vuelvan a leer toda la colección. Cuando el
+    snapshot envejece solo se consultan los gastos nuevos (createdAt).
+    """
     if not FIREBASE_AVAILABLE or not db:
         return None, "Firebase no disponible"
-    
-    try:
-        gastos_ref = db.collection('users').document(usuario_id).collection('gastos')
-        gastos_docs = gastos_ref.stream()
-        
-        gastos = []
-        for doc in gastos_docs:
-            gasto = doc.to_dict()
-            gasto['id'] = doc.id
-            gastos.append(gasto)
-        
-        return gastos, None
-    except Exception as e:
-        return None, str(e)
+
+    if usar_cache:
+        entrada = _cache_obtener(_gastos_cache, usuario_id)
+        if entrada is not None and _snapshot_gastos_vigente(entrada):
+            return entrada, None
+
+    with _lock_gastos_usuario(usuario_id):
+        # Otra petición pudo haber sincronizado mientras esperábamos
+        entrada = _cache_obtener(_gastos_cache, usuario_id, contar=False)
+        if usar_cache and entrada is not None and _snapshot_gastos_vigente(entrada):
+            return entrada, None
+
+        try:
+            entrada = sincronizar_gastos_usuario(usuario_id, entrada=entrada, completa=not usar_cache)
+        except Exception as e:
+            return None, str(e)
+
+        _cache_guardar(_gastos_cache, usuario_id, entrada)
+        return entrada, None
+
+
+def obtener_gastos_firebase(usuario_id, usar_cache=True):
+    """Obtiene todos los gastos de un usuario desde Firebase (lista de dicts)."""
+    entrada, error = _snapshot_gastos(usuario_id, usar_cache)
+    if error:
+        return None, error
+    return list(entrada['gastos'].values()), None
+
+
+def obtener_frame_gastos(usuario_id, usar_cache=True):
+    """
+    Obtiene el DataFrame tipado de gastos del usuario (ver construir_frame_gastos).
+
+    El frame se construye una vez por versión del snapshot y se comparte entre
+    peticiones: los análisis deben tratarlo como de solo lectura.
+    """
+    entrada, error = _snapshot_gastos(usuario_id, usar_cache)
+    if error:
+        return None, error
+    df = entrada.get('frame')
+    if df is None:
+        df = construir_frame_gastos(list(entrada['gastos'].values()))
+        registrar_huella_frame(df)
+        entrada['frame'] = df
+    return df, None
 
 
 def obtener_budget_usuario(usuario_id):
@@ -3364,6 +6209,7 @@ def obtener_budget_usuario(usuario_id):
     try:
         doc = db.collection('users').document(usuario_id).collection('budget').document('current').get()
         if not doc.exists:
+            _cache_guardar(_presupuestos_cache, usuario_id, {})
             return None, None
         data = doc.to_dict() or {}
         # Normalizar posibles nombres de campos
@@ -3372,6 +6218,7 @@ def obtener_budget_usuario(usuario_id):
             'monthly_income': data.get('monthly_income') or data.get('income') or data.get('monthlyIncome'),
             'currency': data.get('currency')
         }
+        _cache_guardar(_presupuestos_cache, usuario_id, budget_info)
         return budget_info, None
     except Exception as e:
         return None, str(e)
@@ -3402,6 +6249,321 @@ def procesar_fecha(fecha_str):
     return datetime.now()
 
 
+# Formatos aceptados por procesar_fecha junto con el patrón que los identifica
+_FORMATOS_FECHA = [
+    (r'^\d{4}-\d{1,2}-\d{1,2}T\d{1,2}:\d{1,2}:\d{1,2}\.\d{1,6}$', '%Y-%m-%dT%H:%M:%S.%f'),
+    (r'^\d{4}-\d{1,2}-\d{1,2}T\d{1,2}:\d{1,2}:\d{1,2}$', '%Y-%m-%dT%H:%M:%S'),
+    (r'^\d{4}-\d{1,2}-\d{1,2}$', '%Y-%m-%d'),
+    (r'^\d{1,2}/\d{1,2}/\d{4}$', '%d/%m/%Y'),
+    (r'^\d{1,2}-\d{1,2}-\d{4}$', '%d-%m-%Y')
+]
+
+
+def normalizar_fechas(valores):
+    """
+    Versión vectorizada de procesar_fecha para columnas completas.
+
+    Detecta el formato de cada valor, agrupa por formato y ejecuta
+    pd.to_datetime una sola vez por grupo. Los valores que no se pueden
+    interpretar quedan como NaT (no se sustituyen por la fecha actual).
+
+    Args:
+        valores: Serie o lista con fechas en texto, datetime o None
+
+    Returns:
+        Tupla (Serie datetime64 sin zona horaria, número de fechas inválidas)
+    """
+    serie = valores if isinstance(valores, pd.Series) else pd.Series(list(valores), dtype=object)
+
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        fechas = serie.dt.tz_convert(None) if serie.dt.tz is not None else serie
+        return fechas, int(fechas.isna().sum())
+
+    fechas = pd.Series(pd.NaT, index=serie.index, dtype='datetime64[ns]')
+
+    # datetime / Timestamp de Firestore: conversión directa (a UTC sin zona)
+    es_datetime = serie.map(lambda v: isinstance(v, datetime)).astype(bool)
+    if es_datetime.any():
+        fechas[es_datetime] = pd.to_datetime(serie[es_datetime], utc=True).dt.tz_convert(None)
+
+    # Texto: mismo recorte a 26 caracteres que procesar_fecha
+    es_texto = serie.map(lambda v: isinstance(v, str)).astype(bool)
+    if es_texto.any():
+        texto = serie[es_texto].str.slice(0, 26)
+        pendiente = pd.Series(True, index=texto.index)
+        for patron, formato in _FORMATOS_FECHA:
+            mascara = pendiente & texto.str.match(patron)
+            if mascara.any():
+                fechas[mascara[mascara].index] = pd.to_datetime(texto[mascara], format=formato, errors='coerce')
+                pendiente &= ~mascara
+        # Resto de variantes ISO 8601 (espacio como separador, zona horaria...)
+        if pendiente.any():
+            resto = pd.to_datetime(texto[pendiente], format='ISO8601', errors='coerce', utc=True)
+            fechas[resto.index] = resto.dt.tz_convert(None)
+
+    return fechas, int(fechas.isna().sum())
+
+
+# ============================================================
+# 🗄️ RESULTADOS PRECALCULADOS (STALE-WHILE-REVALIDATE)
+# ============================================================
+# Los endpoints pesados guardan su resultado junto a la huella de los datos
+# de entrada. Si la huella coincide se sirve tal cual; si los gastos cambiaron
+# se sirve el resultado anterior marcado como obsoleto y se recalcula en
+# segundo plano. Crear un gasto lanza ya el recálculo, y durante
+# RESULTADOS_VERIFICACION_SEGUNDOS un resultado comprobado se sirve sin volver
+# a construir el frame ni leer el budget. Se persiste en
+# users/{id}/resultados/{endpoint} (troceado en la subcolección 'partes' para
+# no superar el límite de 1 MiB por documento) para que otros workers y
+# reinicios lo aprovechen.
+
+RESULTADOS_CACHE_MAX = int(os.getenv('RESULTADOS_CACHE_MAX', 256))
+RESULTADOS_PERSISTIR = os.getenv('RESULTADOS_PERSISTIR', 'true').lower() == 'true'
+RESULTADOS_WORKERS = int(os.getenv('RESULTADOS_WORKERS', 1))
+# Mismo margen que el snapshot de gastos: los cambios hechos desde otro worker
+# o fuera de la API se ven, como mucho, pasado este tiempo
+RESULTADOS_VERIFICACION_SEGUNDOS = int(os.getenv('RESULTADOS_VERIFICACION_SEGUNDOS', GASTOS_CACHE_TTL_SEGUNDOS))
+# Tamaño de cada trozo persistido y tope total (los informes mayores solo se guardan en memoria)
+RESULTADOS_BYTES_PARTE = 900 * 1024
+RESULTADOS_MAX_BYTES = int(os.getenv('RESULTADOS_MAX_BYTES', 4 * 1024 * 1024))
+RESULTADOS_COLECCION = 'resultados'
+
+_resultados_cache = _crear_cache_lru(RESULTADOS_CACHE_MAX)
+
+_resultados_stats = {
+    'servidos_frescos': 0,
+    'servidos_obsoletos': 0,
+    'calculos_sincronos': 0,
+    'revalidaciones': 0,
+    'errores_revalidacion': 0,
+    'errores_persistencia': 0,
+    'no_persistidos_por_tamaño': 0
+}
+
+_revalidando = set()
+_revalidacion_pendiente = set()
+_revalidando_lock = threading.Lock()
+_pool_revalidacion = None
+# endpoint -> recalcular(usuario_id); se registra al servir cada resultado
+_recalculadores_resultados = {}
+
+
+def huella_frame(df):
+    """Huella del contenido de un frame de gastos (la registrada si es un frame compartido)."""
+    return huella_registrada(df) or calcular_huella_frame(df)
+
+
+def huella_resultado(df, *extras):
+    """Huella de un resultado: datos de gastos más cualquier otra entrada (budget...)."""
+    h = hashlib.blake2b(huella_frame(df).encode(), digest_size=16)
+    for extra in extras:
+        h.update(json.dumps(extra, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _doc_resultado(usuario_id, endpoint):
+    return db.collection('users').document(usuario_id).collection(RESULTADOS_COLECCION).document(endpoint)
+
+
+def _leer_resultado(usuario_id, endpoint):
+    """Resultado guardado (memoria y, si no está, Firestore) o None."""
+    entrada = _cache_obtener(_resultados_cache, (usuario_id, endpoint))
+    if entrada is not None or not RESULTADOS_PERSISTIR or not db:
+        return entrada
+    try:
+        doc_ref = _doc_resultado(usuario_id, endpoint)
+        doc = doc_ref.get()
+        if not doc.exists:
+            return None
+        datos = doc.to_dict()
+        if 'resultado' in datos:
+            texto = datos['resultado']
+        else:
+            partes = db.get_all([
+                doc_ref.collection('partes').document(str(i)) for i in range(datos['partes'])
+            ])
+            trozos = {p.id: (p.to_dict() or {}) for p in partes if p.exists}
+            if len(trozos) != datos['partes'] or any(
+                t.get('calculado_en') != datos['calculado_en'] for t in trozos.values()
+            ):
+                return None
+            texto = ''.join(trozos[str(i)]['datos'] for i in range(datos['partes']))
+        entrada = {
+            'huella': datos['huella'],
+            'calculado_en': datos['calculado_en'],
+            'verificado': None,
+            'resultado': json.loads(texto)
+        }
+    except Exception as e:
+        _resultados_stats['errores_persistencia'] += 1
+        print(f"⚠️ No se pudo leer el resultado {endpoint} de {usuario_id}: {e}")
+        return None
+    _cache_guardar(_resultados_cache, (usuario_id, endpoint), entrada)
+    return entrada
+
+
+def _persistir_resultado(usuario_id, endpoint, entrada):
+    """Escribe el resultado en Firestore troceado en documentos de RESULTADOS_BYTES_PARTE."""
+    # Como texto JSON ASCII: Firestore no admite arrays anidados ni claves no
+    # str, y así cada carácter ocupa un byte al trocear
+    texto = json.dumps(_a_nativo(entrada['resultado']))
+    if len(texto) > RESULTADOS_MAX_BYTES:
+        _resultados_stats['no_persistidos_por_tamaño'] += 1
+        print(f"⚠️ Resultado {endpoint} de {usuario_id} demasiado grande para persistir "
+              f"({len(texto)} bytes > {RESULTADOS_MAX_BYTES}); solo queda en memoria")
+        return
+    trozos = [texto[i:i + RESULTADOS_BYTES_PARTE] for i in range(0, len(texto), RESULTADOS_BYTES_PARTE)] or ['']
+    doc_ref = _doc_resultado(usuario_id, endpoint)
+    # Un solo batch: el documento principal y sus partes cambian a la vez
+    batch = db.batch()
+    for i, trozo in enumerate(trozos):
+        batch.set(doc_ref.collection('partes').document(str(i)), {
+            'datos': trozo,
+            'calculado_en': entrada['calculado_en']
+        })
+    batch.set(doc_ref, {
+        'huella': entrada['huella'],
+        'calculado_en': entrada['calculado_en'],
+        'partes': len(trozos)
+    })
+    batch.commit()
+
+
+def guardar_resultado(usuario_id, endpoint, huella, resultado):
+    """Guarda un resultado recién calculado en memoria y, si está activado, en Firestore."""
+    entrada = {
+        'huella': huella,
+        'calculado_en': time.time(),
+        'verificado': time.monotonic(),
+        'resultado': resultado
+    }
+    _cache_guardar(_resultados_cache, (usuario_id, endpoint), entrada)
+    if RESULTADOS_PERSISTIR and db:
+        try:
+            _persistir_resultado(usuario_id, endpoint, entrada)
+        except Exception as e:
+            _resultados_stats['errores_persistencia'] += 1
+            print(f"⚠️ No se pudo persistir el resultado {endpoint} de {usuario_id}: {e}")
+    return entrada
+
+
+def _revalidar_resultado(usuario_id, endpoint, recalcular):
+    clave = (usuario_id, endpoint)
+    try:
+        calculado = recalcular(usuario_id)
+        if calculado is not None:
+            huella, resultado = calculado
+            guardar_resultado(usuario_id, endpoint, huella, resultado)
+            _resultados_stats['revalidaciones'] += 1
+    except Exception as e:
+        _resultados_stats['errores_revalidacion'] += 1
+        print(f"⚠️ Error recalculando {endpoint} de {usuario_id}: {e}")
+    finally:
+        with _revalidando_lock:
+            repetir = clave in _revalidacion_pendiente
+            _revalidacion_pendiente.discard(clave)
+            if not repetir:
+                _revalidando.discard(clave)
+    if repetir:
+        # Llegaron gastos nuevos mientras se calculaba: otra pasada con ellos
+        _pool_revalidacion.submit(_revalidar_resultado, usuario_id, endpoint, recalcular)
+
+
+def _programar_revalidacion(usuario_id, endpoint, recalcular):
+    """Encola el recálculo en segundo plano (como mucho uno en vuelo por usuario y endpoint)."""
+    global _pool_revalidacion
+    clave = (usuario_id, endpoint)
+    with _revalidando_lock:
+        if clave in _revalidando:
+            _revalidacion_pendiente.add(clave)
+            return
+        _revalidando.add(clave)
+        if _pool_revalidacion is None:
+            _pool_revalidacion = ThreadPoolExecutor(
+                max_workers=max(1, RESULTADOS_WORKERS),
+                thread_name_prefix='revalidacion'
+            )
+    _pool_revalidacion.submit(_revalidar_resultado, usuario_id, endpoint, recalcular)
+
+
+def invalidar_resultados(usuario_id):
+    """
+    Marca como no verificados los resultados en memoria del usuario y los
+    recalcula en segundo plano (se llama desde las escrituras de gastos).
+    """
+    for endpoint, recalcular in list(_recalculadores_resultados.items()):
+        entrada = _cache_obtener(_resultados_cache, (usuario_id, endpoint), contar=False)
+        if entrada is None:
+            continue
+        entrada['verificado'] = None
+        _programar_revalidacion(usuario_id, endpoint, recalcular)
+
+
+def _meta_resultado(entrada, stale):
+    return {
+        'computed_at': datetime.fromtimestamp(entrada['calculado_en']).isoformat(),
+        'stale': stale,
+        'edad_segundos': round(time.time() - entrada['calculado_en'], 1)
+    }
+
+
+def resultado_verificado(usuario_id, endpoint):
+    """
+    Devuelve (resultado, meta) si hay un resultado en memoria comprobado hace
+    menos de RESULTADOS_VERIFICACION_SEGUNDOS y sin escrituras posteriores;
+    None si hay que calcular la huella (ver servir_resultado).
+    """
+    entrada = _cache_obtener(_resultados_cache, (usuario_id, endpoint), contar=False)
+    if entrada is None or entrada.get('verificado') is None:
+        return None
+    if time.monotonic() - entrada['verificado'] > RESULTADOS_VERIFICACION_SEGUNDOS:
+        return None
+    _resultados_stats['servidos_frescos'] += 1
+    return entrada['resultado'], _meta_resultado(entrada, False)
+
+
+def servir_resultado(usuario_id, endpoint, huella, calcular, recalcular):
+    """
+    Devuelve (resultado, meta) aplicando stale-while-revalidate.
+
+    Args:
+        usuario_id: ID del usuario
+        endpoint: Nombre del resultado (clave junto al usuario)
+        huella: Huella de los datos actuales (ver huella_resultado)
+        calcular: Función sin argumentos que calcula el resultado con los datos actuales
+        recalcular: Función(usuario_id) -> (huella, resultado) o None, para el segundo plano
+
+    Returns:
+        Tupla (resultado, meta) donde meta incluye computed_at, stale y edad_segundos
+    """
+    _recalculadores_resultados[endpoint] = recalcular
+    entrada = _leer_resultado(usuario_id, endpoint)
+    stale = False
+    if entrada is None:
+        entrada = guardar_resultado(usuario_id, endpoint, huella, calcular())
+        _resultados_stats['calculos_sincronos'] += 1
+    elif entrada['huella'] == huella:
+        entrada['verificado'] = time.monotonic()
+        _resultados_stats['servidos_frescos'] += 1
+    else:
+        stale = True
+        _resultados_stats['servidos_obsoletos'] += 1
+        _programar_revalidacion(usuario_id, endpoint, recalcular)
+
+    return entrada['resultado'], _meta_resultado(entrada, stale)
+
+
+def estadisticas_resultados():
+    """Uso del almacén de resultados precalculados."""
+    return {
+        **_cache_estadisticas(_resultados_cache),
+        'persistencia': RESULTADOS_PERSISTIR,
+        'verificacion_segundos': RESULTADOS_VERIFICACION_SEGUNDOS,
+        'revalidando': len(_revalidando),
+        **_resultados_stats
+    }
+
+
 @app.route('/api/v2/firebase/users/<usuario_id>/asesor-financiero', methods=['GET'])
 @token_required
 def asesor_financiero_completo(usuario_id):
@@ -3413,77 +6575,51 @@ def asesor_financiero_completo(usuario_id):
     - Análisis estadístico completo
     - Recomendaciones personalizadas de ahorro
     - Datos preparados para gráficos
+    
+    El informe se guarda junto a la huella de gastos y budget: mientras no
+    cambien se sirve sin recalcular, y si cambian se devuelve el anterior
+    (stale=true) mientras se recalcula en segundo plano. Crear un gasto lanza
+    el recálculo de inmediato. La respuesta incluye computed_at, stale y
+    edad_segundos.
     """
     if not FIREBASE_AVAILABLE:
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        # Obtener gastos de Firebase
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        # Informe comprobado hace poco y sin gastos nuevos: no hace falta ni el frame
+        verificado = resultado_verificado(usuario_id, 'asesor-financiero')
+        if verificado is not None:
+            resultado, meta = verificado
+            return jsonify({**resultado, **meta}), 200
+        
+        # Obtener gastos de Firebase (frame tipado compartido)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': f'Error obteniendo gastos: {error}'}), 500
         
-        if not gastos or len(gastos) < 3:
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        total_registrados = len(df) + fechas_invalidas
+        if total_registrados < 3:
             return jsonify({
                 'status': 'error',
                 'mensaje': 'Se necesitan al menos 3 gastos registrados para el análisis',
-                'gastos_actuales': len(gastos) if gastos else 0
+                'gastos_actuales': total_registrados
+            }), 400
+        if len(df) < 3:
+            return jsonify({
+                'status': 'error',
+                'mensaje': 'Se necesitan al menos 3 gastos con fecha válida para el análisis',
+                'gastos_actuales': total_registrados,
+                'fechas_invalidas': fechas_invalidas
             }), 400
         
-        # Convertir a DataFrame
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
-        df['mes'] = df['fecha'].dt.month
-        df['año'] = df['fecha'].dt.year
-        df['dia_semana'] = df['fecha'].dt.dayofweek
-        df['dia_mes'] = df['fecha'].dt.day
-        df['semana'] = df['fecha'].dt.isocalendar().week
-        
-        # ============================================
-        # 1. PREDICCIÓN DE GASTOS FUTUROS
-        # ============================================
-        predicciones = generar_predicciones(df)
-        
-        # ============================================
-        # 2. ANÁLISIS ESTADÍSTICO
-        # ============================================
-        analisis = generar_analisis_estadistico(df)
-        
-        # ============================================
-        # 3. RECOMENDACIONES DE AHORRO
-        # ============================================
         budget_info, _ = obtener_budget_usuario(usuario_id)
-        recomendaciones = generar_recomendaciones(df, analisis, budget_info=budget_info, predicciones=predicciones)
-        
-        # ============================================
-        # 4. DATOS PARA GRÁFICOS
-        # ============================================
-        graficos = preparar_datos_graficos(df)
-        
-        # Puntuación financiera (gamificación)
-        score = calcular_score_financiero(df, analisis)
-        
-        return jsonify({
-            'status': 'success',
-            'usuario_id': usuario_id,
-            'fecha_analisis': datetime.now().isoformat(),
-            'resumen': {
-                'total_gastos_registrados': len(gastos),
-                'gasto_total': round(df['cantidad'].sum(), 2),
-                'gasto_promedio': round(df['cantidad'].mean(), 2),
-                'periodo_analizado': {
-                    'desde': df['fecha'].min().strftime('%Y-%m-%d'),
-                    'hasta': df['fecha'].max().strftime('%Y-%m-%d'),
-                    'dias': (df['fecha'].max() - df['fecha'].min()).days
-                }
-            },
-            'score_financiero': score,
-            'predicciones': predicciones,
-            'analisis_estadistico': analisis,
-            'recomendaciones': recomendaciones,
-            'graficos': graficos
-        }), 200
+        resultado, meta = servir_resultado(
+            usuario_id, 'asesor-financiero', huella_resultado(df, budget_info),
+            lambda: calcular_asesor_financiero(usuario_id, df, budget_info),
+            _recalcular_asesor_financiero
+        )
+        return jsonify({**resultado, **meta}), 200
         
     except Exception as e:
         import traceback
@@ -3493,7 +6629,69 @@ def asesor_financiero_completo(usuario_id):
         }), 500
 
 
-def generar_predicciones(df):
+def calcular_asesor_financiero(usuario_id, df, budget_info=None):
+    """Calcula el informe completo del asesor financiero a partir del frame de gastos."""
+    fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+    
+    # Agregados compartidos por todas las secciones
+    cubo = obtener_cubo_agregados(df)
+    
+    # ============================================
+    # 1. PREDICCIÓN DE GASTOS FUTUROS
+    # ============================================
+    predicciones = generar_predicciones(df, cubo=cubo)
+    
+    # ============================================
+    # 2. ANÁLISIS ESTADÍSTICO
+    # ============================================
+    analisis = generar_analisis_estadistico(df, cubo=cubo, usuario_id=usuario_id)
+    
+    # ============================================
+    # 3. RECOMENDACIONES DE AHORRO
+    # ============================================
+    recomendaciones = generar_recomendaciones(df, analisis, budget_info=budget_info, predicciones=predicciones, cubo=cubo)
+    
+    # ============================================
+    # 4. DATOS PARA GRÁFICOS
+    # ============================================
+    graficos = preparar_datos_graficos(df, cubo=cubo)
+    
+    # Puntuación financiera (gamificación)
+    score = calcular_score_financiero(df, analisis)
+    
+    return {
+        'status': 'success',
+        'usuario_id': usuario_id,
+        'fecha_analisis': datetime.now().isoformat(),
+        'resumen': {
+            'total_gastos_registrados': len(df) + fechas_invalidas,
+            'fechas_invalidas': fechas_invalidas,
+            'gasto_total': round(cubo['total'], 2),
+            'gasto_promedio': round(cubo['media'], 2),
+            'periodo_analizado': {
+                'desde': df['fecha'].min().strftime('%Y-%m-%d'),
+                'hasta': df['fecha'].max().strftime('%Y-%m-%d'),
+                'dias': (df['fecha'].max() - df['fecha'].min()).days
+            }
+        },
+        'score_financiero': score,
+        'predicciones': predicciones,
+        'analisis_estadistico': analisis,
+        'recomendaciones': recomendaciones,
+        'graficos': graficos
+    }
+
+
+def _recalcular_asesor_financiero(usuario_id):
+    """Recalcula el asesor con los gastos y el budget actuales (segundo plano)."""
+    df, error = obtener_frame_gastos(usuario_id)
+    if error or len(df) < 3:
+        return None
+    budget_info, _ = obtener_budget_usuario(usuario_id)
+    return huella_resultado(df, budget_info), calcular_asesor_financiero(usuario_id, df, budget_info)
+
+
+def generar_predicciones(df, cubo=None):
     """Genera predicciones de gastos futuros"""
     predicciones = {
         'proximo_mes': {},
@@ -3503,21 +6701,21 @@ def generar_predicciones(df):
     }
     
     try:
+        cubo = cubo or obtener_cubo_agregados(df)
+        por_dia = cubo['por_dia']['total']
+        
         # Gasto diario promedio
-        dias_unicos = df['fecha'].dt.date.nunique()
-        gasto_diario = df['cantidad'].sum() / max(dias_unicos, 1)
+        dias_unicos = len(por_dia)
+        gasto_diario = cubo['total'] / max(dias_unicos, 1)
         
         # Predicción próximo mes (30 días)
         prediccion_mes = round(gasto_diario * 30, 2)
         
-        # Calcular tendencia usando regresión
-        df_agrupado = df.groupby(df['fecha'].dt.date)['cantidad'].sum().reset_index()
-        df_agrupado['dias'] = range(len(df_agrupado))
-        
+        # Calcular tendencia usando regresión sobre los totales diarios
         tendencia_valor = 0
-        if len(df_agrupado) >= 3:
-            X = df_agrupado['dias'].values.reshape(-1, 1)
-            y = df_agrupado['cantidad'].values
+        if len(por_dia) >= 3:
+            X = np.arange(len(por_dia)).reshape(-1, 1)
+            y = por_dia.values
             modelo = LinearRegression()
             modelo.fit(X, y)
             tendencia_valor = modelo.coef_[0]
@@ -3542,23 +6740,19 @@ def generar_predicciones(df):
         predicciones['tendencia'] = tendencia
         
         # Predicción por categoría
-        for categoria in df['categoria'].unique():
-            df_cat = df[df['categoria'] == categoria]
-            dias_cat = df_cat['fecha'].dt.date.nunique()
-            gasto_cat_diario = df_cat['cantidad'].sum() / max(dias_cat, 1)
+        por_categoria = cubo['por_categoria']
+        for categoria, fila in por_categoria.iterrows():
+            gasto_cat_diario = fila['total'] / max(fila['dias'], 1)
             predicciones['por_categoria'][categoria] = {
                 'prediccion_30_dias': round(gasto_cat_diario * 30, 2),
-                'promedio_por_gasto': round(df_cat['cantidad'].mean(), 2),
-                'total_registros': len(df_cat)
+                'promedio_por_gasto': round(fila['promedio'], 2),
+                'total_registros': int(fila['n'])
             }
         
         # Alertas de gastos altos
-        gasto_promedio = df['cantidad'].mean()
-        gasto_std = df['cantidad'].std()
-        umbral = gasto_promedio + (1.5 * gasto_std)
+        umbral = cubo['media'] + (1.5 * cubo['desviacion'])
         
-        for categoria in df['categoria'].unique():
-            gasto_cat = df[df['categoria'] == categoria]['cantidad'].mean()
+        for categoria, gasto_cat in por_categoria['promedio'].items():
             if gasto_cat > umbral:
                 predicciones['alerta_gastos'].append({
                     'categoria': categoria,
@@ -3573,7 +6767,7 @@ def generar_predicciones(df):
     return predicciones
 
 
-def generar_analisis_estadistico(df):
+def generar_analisis_estadistico(df, cubo=None, usuario_id=None):
     """Genera análisis estadístico completo"""
     analisis = {
         'por_categoria': {},
@@ -3587,64 +6781,73 @@ def generar_analisis_estadistico(df):
     }
     
     try:
+        cubo = cubo or obtener_cubo_agregados(df)
+        gasto_total = cubo['total']
+        
         # Análisis por categoría
-        for categoria in df['categoria'].unique():
-            df_cat = df[df['categoria'] == categoria]
+        for categoria, fila in cubo['por_categoria'].iterrows():
             analisis['por_categoria'][categoria] = {
-                'total': round(df_cat['cantidad'].sum(), 2),
-                'promedio': round(df_cat['cantidad'].mean(), 2),
-                'maximo': round(df_cat['cantidad'].max(), 2),
-                'minimo': round(df_cat['cantidad'].min(), 2),
-                'desviacion': round(df_cat['cantidad'].std(), 2) if len(df_cat) > 1 else 0,
-                'cantidad_gastos': len(df_cat),
-                'porcentaje_total': round((df_cat['cantidad'].sum() / df['cantidad'].sum()) * 100, 2)
+                'total': round(fila['total'], 2),
+                'promedio': round(fila['promedio'], 2),
+                'maximo': round(fila['maximo'], 2),
+                'minimo': round(fila['minimo'], 2),
+                'desviacion': round(fila['desviacion'], 2) if fila['n'] > 1 else 0,
+                'cantidad_gastos': int(fila['n']),
+                'porcentaje_total': round((fila['total'] / gasto_total) * 100, 2)
             }
         
-        # Análisis por mes
+        # Análisis por mes, año y trimestre a partir de los totales mes×categoría
         dias_semana = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
         meses = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
                  'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
         
-        for mes in df['mes'].unique():
-            df_mes = df[df['mes'] == mes]
+        mes_categoria = cubo['por_mes_categoria'].reset_index()
+        periodos = mes_categoria['año_mes'].dt
+        
+        def _resumen_periodo(claves):
+            resumen = {}
+            for clave, grupo in mes_categoria.groupby(claves, sort=False):
+                total = grupo['total'].sum()
+                n = grupo['n'].sum()
+                top = grupo.groupby('categoria', observed=True)['total'].sum().idxmax()
+                resumen[clave] = (total, n, top)
+            return resumen
+        
+        for mes, (total, n, top) in _resumen_periodo(periodos.month.rename('mes')).items():
             nombre_mes = meses[int(mes) - 1] if 1 <= mes <= 12 else f'Mes {mes}'
             analisis['por_mes'][nombre_mes] = {
-                'total': round(df_mes['cantidad'].sum(), 2),
-                'promedio': round(df_mes['cantidad'].mean(), 2),
-                'cantidad_gastos': len(df_mes),
-                'categoria_top': df_mes.groupby('categoria')['cantidad'].sum().idxmax() if len(df_mes) > 0 else None
+                'total': round(total, 2),
+                'promedio': round(total / n, 2),
+                'cantidad_gastos': int(n),
+                'categoria_top': top
             }
 
         # Análisis por año
-        for year in df['año'].unique():
-            df_year = df[df['año'] == year]
+        for year, (total, n, top) in _resumen_periodo(periodos.year.rename('año')).items():
             analisis['por_año'][str(int(year))] = {
-                'total': round(df_year['cantidad'].sum(), 2),
-                'promedio': round(df_year['cantidad'].mean(), 2),
-                'cantidad_gastos': len(df_year),
-                'categoria_top': df_year.groupby('categoria')['cantidad'].sum().idxmax() if len(df_year) > 0 else None
+                'total': round(total, 2),
+                'promedio': round(total / n, 2),
+                'cantidad_gastos': int(n),
+                'categoria_top': top
             }
 
         # Análisis por trimestre
-        df['trimestre_num'] = df['fecha'].dt.quarter
-        df['trimestre_label'] = df['año'].astype(str) + '-Q' + df['trimestre_num'].astype(str)
-        for tlabel in df['trimestre_label'].unique():
-            df_tri = df[df['trimestre_label'] == tlabel]
+        trimestre_label = (periodos.year.astype(str) + '-Q' + periodos.quarter.astype(str)).rename('trimestre')
+        for tlabel, (total, n, top) in _resumen_periodo(trimestre_label).items():
             analisis['por_trimestre'][tlabel] = {
-                'total': round(df_tri['cantidad'].sum(), 2),
-                'promedio': round(df_tri['cantidad'].mean(), 2),
-                'cantidad_gastos': len(df_tri),
-                'categoria_top': df_tri.groupby('categoria')['cantidad'].sum().idxmax() if len(df_tri) > 0 else None
+                'total': round(total, 2),
+                'promedio': round(total / n, 2),
+                'cantidad_gastos': int(n),
+                'categoria_top': top
             }
         
         # Análisis por día de semana
-        for dia in df['dia_semana'].unique():
-            df_dia = df[df['dia_semana'] == dia]
+        for dia, fila in cubo['por_dia_semana'].iterrows():
             nombre_dia = dias_semana[int(dia)] if 0 <= dia <= 6 else f'Día {dia}'
             analisis['por_dia_semana'][nombre_dia] = {
-                'total': round(df_dia['cantidad'].sum(), 2),
-                'promedio': round(df_dia['cantidad'].mean(), 2),
-                'cantidad_gastos': len(df_dia)
+                'total': round(fila['total'], 2),
+                'promedio': round(fila['promedio'], 2),
+                'cantidad_gastos': int(fila['n'])
             }
         
         # Comparativa mes actual vs anterior
@@ -3652,8 +6855,6 @@ def generar_analisis_estadistico(df):
         mes_actual = hoy.month
         año_actual = hoy.year
         
-        df_mes_actual = df[(df['mes'] == mes_actual) & (df['año'] == año_actual)]
-        
         if mes_actual == 1:
             mes_anterior = 12
             año_anterior = año_actual - 1
@@ -3661,10 +6862,11 @@ def generar_analisis_estadistico(df):
             mes_anterior = mes_actual - 1
             año_anterior = año_actual
         
-        df_mes_anterior = df[(df['mes'] == mes_anterior) & (df['año'] == año_anterior)]
-        
-        gasto_actual = df_mes_actual['cantidad'].sum()
-        gasto_anterior = df_mes_anterior['cantidad'].sum()
+        por_mes = cubo['por_mes']
+        periodo_actual = pd.Period(year=año_actual, month=mes_actual, freq='M')
+        periodo_anterior = pd.Period(year=año_anterior, month=mes_anterior, freq='M')
+        gasto_actual = por_mes['total'].get(periodo_actual, 0.0)
+        gasto_anterior = por_mes['total'].get(periodo_anterior, 0.0)
         
         if gasto_anterior > 0:
             variacion = ((gasto_actual - gasto_anterior) / gasto_anterior) * 100
@@ -3675,43 +6877,42 @@ def generar_analisis_estadistico(df):
             'mes_actual': {
                 'nombre': meses[mes_actual - 1],
                 'total': round(gasto_actual, 2),
-                'cantidad_gastos': len(df_mes_actual)
+                'cantidad_gastos': int(por_mes['n'].get(periodo_actual, 0))
             },
             'mes_anterior': {
                 'nombre': meses[mes_anterior - 1],
                 'total': round(gasto_anterior, 2),
-                'cantidad_gastos': len(df_mes_anterior)
+                'cantidad_gastos': int(por_mes['n'].get(periodo_anterior, 0))
             },
             'variacion_porcentaje': round(variacion, 2),
             'tendencia': 'AUMENTO' if variacion > 5 else 'DISMINUCIÓN' if variacion < -5 else 'ESTABLE'
         }
         
         # Detectar outliers (gastos inusuales)
-        Q1 = df['cantidad'].quantile(0.25)
-        Q3 = df['cantidad'].quantile(0.75)
+        Q1, Q3 = cuantiles_gastos(df, [0.25, 0.75], usuario_id)
         IQR = Q3 - Q1
         umbral_superior = Q3 + 1.5 * IQR
         
-        outliers_df = df[df['cantidad'] > umbral_superior]
+        outliers_df = df[df['monto'] > umbral_superior]
         for _, row in outliers_df.iterrows():
             analisis['outliers'].append({
                 'categoria': row['categoria'],
-                'cantidad': round(row['cantidad'], 2),
+                'cantidad': round(row['monto'], 2),
                 'fecha': row['fecha'].strftime('%Y-%m-%d'),
                 'descripcion': row.get('descripcion', ''),
                 'motivo': 'Gasto significativamente mayor al promedio'
             })
         
         # Patrones detectados
-        dia_mas_gasto = df.groupby('dia_semana')['cantidad'].sum().idxmax()
-        categoria_mas_frecuente = df['categoria'].value_counts().idxmax()
+        dia_mas_gasto = cubo['por_dia_semana']['total'].idxmax()
+        categoria_mas_frecuente = cubo['por_categoria']['n'].idxmax()
         hora_pico = None  # Si tuviéramos hora
         
         analisis['patrones'] = {
             'dia_mas_gastos': dias_semana[int(dia_mas_gasto)] if 0 <= dia_mas_gasto <= 6 else 'N/A',
             'categoria_mas_frecuente': categoria_mas_frecuente,
-            'gasto_promedio_general': round(df['cantidad'].mean(), 2),
-            'gasto_mediano': round(df['cantidad'].median(), 2)
+            'gasto_promedio_general': round(cubo['media'], 2),
+            'gasto_mediano': round(cubo['mediana'], 2)
         }
         
     except Exception as e:
@@ -3720,7 +6921,7 @@ def generar_analisis_estadistico(df):
     return analisis
 
 
-def generar_recomendaciones(df, analisis, budget_info=None, predicciones=None):
+def generar_recomendaciones(df, analisis, budget_info=None, predicciones=None, cubo=None):
     """Genera recomendaciones personalizadas de ahorro"""
     recomendaciones = {
         'ahorro': [],
@@ -3730,11 +6931,12 @@ def generar_recomendaciones(df, analisis, budget_info=None, predicciones=None):
     }
     
     try:
-        gasto_total = df['cantidad'].sum()
-        gasto_promedio = df['cantidad'].mean()
+        cubo = cubo or obtener_cubo_agregados(df)
+        gasto_total = cubo['total']
+        gasto_promedio = cubo['media']
         
         # Analizar categorías con mayor gasto
-        gastos_categoria = df.groupby('categoria')['cantidad'].sum().sort_values(ascending=False)
+        gastos_categoria = cubo['por_categoria']['total'].sort_values(ascending=False)
         
         # Top 3 categorías con más gasto
         for i, (categoria, total) in enumerate(gastos_categoria.head(3).items()):
@@ -3766,10 +6968,10 @@ def generar_recomendaciones(df, analisis, budget_info=None, predicciones=None):
                 })
         
         # Metas sugeridas dinámicas (evitar "números rojos")
-        gasto_mensual_promedio = gasto_total / max(df['mes'].nunique(), 1)
+        gasto_mensual_promedio = gasto_total / max(cubo['por_mes'].index.month.nunique(), 1)
         # Obtener predicción próxima (si no viene, calcular)
         if not predicciones:
-            predicciones = generar_predicciones(df)
+            predicciones = generar_predicciones(df, cubo=cubo)
         pred_next = predicciones.get('proximo_mes', {}).get('estimacion_ajustada') or predicciones.get('proximo_mes', {}).get('estimacion_base') or gasto_mensual_promedio
         # Determinar presupuesto/ingresos
         monthly_budget = None
@@ -3875,13 +7077,17 @@ def generar_recomendaciones(df, analisis, budget_info=None, predicciones=None):
     return recomendaciones
 
 
-def preparar_datos_graficos(df):
+def preparar_datos_graficos(df, cubo=None):
     """Prepara datos estructurados para gráficos en frontend"""
     graficos = {}
     
     try:
+        cubo = cubo or obtener_cubo_agregados(df)
+        mes_categoria = cubo['por_mes_categoria'].reset_index()
+        mes_categoria['mes'] = mes_categoria['año_mes'].dt.month
+        
         # 1. Gráfico de pastel - Distribución por categoría
-        categorias = df.groupby('categoria')['cantidad'].sum()
+        categorias = cubo['por_categoria']['total']
         graficos['pie_categorias'] = {
             'tipo': 'pie',
             'titulo': 'Distribución de Gastos por Categoría',
@@ -3892,7 +7098,7 @@ def preparar_datos_graficos(df):
         
         # 2. Gráfico de barras - Gastos por mes
         meses_nombres = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
-        gastos_mes = df.groupby('mes')['cantidad'].sum()
+        gastos_mes = mes_categoria.groupby('mes')['total'].sum()
         
         graficos['bar_meses'] = {
             'tipo': 'bar',
@@ -3903,21 +7109,19 @@ def preparar_datos_graficos(df):
         }
         
         # 3. Gráfico de línea - Tendencia temporal
-        gastos_diarios = df.groupby(df['fecha'].dt.date)['cantidad'].sum().reset_index()
-        gastos_diarios.columns = ['fecha', 'total']
-        gastos_diarios = gastos_diarios.sort_values('fecha').tail(30)  # Últimos 30 días
+        gastos_diarios = cubo['por_dia']['total'].tail(30)  # Últimos 30 días
         
         graficos['line_tendencia'] = {
             'tipo': 'line',
             'titulo': 'Tendencia de Gastos (Últimos 30 días)',
-            'labels': [str(f) for f in gastos_diarios['fecha'].values],
-            'values': [round(v, 2) for v in gastos_diarios['total'].values],
+            'labels': [str(f.date()) for f in gastos_diarios.index],
+            'values': [round(v, 2) for v in gastos_diarios.values],
             'color': '#FF6384'
         }
         
         # 4. Gráfico de barras - Gastos por día de semana
         dias = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
-        gastos_dia = df.groupby('dia_semana')['cantidad'].sum()
+        gastos_dia = cubo['por_dia_semana']['total']
         
         graficos['bar_dias_semana'] = {
             'tipo': 'bar',
@@ -3928,18 +7132,18 @@ def preparar_datos_graficos(df):
         }
         
         # 5. Heatmap data - Calendario de gastos
-        gastos_calendario = df.groupby([df['fecha'].dt.date])['cantidad'].sum()
+        gastos_calendario = cubo['por_dia']['total']
         graficos['heatmap_calendario'] = {
             'tipo': 'heatmap',
             'titulo': 'Calendario de Gastos',
             'data': [
-                {'fecha': str(fecha), 'valor': round(valor, 2)}
+                {'fecha': str(fecha.date()), 'valor': round(valor, 2)}
                 for fecha, valor in gastos_calendario.items()
             ]
         }
         
         # 6. Comparativa de categorías (stacked bar)
-        cat_por_mes = df.groupby(['mes', 'categoria'])['cantidad'].sum().unstack(fill_value=0)
+        cat_por_mes = mes_categoria.groupby(['mes', 'categoria'], observed=True)['total'].sum().unstack(fill_value=0)
         graficos['stacked_categorias_mes'] = {
             'tipo': 'stacked_bar',
             'titulo': 'Categorías por Mes',
@@ -3949,19 +7153,19 @@ def preparar_datos_graficos(df):
                     'label': cat,
                     'data': [round(cat_por_mes.loc[m, cat] if cat in cat_por_mes.columns else 0, 2) for m in cat_por_mes.index]
                 }
-                for cat in df['categoria'].unique()
+                for cat in categorias.index
             ]
         }
         
         # 7. Top 5 gastos más grandes
-        top_gastos = df.nlargest(5, 'cantidad')[['categoria', 'cantidad', 'descripcion', 'fecha']]
+        top_gastos = df.nlargest(5, 'monto')[['categoria', 'monto', 'descripcion', 'fecha']]
         graficos['top_gastos'] = {
             'tipo': 'lista',
             'titulo': 'Top 5 Gastos Más Grandes',
             'data': [
                 {
                     'categoria': row['categoria'],
-                    'cantidad': round(row['cantidad'], 2),
+                    'cantidad': round(row['monto'], 2),
                     'descripcion': row.get('descripcion', 'N/A'),
                     'fecha': row['fecha'].strftime('%Y-%m-%d')
                 }
@@ -4061,21 +7265,19 @@ def obtener_predicciones(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': error}), 500
         
-        if not gastos or len(gastos) < 3:
-            return jsonify({'error': 'Datos insuficientes'}), 400
-        
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        if len(df) < 3:
+            return jsonify({'error': 'Datos insuficientes', 'fechas_invalidas': fechas_invalidas}), 400
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
-            'predicciones': generar_predicciones(df)
+            'predicciones': generar_predicciones(df),
+            'fechas_invalidas': fechas_invalidas
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4089,19 +7291,13 @@ def obtener_analisis(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': error}), 500
         
-        if not gastos or len(gastos) < 3:
-            return jsonify({'error': 'Datos insuficientes'}), 400
-        
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
-        df['mes'] = df['fecha'].dt.month
-        df['año'] = df['fecha'].dt.year
-        df['dia_semana'] = df['fecha'].dt.dayofweek
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        if len(df) < 3:
+            return jsonify({'error': 'Datos insuficientes', 'fechas_invalidas': fechas_invalidas}), 400
 
         # Filtros de periodo opcionales via query params
         period = request.args.get('period')
@@ -4116,11 +7312,10 @@ def obtener_analisis(usuario_id):
             try:
                 if p_norm == 'month':
                     # v: YYYY-MM
-                    df_in['period_m'] = df_in['fecha'].dt.to_period('M').astype(str)
-                    return df_in[df_in['period_m'] == v], {'period': p, 'value': v}
+                    return df_in[df_in['año_mes'].astype(str) == v], {'period': p, 'value': v}
                 elif p_norm == 'year':
                     yr = int(v)
-                    return df_in[df_in['fecha'].dt.year == yr], {'period': p, 'value': v}
+                    return df_in[df_in['año'] == yr], {'period': p, 'value': v}
                 elif p_norm == 'quarter':
                     # v: YYYY-Qn or Qn-YYYY
                     if '-' in v:
@@ -4135,7 +7330,7 @@ def obtener_analisis(usuario_id):
                         yr, qstr = v.split('Q') if 'Q' in v else (v, '1')
                         yr = int(yr)
                         q = int(qstr)
-                    mask = (df_in['fecha'].dt.year == yr) & (df_in['fecha'].dt.quarter == q)
+                    mask = (df_in['año'] == yr) & (df_in['trimestre'] == q)
                     return df_in[mask], {'period': p, 'value': f'{yr}-Q{q}'}
             except Exception:
                 return df_in, None
@@ -4146,8 +7341,9 @@ def obtener_analisis(usuario_id):
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
-            'analisis': generar_analisis_estadistico(df),
-            'filtro': filtro_aplicado
+            'analisis': generar_analisis_estadistico(df, usuario_id=usuario_id),
+            'filtro': filtro_aplicado,
+            'fechas_invalidas': fechas_invalidas
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4161,28 +7357,23 @@ def obtener_recomendaciones(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': error}), 500
         
-        if not gastos or len(gastos) < 3:
-            return jsonify({'error': 'Datos insuficientes'}), 400
-        
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
-        df['mes'] = df['fecha'].dt.month
-        df['año'] = df['fecha'].dt.year
-        df['dia_semana'] = df['fecha'].dt.dayofweek
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        if len(df) < 3:
+            return jsonify({'error': 'Datos insuficientes', 'fechas_invalidas': fechas_invalidas}), 400
         
-        analisis = generar_analisis_estadistico(df)
+        analisis = generar_analisis_estadistico(df, usuario_id=usuario_id)
         predicciones = generar_predicciones(df)
         budget_info, _ = obtener_budget_usuario(usuario_id)
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
-            'recomendaciones': generar_recomendaciones(df, analisis, budget_info=budget_info, predicciones=predicciones)
+            'recomendaciones': generar_recomendaciones(df, analisis, budget_info=budget_info, predicciones=predicciones),
+            'fechas_invalidas': fechas_invalidas
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4196,24 +7387,19 @@ def obtener_graficos(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': error}), 500
         
-        if not gastos or len(gastos) < 3:
-            return jsonify({'error': 'Datos insuficientes'}), 400
-        
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
-        df['mes'] = df['fecha'].dt.month
-        df['año'] = df['fecha'].dt.year
-        df['dia_semana'] = df['fecha'].dt.dayofweek
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        if len(df) < 3:
+            return jsonify({'error': 'Datos insuficientes', 'fechas_invalidas': fechas_invalidas}), 400
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
-            'graficos': preparar_datos_graficos(df)
+            'graficos': preparar_datos_graficos(df),
+            'fechas_invalidas': fechas_invalidas
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4227,27 +7413,22 @@ def obtener_score(usuario_id):
         return jsonify({'error': 'Firebase no disponible'}), 503
     
     try:
-        gastos, error = obtener_gastos_firebase(usuario_id)
+        df, error = obtener_frame_gastos(usuario_id)
         if error:
             return jsonify({'error': error}), 500
         
-        if not gastos or len(gastos) < 3:
-            return jsonify({'error': 'Datos insuficientes'}), 400
-        
-        df = pd.DataFrame(gastos)
-        df['fecha'] = df['fecha'].apply(procesar_fecha)
-        df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
-        df['mes'] = df['fecha'].dt.month
-        df['año'] = df['fecha'].dt.year
-        df['dia_semana'] = df['fecha'].dt.dayofweek
+        fechas_invalidas = df.attrs.get('fechas_invalidas', 0)
+        if len(df) < 3:
+            return jsonify({'error': 'Datos insuficientes', 'fechas_invalidas': fechas_invalidas}), 400
         
-        analisis = generar_analisis_estadistico(df)
+        analisis = generar_analisis_estadistico(df, usuario_id=usuario_id)
         score = calcular_score_financiero(df, analisis)
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
-            'score_financiero': score
+            'score_financiero': score,
+            'fechas_invalidas': fechas_invalidas
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4260,17 +7441,19 @@ def obtener_score(usuario_id):
 @app.route('/api/v2/users/<usuario_id>/predict-category', methods=['GET'])
 @token_required
 def predict_category_user(usuario_id):
-    """Predicción por categoría específica. Parámetro: ?category=nombre (opcional)"""
+    """Predicción por categoría específica. Parámetros: ?category=nombre y ?days=30 (opcionales)"""
     try:
         category = request.args.get('category', None)
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        days, err_days = _leer_dias_prediccion()
+        if err_days:
+            return jsonify({'error': err_days}), 400
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         
         if category:
             # Filtrar gastos por categoría
-            df_filtered = df[df['category'].str.lower() == category.lower()]
+            df_filtered = df[df['categoria'].astype(str).str.lower() == category.lower()]
             if df_filtered.empty:
                 return jsonify({
                     'status': 'success',
@@ -4278,14 +7461,19 @@ def predict_category_user(usuario_id):
                     'categoria': category,
                     'data': {'mensaje': f'Sin datos para categoría: {category}'}
                 }), 200
-            prediction = predict_by_category(df_filtered, days=30)
+            prediction = predict_by_category(df_filtered, days=days, usuario_id=usuario_id)
+            precalculado = False
         else:
-            prediction = predict_by_category(df, days=30)
+            prediction = pronostico_precalculado(usuario_id, df, days, 'por_categoria')
+            precalculado = prediction is not None
+            if not precalculado:
+                prediction = predict_by_category(df, days=days, usuario_id=usuario_id)
         
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
             'categoria': category or 'todas',
+            'precalculado': precalculado,
             'data': prediction
         }), 200
     except Exception as e:
@@ -4297,13 +7485,12 @@ def predict_monthly_user(usuario_id):
     """Predicción mensual (30 días). Parámetro: ?category=nombre (opcional)"""
     try:
         category = request.args.get('category', None)
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         
         if category:
-            df = df[df['category'].str.lower() == category.lower()]
+            df = df[df['categoria'].astype(str).str.lower() == category.lower()]
             if df.empty:
                 return jsonify({
                     'status': 'success',
@@ -4312,11 +7499,16 @@ def predict_monthly_user(usuario_id):
                     'data': {'mensaje': f'Sin datos para categoría: {category}'}
                 }), 200
         
-        prediction = predict_monthly(df, days=30)
+        # Con filtro de categoría el frame ya no es el completo y se calcula en vivo
+        prediction = pronostico_precalculado(usuario_id, df, 30, 'mensual')
+        precalculado = prediction is not None
+        if not precalculado:
+            prediction = predict_monthly(df, days=30)
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
             'categoria': category or 'todas',
+            'precalculado': precalculado,
             'data': prediction
         }), 200
     except Exception as e:
@@ -4328,13 +7520,12 @@ def detect_anomalies_user(usuario_id):
     """Detección de anomalías. Parámetro: ?category=nombre (opcional)"""
     try:
         category = request.args.get('category', None)
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         
         if category:
-            df = df[df['category'].str.lower() == category.lower()]
+            df = df[df['categoria'].astype(str).str.lower() == category.lower()]
             if df.empty:
                 return jsonify({
                     'status': 'success',
@@ -4343,7 +7534,7 @@ def detect_anomalies_user(usuario_id):
                     'data': {'anomalias_detectadas': 0}
                 }), 200
         
-        anomalies = detect_anomalies(df)
+        anomalies = detect_anomalies(df, usuario_id=usuario_id)
         return jsonify({
             'status': 'success',
             'usuario_id': usuario_id,
@@ -4357,10 +7548,9 @@ def detect_anomalies_user(usuario_id):
 @token_required
 def compare_models_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': compare_models(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4369,10 +7559,9 @@ def compare_models_user(usuario_id):
 @token_required
 def seasonality_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': analyze_seasonality(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4383,13 +7572,12 @@ def analysis_complete_user(usuario_id):
     """Análisis completo de predicción. Parámetro: ?category=nombre (opcional)"""
     try:
         category = request.args.get('category', None)
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         
         if category:
-            df = df[df['category'].str.lower() == category.lower()]
+            df = df[df['categoria'].astype(str).str.lower() == category.lower()]
             if df.empty:
                 return jsonify({
                     'status': 'error',
@@ -4398,12 +7586,13 @@ def analysis_complete_user(usuario_id):
                     'error': f'Sin datos disponibles para la categoría: {category}'
                 }), 400
         
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'prediccion_categoria': predict_by_category(df),
-            'prediccion_mensual': predict_monthly(df),
-            'anomalias': detect_anomalies(df),
+            'prediccion_categoria': predict_by_category(df, usuario_id=usuario_id),
+            'prediccion_mensual': predict_monthly(df, cubo=cubo),
+            'anomalias': detect_anomalies(df, usuario_id=usuario_id),
             'comparacion_modelos': compare_models(df),
-            'estacionalidad': analyze_seasonality(df),
+            'estacionalidad': analyze_seasonality(df, cubo=cubo),
             'timestamp': datetime.now().isoformat()
         }
         return jsonify({
@@ -4420,11 +7609,12 @@ def analysis_complete_user(usuario_id):
 @token_required
 def correlations_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': analyze_correlations(df)}), 200
+        p_valores, top_k = _leer_opciones_correlacion()
+        correlations = analyze_correlations(df, p_valores=p_valores, top_k=top_k)
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': correlations}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4432,10 +7622,9 @@ def correlations_user(usuario_id):
 @token_required
 def temporal_comparison_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': analyze_temporal_comparison(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4444,12 +7633,13 @@ def temporal_comparison_user(usuario_id):
 @token_required
 def clustering_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        opciones, err_opciones = _leer_opciones_clustering()
+        if err_opciones:
+            return jsonify({'error': err_opciones}), 400
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
-        n_clusters = int(request.args.get('n_clusters', 3))
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': perform_clustering(df, n_clusters)}), 200
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': perform_clustering(df, **opciones)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4457,11 +7647,13 @@ def clustering_user(usuario_id):
 @token_required
 def trends_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        opciones, err_opciones = _leer_opciones_tendencia()
+        if err_opciones:
+            return jsonify({'error': err_opciones}), 400
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': detect_trends(df)}), 200
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': detect_trends(df, **opciones)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4469,11 +7661,10 @@ def trends_user(usuario_id):
 @token_required
 def outliers_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': detect_outliers_iqr(df)}), 200
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': detect_outliers_iqr(df, usuario_id=usuario_id)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4481,16 +7672,16 @@ def outliers_user(usuario_id):
 @token_required
 def stat_complete_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'correlaciones': analyze_correlations(df),
-            'comparacion_temporal': analyze_temporal_comparison(df),
+            'correlaciones': analyze_correlations(df, cubo=cubo),
+            'comparacion_temporal': analyze_temporal_comparison(df, cubo=cubo),
             'clustering': perform_clustering(df),
-            'tendencias': detect_trends(df),
-            'outliers': detect_outliers_iqr(df),
+            'tendencias': detect_trends(df, cubo=cubo),
+            'outliers': detect_outliers_iqr(df, usuario_id=usuario_id),
             'timestamp': datetime.now().isoformat()
         }
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': result}), 200
@@ -4502,10 +7693,9 @@ def stat_complete_user(usuario_id):
 @token_required
 def savings_goals_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         goal_name = request.args.get('goal_name', 'Meta')
         target_amount = float(request.args.get('target_amount', 1000))
         months = int(request.args.get('months', 12))
@@ -4517,11 +7707,10 @@ def savings_goals_user(usuario_id):
 @token_required
 def savings_tips_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_personalized_tips(df)}), 200
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_personalized_tips(df, usuario_id=usuario_id)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4529,12 +7718,15 @@ def savings_tips_user(usuario_id):
 @token_required
 def savings_budget_alerts_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        proyeccion, err_proyeccion = _leer_opciones_presupuesto()
+        if err_proyeccion:
+            return jsonify({'error': err_proyeccion}), 400
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         monthly_budget = float(request.args.get('monthly_budget', 3000))
-        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_budget_alerts(df, monthly_budget)}), 200
+        alerts = generate_budget_alerts(df, monthly_budget, usuario_id=usuario_id, proyeccion=proyeccion)
+        return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': alerts}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -4542,10 +7734,9 @@ def savings_budget_alerts_user(usuario_id):
 @token_required
 def savings_health_score_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         monthly_budget = float(request.args.get('monthly_budget', 3000))
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': calculate_financial_health_score(df, monthly_budget)}), 200
     except Exception as e:
@@ -4555,10 +7746,9 @@ def savings_health_score_user(usuario_id):
 @token_required
 def savings_weekly_report_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_weekly_report(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4567,19 +7757,19 @@ def savings_weekly_report_user(usuario_id):
 @token_required
 def savings_complete_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         goal_name = request.args.get('goal_name', 'Meta general')
         target_amount = float(request.args.get('target_amount', 5000))
         months = int(request.args.get('months', 12))
         monthly_budget = float(request.args.get('monthly_budget', 3000))
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'metas_ahorro': calculate_savings_goals(df, goal_name, target_amount, months),
-            'tips_personalizados': generate_personalized_tips(df),
-            'alertas_presupuesto': generate_budget_alerts(df, monthly_budget),
-            'salud_financiera': calculate_financial_health_score(df, monthly_budget),
+            'metas_ahorro': calculate_savings_goals(df, goal_name, target_amount, months, cubo=cubo),
+            'tips_personalizados': generate_personalized_tips(df, cubo=cubo, usuario_id=usuario_id),
+            'alertas_presupuesto': generate_budget_alerts(df, monthly_budget, cubo=cubo, usuario_id=usuario_id),
+            'salud_financiera': calculate_financial_health_score(df, monthly_budget, cubo=cubo),
             'reporte_semanal': generate_weekly_report(df),
             'timestamp': datetime.now().isoformat()
         }
@@ -4592,10 +7782,9 @@ def savings_complete_user(usuario_id):
 @token_required
 def charts_heatmap_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_heatmap(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4604,10 +7793,9 @@ def charts_heatmap_user(usuario_id):
 @token_required
 def charts_sankey_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_sankey_diagram(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4616,10 +7804,9 @@ def charts_sankey_user(usuario_id):
 @token_required
 def charts_dashboard_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_interactive_dashboard(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4628,10 +7815,9 @@ def charts_dashboard_user(usuario_id):
 @token_required
 def charts_comparison_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': generate_month_comparison_chart(df)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -4640,10 +7826,9 @@ def charts_comparison_user(usuario_id):
 @token_required
 def charts_export_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
         output_format = request.args.get('format', 'json')
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': export_graphics_as_image(df, output_format)}), 200
     except Exception as e:
@@ -4653,16 +7838,16 @@ def charts_export_user(usuario_id):
 @token_required
 def charts_complete_user(usuario_id):
     try:
-        expenses, err = _normalized_expenses_for_user(usuario_id)
-        if not expenses:
+        df, err = _expenses_from_firebase_for_user(usuario_id)
+        if df is None:
             return jsonify({'error': 'No hay gastos en Firebase', 'detalle': err}), 400
-        df = prepare_dataframe(expenses)
+        cubo = obtener_cubo_agregados(df)
         result = {
-            'heatmap': generate_heatmap(df),
-            'sankey': generate_sankey_diagram(df),
-            'dashboard': generate_interactive_dashboard(df),
-            'comparacion_meses': generate_month_comparison_chart(df),
-            'exportacion': export_graphics_as_image(df, 'json'),
+            'heatmap': generate_heatmap(df, cubo=cubo),
+            'sankey': generate_sankey_diagram(df, cubo=cubo),
+            'dashboard': generate_interactive_dashboard(df, cubo=cubo),
+            'comparacion_meses': generate_month_comparison_chart(df, cubo=cubo),
+            'exportacion': export_graphics_as_image(df, 'json', cubo=cubo),
             'timestamp': datetime.now().isoformat()
         }
         return jsonify({'status': 'success', 'usuario_id': usuario_id, 'data': result}), 200
@@ -4680,4 +7865,6 @@ if __name__ == '__main__':
     print(f"🔧 Debug: {debug}")
     print("="*80 + "\n")
     
+    # Con gunicorn lo arranca post_worker_init (gunicorn.conf.py)
+    iniciar_despachador_outbox()
     app.run(debug=debug, host='0.0.0.0', port=port, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+⚙️ Configuración de gunicorn
+gunicorn la carga automáticamente desde el directorio de trabajo
+(Procfile: gunicorn API_MEJORADA:app).
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def on_starting(server):
+    """Antes de crear los workers: valida dónde vive la lista de JWT revocados."""
+    revocados = os.getenv('JWT_REVOCADOS_DB', '')
+    if revocados.lower() != 'memoria' and not os.path.isabs(revocados):
+        raise RuntimeError(
+            'JWT_REVOCADOS_DB requiere una ruta absoluta en un disco persistente '
+            '(p. ej. /var/data/jwt_revocados.db) o el valor memoria con un único worker; '
+            f'valor actual: {revocados!r}'
+        )
+    if revocados.lower() == 'memoria' and server.cfg.workers > 1:
+        raise RuntimeError(
+            f'JWT_REVOCADOS_DB=memoria con {server.cfg.workers} workers: un token revocado en un '
+            'worker seguiría siendo válido en los demás. Usa un SQLite compartido (ruta absoluta en '
+            'JWT_REVOCADOS_DB) o arranca un único worker.'
+        )
+
+
+def post_worker_init(worker):
+    """Con la app ya cargada en el worker, arranca sus servicios en segundo plano."""
+    import API_MEJORADA
+    API_MEJORADA.iniciar_despachador_outbox()
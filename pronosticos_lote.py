@@ -0,0 +1,64 @@
+"""
+📦 Pronósticos por lotes
+Recalcula los pronósticos (predict_monthly + predict_by_category) de todos
+los usuarios de Firestore y los guarda en users/{id}/pronosticos/actual o en
+un directorio local.
+
+Uso:
+    python pronosticos_lote.py --dias 30 --workers 4
+    python pronosticos_lote.py --usuario abc123 --salida ./pronosticos
+
+Para probar en local sin tocar producción, arrancar el emulador de Firestore
+(firebase emulators:start --only firestore) y exportar FIRESTORE_EMULATOR_HOST:
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python pronosticos_lote.py
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import API_MEJORADA as api
+
+
+def _cliente_firestore():
+    """Cliente global de la API o, si hay emulador configurado, uno contra el emulador."""
+    if os.getenv('FIRESTORE_EMULATOR_HOST'):
+        from google.cloud.firestore_v1 import Client as FirestoreClient
+        proyecto = os.getenv('FIREBASE_PROJECT_ID', 'demo-gestofin')
+        return FirestoreClient(project=proyecto, database=api.FIRESTORE_DATABASE_ID)
+    return api.db
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precalcula los pronósticos de gastos de todos los usuarios')
+    parser.add_argument('--dias', type=int, default=30, help='Horizonte de predicción (default: 30)')
+    parser.add_argument('--workers', type=int, default=api.LOTE_WORKERS, help='Tamaño del pool')
+    parser.add_argument('--modo', choices=['process', 'thread'], default='process', help='Tipo de pool')
+    parser.add_argument('--usuario', action='append', dest='usuarios',
+                        help='Procesar solo este usuario (se puede repetir)')
+    parser.add_argument('--salida', help='Directorio local para los resultados (default: Firestore)')
+    args = parser.parse_args(argv)
+
+    if not 1 <= args.dias <= api.PREDICCION_MAX_DIAS:
+        parser.error(f'--dias debe estar entre 1 y {api.PREDICCION_MAX_DIAS}')
+
+    client = _cliente_firestore()
+    if not client:
+        print('❌ Firebase no disponible - configura las credenciales o FIRESTORE_EMULATOR_HOST')
+        return 1
+
+    resumen = api.ejecutar_pronosticos_lote(
+        client=client,
+        dias=args.dias,
+        workers=args.workers,
+        directorio=args.salida,
+        usuarios=args.usuarios,
+        modo=args.modo
+    )
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 1 if resumen['errores'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
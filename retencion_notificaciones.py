@@ -0,0 +1,59 @@
+"""
+🗜️ Retención del historial de notificaciones
+Resume por mes (usuarios/{id}/notificaciones_resumen/{YYYY-MM}) y elimina las
+entradas de notificaciones_historial más antiguas que el periodo de retención.
+
+Uso:
+    python retencion_notificaciones.py --dias 90
+    python retencion_notificaciones.py --usuario abc123 --dias 30
+
+Para probar en local sin tocar producción, arrancar el emulador de Firestore
+(firebase emulators:start --only firestore) y exportar FIRESTORE_EMULATOR_HOST:
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python retencion_notificaciones.py
+
+Índice necesario (solo sin --usuario): la compactación de todos los usuarios es
+una consulta collection_group con rango y orden sobre fecha_envio, y Firestore
+solo crea automáticamente los índices de campo único con ámbito de colección.
+Hay que habilitar una vez el de ámbito de grupo de colecciones (el emulador no
+lo exige; en producción la consulta falla con FAILED_PRECONDITION y un enlace
+para crearlo):
+    gcloud firestore indexes fields update fecha_envio --collection-group=notificaciones_historial --database=$FIRESTORE_DATABASE_ID --index=order=ascending,query-scope=collection-group
+o en la consola: Firestore > Índices > Campo único > Agregar exención,
+colección notificaciones_historial, campo fecha_envio, ascendente, ámbito
+"Grupo de colecciones".
+"""
+
+import argparse
+import json
+import sys
+
+import API_MEJORADA as api
+from pronosticos_lote import _cliente_firestore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compacta el historial de notificaciones antiguo en resúmenes mensuales')
+    parser.add_argument('--dias', type=int, default=api.NOTIF_HISTORIAL_RETENCION_DIAS,
+                        help=f'Días de historial detallado a conservar (default: {api.NOTIF_HISTORIAL_RETENCION_DIAS})')
+    parser.add_argument('--usuario', help='Compactar solo este usuario (default: todos)')
+    args = parser.parse_args(argv)
+
+    if args.dias < 0:
+        parser.error('--dias debe ser mayor o igual que 0')
+
+    client = _cliente_firestore()
+    if not client:
+        print('❌ Firebase no disponible - configura las credenciales o FIRESTORE_EMULATOR_HOST')
+        return 1
+
+    resumen = api.compactar_historial_notificaciones(
+        dias_retencion=args.dias,
+        usuario_id=args.usuario,
+        client=client
+    )
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())